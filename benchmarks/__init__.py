@@ -0,0 +1 @@
+"""Offline benchmarks of the Vision Agent function app."""
@@ -0,0 +1,93 @@
+"""
+Load test comparing the throughput of the synchronous and asynchronous
+azure_openai_processing activities against a fake Azure OpenAI endpoint.
+
+Synchronous activities hold one of the worker threads for the whole chat
+completion (PYTHON_THREADPOOL_THREAD_COUNT), while asynchronous ones all run on
+the event loop of the worker, up to the concurrency allowed by the host
+(maxConcurrentActivityFunctions in host.json).
+
+Run from the repository root with: python -m benchmarks.async_load
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image
+
+from benchmarks.standin import StandInServer
+
+
+def _activity(function_builder):
+    return function_builder._function._func
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=4, help="worker threads")
+    parser.add_argument(
+        "--concurrency", type=int, default=64, help="concurrent async activities"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.2, help="fake completion latency (s)"
+    )
+    args = parser.parse_args()
+
+    with StandInServer(latency=args.latency) as server:
+        os.environ.update(server.environment())
+        os.environ["RESULT_CACHE_BACKEND"] = "none"
+        import function_app
+
+        buffered = BytesIO()
+        Image.new("RGB", (64, 64), "white").save(buffered, format="JPEG")
+        data_url = "data:image/jpeg;base64," + base64.b64encode(
+            buffered.getvalue()
+        ).decode("utf-8")
+        payload = json.dumps(
+            {
+                "image": data_url,
+                "reference_img": data_url,
+                "analyze_prompt": "load test",
+                "use_cache": False,
+            }
+        )
+
+        sync_activity = _activity(function_app.azure_openai_processing)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            list(executor.map(lambda _: sync_activity(payload), range(args.requests)))
+        sync_elapsed = time.perf_counter() - start
+
+        async_activity = _activity(function_app.azure_openai_processing_async)
+
+        async def run_async():
+            semaphore = asyncio.Semaphore(args.concurrency)
+
+            async def call():
+                async with semaphore:
+                    return await async_activity(payload)
+
+            await asyncio.gather(*(call() for _ in range(args.requests)))
+
+        start = time.perf_counter()
+        asyncio.run(run_async())
+        async_elapsed = time.perf_counter() - start
+
+    print(
+        f"{args.requests} requests, {args.latency * 1000:.0f} ms fake latency, "
+        f"{args.workers} worker threads"
+    )
+    print(f"{'mode':<8}{'elapsed s':>12}{'requests/s':>14}")
+    for mode, elapsed in (("sync", sync_elapsed), ("async", async_elapsed)):
+        print(f"{mode:<8}{elapsed:>12.2f}{args.requests / elapsed:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
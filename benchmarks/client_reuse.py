@@ -0,0 +1,100 @@
+"""
+Micro-benchmark of the activity latency with cold and warm SDK clients.
+
+Cold runs clear the client registry before every call, as when the clients were
+created inside each activity. Warm runs reuse the clients of the registry.
+The activities call a local HTTP stand-in, so the numbers only show the client
+construction and connection overhead, TLS handshakes excluded.
+
+Run from the repository root with: python -m benchmarks.client_reuse
+"""
+
+import argparse
+import base64
+import json
+import os
+import statistics
+import time
+from io import BytesIO
+
+from PIL import Image
+
+from benchmarks.standin import StandInServer
+
+
+def _activity(function_builder):
+    return function_builder._function._func
+
+
+def _measure(call, iterations, cold):
+    from shared_code import clients
+
+    durations = []
+    for _ in range(iterations):
+        if cold:
+            clients.registry.clear()
+        start = time.perf_counter()
+        call()
+        durations.append((time.perf_counter() - start) * 1000)
+    return durations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    with StandInServer(latency=args.latency) as server:
+        os.environ.update(server.environment())
+        os.environ["RESULT_CACHE_BACKEND"] = "none"
+        import function_app
+
+        buffered = BytesIO()
+        Image.new("RGB", (64, 64), "white").save(buffered, format="JPEG")
+        image_bytes = buffered.getvalue()
+        server.put_blob("plans", "plan.jpg", image_bytes)
+        b64_image = base64.b64encode(image_bytes).decode("utf-8")
+        data_url = f"data:image/jpeg;base64,{b64_image}"
+
+        calls = {
+            "read_image": lambda: _activity(function_app.read_image)(
+                json.dumps({"container": "plans", "filename": "plan.jpg"})
+            ),
+            "object_detection": lambda: _activity(function_app.object_detection)(
+                json.dumps({"image_data": b64_image})
+            ),
+            "azure_openai_processing": lambda: _activity(
+                function_app.azure_openai_processing
+            )(
+                json.dumps(
+                    {
+                        "image": data_url,
+                        "reference_img": data_url,
+                        "analyze_prompt": "benchmark",
+                        "use_cache": False,
+                    }
+                )
+            ),
+        }
+
+        print(
+            f"{'activity':<26}{'clients':<8}{'mean ms':>10}{'p50 ms':>10}"
+            f"{'p95 ms':>10}{'connections':>13}"
+        )
+        for name, call in calls.items():
+            call()  # imports and first connection out of the measure
+            for cold in (True, False):
+                connections = server.connections
+                durations = _measure(call, args.iterations, cold)
+                percentiles = statistics.quantiles(durations, n=20)
+                print(
+                    f"{name:<26}{'cold' if cold else 'warm':<8}"
+                    f"{statistics.mean(durations):>10.2f}"
+                    f"{percentiles[9]:>10.2f}{percentiles[18]:>10.2f}"
+                    f"{server.connections - connections:>13}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,340 @@
+"""
+In-process stand-ins for the Blob Storage, Custom Vision and Azure OpenAI clients.
+
+They are plugged into shared_code.clients with registry.override, so the
+activities run unchanged against them. Every backend draws its latency from a
+log-normal distribution around a median, and fails a configurable fraction of
+the calls with a transient error or with a throttling (429) error carrying a
+retry-after delay, the way the real services do.
+"""
+
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+import httpx
+import openai
+from azure.core.exceptions import (
+    HttpResponseError,
+    ResourceExistsError,
+    ResourceNotFoundError,
+)
+from openai.types.chat import ChatCompletion
+
+from shared_code import clients
+
+DEFAULT_TAGS = ("door", "window", "outlet", "switch", "light_fixture")
+DEFAULT_ANSWERS = ("Duplex outlet", "Single pole switch", "Ceiling light", "Door")
+_BATCH_COUNT = re.compile(r"from 1 to (\d+)")
+
+
+class FaultProfile:
+    """
+    Latency and failure distribution of a fake backend: log-normal latency of
+    median median_ms and shape sigma, error_rate of transient failures and
+    throttle_rate of 429 answers asking to retry after retry_after_ms.
+    """
+
+    def __init__(
+        self,
+        median_ms=0.0,
+        sigma=0.5,
+        error_rate=0.0,
+        throttle_rate=0.0,
+        retry_after_ms=500,
+        seed=0,
+    ):
+        self.median_ms = median_ms
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after_ms = retry_after_ms
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.throttled = 0
+
+    def draw(self):
+        """Wait for the latency of one call and return its outcome."""
+        with self._lock:
+            self.calls += 1
+            latency = (
+                self.median_ms * self._random.lognormvariate(0, self.sigma) / 1000
+                if self.median_ms
+                else 0.0
+            )
+            roll = self._random.random()
+            if roll < self.throttle_rate:
+                outcome = "throttled"
+                self.throttled += 1
+            elif roll < self.throttle_rate + self.error_rate:
+                outcome = "error"
+                self.errors += 1
+            else:
+                outcome = "ok"
+        time.sleep(latency)
+        return outcome
+
+    def stats(self):
+        return {"calls": self.calls, "errors": self.errors, "throttled": self.throttled}
+
+
+def _storage_failure(profile):
+    outcome = profile.draw()
+    if outcome == "throttled":
+        raise HttpResponseError(message="The server is busy. (ServerBusy)")
+    if outcome == "error":
+        raise HttpResponseError(message="Operation could not be completed.")
+
+
+class FakeBlobClient:
+    def __init__(self, service, container, blob):
+        self._service = service
+        self.container_name = container
+        self.blob_name = blob
+        self.url = f"https://fake.blob.core.windows.net/{container}/{blob}"
+
+    def download_blob(self, **kwargs):
+        _storage_failure(self._service.profile)
+        data = self._service.blobs.get((self.container_name, self.blob_name))
+        if data is None:
+            raise ResourceNotFoundError(message=f"{self.blob_name} not found")
+        return SimpleNamespace(
+            readall=lambda: data,
+            readinto=lambda stream: stream.write(data),
+            chunks=lambda: iter([data]),
+            size=len(data),
+        )
+
+    def upload_blob(self, data, overwrite=False, **kwargs):
+        _storage_failure(self._service.profile)
+        key = (self.container_name, self.blob_name)
+        if not overwrite and key in self._service.blobs:
+            raise ResourceExistsError(message=f"{self.blob_name} already exists")
+        if hasattr(data, "read"):
+            data = data.read()
+        # Like the SDK, text is uploaded encoded in UTF-8
+        self._service.blobs[key] = (
+            data.encode("utf-8") if isinstance(data, str) else bytes(data)
+        )
+
+    def delete_blob(self, **kwargs):
+        self._service.blobs.pop((self.container_name, self.blob_name), None)
+
+    def exists(self, **kwargs):
+        return (self.container_name, self.blob_name) in self._service.blobs
+
+    def get_blob_properties(self, **kwargs):
+        data = self._service.blobs[(self.container_name, self.blob_name)]
+        return SimpleNamespace(size=len(data), metadata={})
+
+
+class FakeContainerClient:
+    def __init__(self, service, container):
+        self._service = service
+        self.container_name = container
+
+    def create_container(self, **kwargs):
+        if self.container_name in self._service.containers:
+            raise ResourceExistsError(message=f"{self.container_name} already exists")
+        self._service.containers.add(self.container_name)
+
+    def get_blob_client(self, blob):
+        return FakeBlobClient(self._service, self.container_name, blob)
+
+    def list_blobs(self, name_starts_with=None, **kwargs):
+        prefix = name_starts_with or ""
+        return [
+            SimpleNamespace(name=name, size=len(data))
+            for (container, name), data in sorted(self._service.blobs.items())
+            if container == self.container_name and name.startswith(prefix)
+        ]
+
+
+class FakeBlobServiceClient:
+    """In-memory BlobServiceClient, shared by all the threads of the process."""
+
+    def __init__(self, profile=None):
+        self.profile = profile or FaultProfile()
+        self.blobs = {}
+        self.containers = set()
+
+    def get_blob_client(self, container, blob):
+        return FakeBlobClient(self, container, blob)
+
+    def get_container_client(self, container):
+        return FakeContainerClient(self, container)
+
+    def close(self):
+        pass
+
+
+class FakeCustomVisionClient:
+    """
+    CustomVisionPredictionClient answering detect_image with detections drawn
+    deterministically from the image bytes: the same image always gets the same
+    detections.
+    """
+
+    def __init__(self, profile=None, detections=20, tags=DEFAULT_TAGS):
+        self.profile = profile or FaultProfile()
+        self.detections = detections
+        self.tags = tags
+
+    def detect_image(self, project_id, published_name, image_data, **kwargs):
+        outcome = self.profile.draw()
+        if outcome == "throttled":
+            raise HttpResponseError(message="Too Many Requests (429)")
+        if outcome == "error":
+            raise HttpResponseError(message="Internal Server Error (500)")
+        seed = int.from_bytes(hashlib.sha256(image_data).digest()[:8], "big")
+        rng = random.Random(seed)
+        predictions = []
+        for _ in range(self.detections):
+            width, height = rng.uniform(0.01, 0.06), rng.uniform(0.01, 0.06)
+            predictions.append(
+                SimpleNamespace(
+                    tag_name=rng.choice(self.tags),
+                    probability=rng.uniform(0.3, 1.0),
+                    bounding_box=SimpleNamespace(
+                        left=rng.uniform(0, 1 - width),
+                        top=rng.uniform(0, 1 - height),
+                        width=width,
+                        height=height,
+                    ),
+                )
+            )
+        return SimpleNamespace(predictions=predictions)
+
+
+class _RawResponse:
+    def __init__(self, completion, headers):
+        self._completion = completion
+        self.headers = headers
+
+    def parse(self):
+        return self._completion
+
+
+class _FakeCompletions:
+    def __init__(self, client):
+        self._client = client
+        self.with_raw_response = SimpleNamespace(create=self._create_raw)
+
+    def _create_raw(self, **kwargs):
+        return _RawResponse(self._client.complete(**kwargs), self._client.headers())
+
+    def create(self, **kwargs):
+        return self._client.complete(**kwargs)
+
+
+class FakeAzureOpenAI:
+    """
+    AzureOpenAI client answering chat completions with canned answers: JSON
+    matches for batched symbol requests, one of answers otherwise.
+    """
+
+    def __init__(self, profile=None, answers=DEFAULT_ANSWERS):
+        self.profile = profile or FaultProfile()
+        self.answers = answers
+        self.chat = SimpleNamespace(completions=_FakeCompletions(self))
+
+    def headers(self):
+        return {"x-ratelimit-remaining-requests": "1000"}
+
+    def _error(self, error_class, status, headers=None):
+        request = httpx.Request("POST", "https://fake.openai.azure.com/chat")
+        response = httpx.Response(status, headers=headers or {}, request=request)
+        return error_class(f"Error code: {status}", response=response, body=None)
+
+    def complete(self, messages, response_format=None, **kwargs):
+        outcome = self.profile.draw()
+        if outcome == "throttled":
+            raise self._error(
+                openai.RateLimitError,
+                429,
+                {"retry-after-ms": str(self.profile.retry_after_ms)},
+            )
+        if outcome == "error":
+            raise self._error(openai.InternalServerError, 500)
+
+        text = json.dumps(messages)
+        digest = int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:8], 16)
+        if response_format:
+            count = int(_BATCH_COUNT.search(text).group(1))
+            content = json.dumps(
+                {
+                    "matches": [
+                        {
+                            "index": index,
+                            "name": self.answers[(digest + index) % len(self.answers)],
+                        }
+                        for index in range(1, count + 1)
+                    ]
+                }
+            )
+        else:
+            content = self.answers[digest % len(self.answers)]
+        prompt_tokens = len(text) // 4
+        return ChatCompletion.model_validate(
+            {
+                "id": f"chatcmpl-{digest:08x}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": kwargs.get("model", "fake"),
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": content},
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": len(content) // 4,
+                    "total_tokens": prompt_tokens + len(content) // 4,
+                },
+            }
+        )
+
+    def close(self):
+        pass
+
+
+class FakeBackends:
+    """The three fake backends, installed in and removed from the client registry."""
+
+    def __init__(
+        self, blob=None, custom_vision=None, openai_profile=None, detections=20
+    ):
+        self.blob = FakeBlobServiceClient(blob)
+        self.custom_vision = FakeCustomVisionClient(custom_vision, detections)
+        self.openai = FakeAzureOpenAI(openai_profile)
+
+    def install(self):
+        clients.registry.override("blob", lambda *settings: self.blob)
+        clients.registry.override("custom_vision", lambda *settings: self.custom_vision)
+        clients.registry.override("openai", lambda *settings: self.openai)
+        return self
+
+    def uninstall(self):
+        for name in ("blob", "custom_vision", "openai"):
+            clients.registry.override(name, None)
+
+    def __enter__(self):
+        return self.install()
+
+    def __exit__(self, *exc_info):
+        self.uninstall()
+
+    def stats(self):
+        return {
+            "blob": self.blob.profile.stats(),
+            "custom_vision": self.custom_vision.profile.stats(),
+            "openai": self.openai.profile.stats(),
+        }
@@ -0,0 +1,208 @@
+"""
+Fixture of the ONNX detection backend, so that benchmarks.onnx_parity runs offline.
+
+The fixture model is a tiny stand-in with the input, outputs and metadata of a
+Custom Vision object detection export: it splits its 64x64 BGR input into a 4x4
+grid and returns every cell as a detection, the share of ink of the cell being
+its probability and its tag red_symbol when the ink is red, symbol otherwise.
+The fixture images hold black and red squares filling some of the cells, and the
+recording holds the predictions expected for them, in the format of the
+predictions recorded from the prediction endpoint. So the parity check exercises
+the loading of the model, the batches, the pixel layout and the normalization
+of the boxes without any Azure resource.
+
+The files are written to benchmarks/fixtures/onnx. model.onnx is built with the
+onnx package, which only this script needs.
+
+Run from the repository root with: python -m benchmarks.onnx_fixture
+"""
+
+import json
+import random
+from pathlib import Path
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+FIXTURE = Path("benchmarks/fixtures/onnx")
+INPUT_SIZE = 64
+GRID = 4
+LABELS = ("symbol", "red_symbol")
+# (width, height) of the fixture images, resized to the input of the model
+IMAGE_SIZES = ((256, 256), (320, 256), (256, 384))
+IMAGES_PER_SIZE = 2
+# Ink color of each tag, and the resulting share of ink of a filled cell
+INK = {"symbol": ((0, 0, 0), 1.0), "red_symbol": ((255, 0, 0), 2 / 3)}
+
+
+def cell_box(column, row):
+    """Normalized bounding box of a cell of the grid."""
+    return {
+        "left": column / GRID,
+        "top": row / GRID,
+        "width": 1 / GRID,
+        "height": 1 / GRID,
+    }
+
+
+def build_model(path, input_shape=("batch", 3, INPUT_SIZE, INPUT_SIZE)):
+    """
+    Write the fixture model, with an input of input_shape whose dimensions may
+    be symbolic names. Its input must be INPUT_SIZE pixels square at run time.
+    """
+    import onnx
+    from onnx import TensorProto, helper
+
+    cells = GRID * GRID
+    boxes = np.array(
+        [
+            [column / GRID, row / GRID, (column + 1) / GRID, (row + 1) / GRID]
+            for row in range(GRID)
+            for column in range(GRID)
+        ],
+        dtype=np.float32,
+    ).reshape(1, cells, 4)
+    cell_side = INPUT_SIZE // GRID
+
+    def constant(name, value):
+        return helper.make_node(
+            "Constant",
+            [],
+            [name],
+            value=helper.make_tensor(
+                name,
+                TensorProto.INT64 if value.dtype == np.int64 else TensorProto.FLOAT,
+                value.shape,
+                value.ravel().tolist(),
+            ),
+        )
+
+    nodes = [
+        constant("cell_boxes", boxes),
+        constant("full_range", np.array(255.0, dtype=np.float32)),
+        constant("flat_shape", np.array([0, cells], dtype=np.int64)),
+        constant("boxes_shape", np.array([cells, 4], dtype=np.int64)),
+        # Bounds of the blue (0) and red (2) channels of the BGR input
+        constant("blue_start", np.array([0], dtype=np.int64)),
+        constant("blue_end", np.array([1], dtype=np.int64)),
+        constant("red_start", np.array([2], dtype=np.int64)),
+        constant("red_end", np.array([3], dtype=np.int64)),
+        constant("channel_axis", np.array([1], dtype=np.int64)),
+        constant("red_lead", np.array(128.0, dtype=np.float32)),
+        # Mean of each channel over every cell, (N, 3, GRID, GRID)
+        helper.make_node(
+            "AveragePool",
+            ["data"],
+            ["cell_means"],
+            kernel_shape=[cell_side, cell_side],
+            strides=[cell_side, cell_side],
+        ),
+        # Share of ink of each cell, white being 0 and black 1
+        helper.make_node(
+            "ReduceMean", ["cell_means"], ["cell_gray"], axes=[1], keepdims=1
+        ),
+        helper.make_node("Sub", ["full_range", "cell_gray"], ["ink"]),
+        helper.make_node("Div", ["ink", "full_range"], ["ink_share"]),
+        helper.make_node("Reshape", ["ink_share", "flat_shape"], ["detected_scores"]),
+        # Red ink has much more red than blue, in the BGR order of the input
+        helper.make_node(
+            "Slice",
+            ["cell_means", "blue_start", "blue_end", "channel_axis"],
+            ["blue"],
+        ),
+        helper.make_node(
+            "Slice",
+            ["cell_means", "red_start", "red_end", "channel_axis"],
+            ["red"],
+        ),
+        helper.make_node("Sub", ["red", "blue"], ["redness"]),
+        helper.make_node("Greater", ["redness", "red_lead"], ["is_red"]),
+        helper.make_node("Cast", ["is_red"], ["red_class"], to=TensorProto.INT64),
+        helper.make_node("Reshape", ["red_class", "flat_shape"], ["detected_classes"]),
+        # The same cell boxes for every image of the batch
+        helper.make_node("Shape", ["data"], ["batch"], start=0, end=1),
+        helper.make_node(
+            "Concat", ["batch", "boxes_shape"], ["batch_boxes_shape"], axis=0
+        ),
+        helper.make_node(
+            "Expand", ["cell_boxes", "batch_boxes_shape"], ["detected_boxes"]
+        ),
+    ]
+    graph = helper.make_graph(
+        nodes,
+        "fixture_detector",
+        [helper.make_tensor_value_info("data", TensorProto.FLOAT, list(input_shape))],
+        [
+            helper.make_tensor_value_info(
+                "detected_boxes", TensorProto.FLOAT, ["batch", cells, 4]
+            ),
+            helper.make_tensor_value_info(
+                "detected_scores", TensorProto.FLOAT, ["batch", cells]
+            ),
+            helper.make_tensor_value_info(
+                "detected_classes", TensorProto.INT64, ["batch", cells]
+            ),
+        ],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 17)])
+    model.ir_version = 8
+    helper.set_model_props(
+        model,
+        {
+            "Image.BitmapPixelFormat": "Bgr8",
+            "Image.NominalPixelRange": "NominalRange_0_255",
+        },
+    )
+    onnx.checker.check_model(model)
+    onnx.save(model, path)
+
+
+def draw_image(path, size, generator):
+    """Image with squares filling random cells, and their expected predictions."""
+    width, height = size
+    image = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(image)
+    predictions = []
+    for row in range(GRID):
+        for column in range(GRID):
+            if generator.random() < 0.5:
+                continue
+            tag = generator.choice(LABELS)
+            color, probability = INK[tag]
+            draw.rectangle(
+                [
+                    column * width // GRID,
+                    row * height // GRID,
+                    (column + 1) * width // GRID - 1,
+                    (row + 1) * height // GRID - 1,
+                ],
+                fill=color,
+            )
+            predictions.append(
+                {
+                    "tag": tag,
+                    "probability": probability,
+                    "bounding_box": cell_box(column, row),
+                }
+            )
+    image.save(path)
+    return predictions
+
+
+def main():
+    images = FIXTURE / "images"
+    images.mkdir(parents=True, exist_ok=True)
+    build_model(FIXTURE / "model.onnx")
+    (FIXTURE / "labels.txt").write_text("\n".join(LABELS) + "\n")
+    generator = random.Random(0)
+    recorded = {}
+    for width, height in IMAGE_SIZES:
+        for number in range(IMAGES_PER_SIZE):
+            name = f"plan_{width}x{height}_{number}.png"
+            recorded[name] = draw_image(images / name, (width, height), generator)
+    (FIXTURE / "recorded_predictions.json").write_text(json.dumps(recorded, indent=1))
+    print(f"Wrote the model and {len(recorded)} images to {FIXTURE}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+Parity of the ONNX detection backend with the Custom Vision prediction endpoint.
+
+With --record, the images are sent to the prediction endpoint configured in the
+environment (CUSTOM_VISION_* settings) and its predictions are saved to the
+recording file. Without it, the images are detected with the exported model
+(ONNX_MODEL_PATH) and compared to the recorded predictions: detections of the
+same tag are paired greedily by decreasing intersection over union, and the
+report gives, for each image, the share of the cloud detections found locally
+(recall), of the local detections found by the cloud (precision), and the mean
+IoU and probability difference of the pairs. Only the detections above
+--min-probability are compared.
+
+The exit status is 1 when the overall recall or precision is below --min-recall
+or --min-precision, so the script can gate a new model export.
+
+By default the images, the recording and the model (unless ONNX_MODEL_PATH is
+set) are the offline fixture of benchmarks/fixtures/onnx, written by
+benchmarks.onnx_fixture. Pass --images, --recording and --model to check a real
+export against predictions recorded from the prediction endpoint.
+
+Run from the repository root with: python -m benchmarks.onnx_parity
+"""
+
+import argparse
+import json
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif")
+FIXTURE = Path("benchmarks/fixtures/onnx")
+
+
+def _corners(predictions):
+    return np.array(
+        [
+            [
+                p["bounding_box"]["left"],
+                p["bounding_box"]["top"],
+                p["bounding_box"]["left"] + p["bounding_box"]["width"],
+                p["bounding_box"]["top"] + p["bounding_box"]["height"],
+            ]
+            for p in predictions
+        ]
+    ).reshape(-1, 4)
+
+
+def iou_matrix(first, second):
+    """Intersection over union of every pair of boxes of two prediction lists."""
+    a, b = _corners(first)[:, None], _corners(second)[None]
+    width = np.clip(
+        np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]), 0, None
+    )
+    height = np.clip(
+        np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1]), 0, None
+    )
+    intersection = width * height
+    areas_a = (a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1])
+    areas_b = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+    union = areas_a + areas_b - intersection
+    return np.divide(
+        intersection, union, out=np.zeros_like(intersection), where=union > 0
+    )
+
+
+def match_predictions(cloud, local, iou_threshold):
+    """(cloud index, local index, IoU) of the greedily paired detections."""
+    pairs = []
+    for tag in {p["tag"] for p in cloud} & {p["tag"] for p in local}:
+        cloud_ids = [i for i, p in enumerate(cloud) if p["tag"] == tag]
+        local_ids = [i for i, p in enumerate(local) if p["tag"] == tag]
+        ious = iou_matrix([cloud[i] for i in cloud_ids], [local[i] for i in local_ids])
+        while ious.size and ious.max() >= iou_threshold:
+            row, column = np.unravel_index(ious.argmax(), ious.shape)
+            pairs.append((cloud_ids[row], local_ids[column], float(ious[row, column])))
+            ious[row, :] = -1
+            ious[:, column] = -1
+    return pairs
+
+
+def record(image_paths, recording):
+    import function_app
+
+    from shared_code import clients
+
+    predictor = clients.get_custom_vision_client()
+    recorded = {}
+    for path in image_paths:
+        results = predictor.detect_image(
+            os.environ["CUSTOM_VISION_PROJECT_ID"],
+            os.environ["CUSTOM_VISION_ITERATION_PUBLISHED_NAME"],
+            path.read_bytes(),
+        )
+        recorded[path.name] = [
+            function_app.Prediction(
+                tag=p.tag_name,
+                probability=p.probability,
+                bounding_box=function_app.BoundingBox(
+                    left=p.bounding_box.left,
+                    top=p.bounding_box.top,
+                    width=p.bounding_box.width,
+                    height=p.bounding_box.height,
+                ),
+            ).model_dump()
+            for p in results.predictions
+        ]
+        print(f"{path.name}: {len(recorded[path.name])} predictions")
+    recording.write_text(json.dumps(recorded, indent=1))
+
+
+def compare(image_paths, recording, args):
+    from shared_code import onnx_detection
+
+    recorded = json.loads(recording.read_text())
+    totals = {"cloud": 0, "local": 0, "pairs": 0}
+    print(
+        f"{'image':<40}{'cloud':>7}{'local':>7}{'recall':>8}{'precision':>11}"
+        f"{'mean IoU':>10}{'mean dp':>9}"
+    )
+    for path in image_paths:
+        if path.name not in recorded:
+            continue
+        with Image.open(path) as image:
+            local = onnx_detection.detect_image(
+                image, args.tile_size, args.tile_overlap
+            )
+        cloud = [
+            p for p in recorded[path.name] if p["probability"] >= args.min_probability
+        ]
+        local = [p for p in local if p["probability"] >= args.min_probability]
+        pairs = match_predictions(cloud, local, args.iou_threshold)
+        totals["cloud"] += len(cloud)
+        totals["local"] += len(local)
+        totals["pairs"] += len(pairs)
+        mean_iou = np.mean([iou for _, _, iou in pairs]) if pairs else 0.0
+        mean_dp = (
+            np.mean(
+                [
+                    abs(cloud[i]["probability"] - local[j]["probability"])
+                    for i, j, _ in pairs
+                ]
+            )
+            if pairs
+            else 0.0
+        )
+        print(
+            f"{path.name[:39]:<40}{len(cloud):>7}{len(local):>7}"
+            f"{len(pairs) / len(cloud) if cloud else 1.0:>8.1%}"
+            f"{len(pairs) / len(local) if local else 1.0:>11.1%}"
+            f"{mean_iou:>10.3f}{mean_dp:>9.3f}"
+        )
+
+    recall = totals["pairs"] / totals["cloud"] if totals["cloud"] else 1.0
+    precision = totals["pairs"] / totals["local"] if totals["local"] else 1.0
+    print(f"\nOverall recall {recall:.1%}, precision {precision:.1%}")
+    return recall >= args.min_recall and precision >= args.min_precision
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--images", default=FIXTURE / "images", type=Path)
+    parser.add_argument(
+        "--recording", default=FIXTURE / "recorded_predictions.json", type=Path
+    )
+    parser.add_argument(
+        "--model",
+        default=os.environ.get("ONNX_MODEL_PATH", FIXTURE / "model.onnx"),
+        type=Path,
+    )
+    parser.add_argument("--record", action="store_true")
+    parser.add_argument("--tile-size", type=int)
+    parser.add_argument("--tile-overlap", type=int, default=128)
+    parser.add_argument("--min-probability", type=float, default=0.5)
+    parser.add_argument("--iou-threshold", type=float, default=0.5)
+    parser.add_argument("--min-recall", type=float, default=0.9)
+    parser.add_argument("--min-precision", type=float, default=0.9)
+    args = parser.parse_args()
+    os.environ["ONNX_MODEL_PATH"] = str(args.model)
+
+    image_paths = sorted(
+        path
+        for path in Path(args.images).iterdir()
+        if path.suffix.lower() in IMAGE_EXTENSIONS
+    )
+    if args.record:
+        record(image_paths, args.recording)
+    elif not compare(image_paths, args.recording, args):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
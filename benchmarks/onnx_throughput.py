@@ -0,0 +1,82 @@
+"""
+Throughput of the ONNX detection backend, in images per second per core.
+
+The images are detected with the exported model (ONNX_MODEL_PATH), whole or in
+tiles of --tile-size pixels, with onnxruntime limited to --threads threads. The
+preprocessing and the inference are timed separately, after a warm-up pass, so
+that the batch size (ONNX_BATCH_SIZE) and the thread count can be tuned for the
+function app plan.
+
+Run from the repository root with: python -m benchmarks.onnx_throughput
+"""
+
+import argparse
+import os
+import time
+from pathlib import Path
+
+from PIL import Image
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--images", default="images-dumb-training")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--tile-size", type=int)
+    parser.add_argument("--tile-overlap", type=int, default=128)
+    args = parser.parse_args()
+
+    os.environ["ONNX_INTRA_OP_THREADS"] = str(args.threads)
+    from shared_code import detections, onnx_detection
+
+    images = []
+    for path in sorted(Path(args.images).iterdir()):
+        if path.suffix.lower() in IMAGE_EXTENSIONS:
+            with Image.open(path) as image:
+                images.append(image.convert("RGB"))
+    detector = onnx_detection.get_onnx_detector()
+
+    # Inputs of the model: whole images, or all the tiles of the images
+    inputs = []
+    for image in images:
+        if args.tile_size:
+            inputs.extend(
+                image.crop(tile)
+                for tile in detections.plan_tiles(
+                    image.width, image.height, args.tile_size, args.tile_overlap
+                )
+            )
+        else:
+            inputs.append(image)
+
+    detector.detect(inputs[: detector.batch_size])  # session warm-up
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        detector.detect(inputs)
+    elapsed = time.perf_counter() - start
+    # Preprocessing alone, the rest of the time being the inference
+    start = time.perf_counter()
+    for batch_start in range(0, len(inputs), detector.batch_size):
+        onnx_detection.preprocess(
+            inputs[batch_start : batch_start + detector.batch_size],
+            detector.input_size,
+            detector.bgr,
+            detector.range_255,
+        )
+    preprocess_seconds = (time.perf_counter() - start) * args.repeat
+
+    processed = args.repeat * len(images)
+    print(
+        f"{processed} images ({args.repeat * len(inputs)} model inputs) in "
+        f"{elapsed:.2f} s with {args.threads} threads, batches of "
+        f"{detector.batch_size}: {processed / elapsed:.2f} images/s, "
+        f"{processed / elapsed / args.threads:.2f} images/s per core, "
+        f"preprocessing {preprocess_seconds / elapsed:.0%} of the time"
+    )
+
+
+if __name__ == "__main__":
+    main()
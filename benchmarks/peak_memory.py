@@ -0,0 +1,170 @@
+"""
+Peak memory of reading and cropping very large scanned plans.
+
+Synthetic plans of --megapixels pixels (color line drawings, in JPEG and
+PNG) are generated once, then every scenario runs in a fresh process whose peak
+resident memory is reported:
+
+- full: the plan is downloaded whole and decoded at full resolution, as
+  read_image and crop_detections did before the working copies
+- bounded: read_image and crop_detections run against the in-process fake
+  blob storage, the plan being downloaded to a temporary file and replaced by
+  a working copy of at most MAX_IMAGE_PIXELS pixels, and the detections being
+  cropped out of the original plan at full resolution
+
+The exit status is 1 when a bounded scenario goes above --max-rss-mb, so the
+script catches memory regressions of the image pipeline.
+
+Run from the repository root with: python -m benchmarks.peak_memory
+"""
+
+import argparse
+import base64
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+from io import BytesIO
+from pathlib import Path
+
+DETECTIONS = 50
+ENVIRONMENT = {
+    "BLOB_CONNECTION_STRING": "UseDevelopmentStorage=true",
+    "RESULT_CACHE_BACKEND": "none",
+}
+
+
+def generate(path, megapixels):
+    """Color plan of about megapixels million pixels, with a grid of walls."""
+    from PIL import Image, ImageDraw
+
+    Image.MAX_IMAGE_PIXELS = None
+    side = int((megapixels * 1_000_000) ** 0.5)
+    image = Image.new("RGB", (side, side), "white")
+    draw = ImageDraw.Draw(image)
+    for position in range(0, side, 400):
+        draw.line((position, 0, position, side), fill="black", width=8)
+        draw.line((0, position, side, position), fill="black", width=8)
+    image.save(path, quality=90) if path.suffix == ".jpg" else image.save(path)
+
+
+def detections():
+    return [
+        {
+            "tag": "outlet",
+            "probability": 0.9,
+            "bounding_box": {
+                "left": (index % 10) / 10 + 0.02,
+                "top": (index // 10) / 5 + 0.02,
+                "width": 0.01,
+                "height": 0.01,
+            },
+        }
+        for index in range(DETECTIONS)
+    ]
+
+
+def run_full(path):
+    from PIL import Image
+
+    import function_app
+
+    Image.MAX_IMAGE_PIXELS = None
+    image_bytes = path.read_bytes()
+    encoded = base64.b64encode(image_bytes).decode("utf-8")
+    image = Image.open(BytesIO(base64.b64decode(encoded)))
+    image.load()
+    for detection in detections():
+        function_app.crop_bounding_box(image, detection["bounding_box"])
+
+
+def run_bounded(path):
+    from benchmarks.fake_backends import FakeBackends
+
+    import function_app
+
+    backends = FakeBackends()
+    backends.blob.blobs[("plans", path.name)] = path.read_bytes()
+    with backends:
+        image_data = function_app.read_image._function._func(
+            json.dumps({"container": "plans", "filename": path.name})
+        )["image"]
+        function_app.crop_detections._function._func(
+            json.dumps(
+                {
+                    "image_data": image_data,
+                    "plan": {"container": "plans", "filename": path.name},
+                    "detections": detections(),
+                }
+            )
+        )
+
+
+def run_scenario(scenario, path):
+    """Run one scenario in this process and print its peak RSS in MB."""
+    for name, value in ENVIRONMENT.items():
+        os.environ.setdefault(name, value)
+    {"full": run_full, "bounded": run_bounded}[scenario](path)
+    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--megapixels", type=int, default=200)
+    parser.add_argument("--max-rss-mb", type=float, default=1024)
+    parser.add_argument("--scenario", choices=("full", "bounded"))
+    parser.add_argument("--image", type=Path)
+    args = parser.parse_args()
+
+    if args.scenario:
+        run_scenario(args.scenario, args.image)
+        return
+
+    failed = False
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{'plan':<10}{'scenario':<10}{'file MB':>9}{'peak RSS MB':>13}")
+        for extension in (".jpg", ".png"):
+            path = Path(directory) / f"plan{extension}"
+            subprocess.run(
+                [
+                    sys.executable,
+                    "-c",
+                    "import sys; from pathlib import Path; "
+                    "from benchmarks.peak_memory import generate; "
+                    "generate(Path(sys.argv[1]), int(sys.argv[2]))",
+                    str(path),
+                    str(args.megapixels),
+                ],
+                check=True,
+            )
+            for scenario in ("full", "bounded"):
+                output = subprocess.run(
+                    [
+                        sys.executable,
+                        "-m",
+                        "benchmarks.peak_memory",
+                        "--scenario",
+                        scenario,
+                        "--image",
+                        str(path),
+                    ],
+                    check=True,
+                    capture_output=True,
+                    text=True,
+                ).stdout
+                peak = float(output.strip().splitlines()[-1])
+                print(
+                    f"{extension[1:]:<10}{scenario:<10}"
+                    f"{path.stat().st_size / 2**20:>9.1f}{peak:>13.0f}"
+                )
+                if scenario == "bounded" and peak > args.max_rss_mb:
+                    failed = True
+    if failed:
+        print(f"Peak RSS above {args.max_rss_mb:.0f} MB")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
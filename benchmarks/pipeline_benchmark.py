@@ -0,0 +1,294 @@
+"""
+End-to-end benchmark of the activities against the offline fake backends.
+
+Every image of a folder is run through read_image, object_detection,
+aggregate_detections_activity, crop_detections, azure_openai_processing (one
+call per representative crop, on a thread pool like the fan-out of the
+orchestrator) and generate_summary, with the fake backends of
+benchmarks.fake_backends in place of the Azure services. Failed activities are
+retried like the orchestrator does. The report gives the p50 and p95 latency,
+the retried failures and the mean payload size of every stage, the throughput
+and the peak resident memory of the process.
+
+Run from the repository root with: python -m benchmarks.pipeline_benchmark
+"""
+
+import argparse
+import json
+import os
+import resource
+import statistics
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from pathlib import Path
+
+from PIL import Image, ImageDraw
+
+from benchmarks.fake_backends import FakeBackends, FaultProfile
+
+CONTAINER = "plans"
+LEGEND = "legend.png"
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif")
+ENVIRONMENT = {
+    "BLOB_CONNECTION_STRING": "UseDevelopmentStorage=true",
+    "CUSTOM_VISION_PREDICTION_URL": "https://fake.cognitiveservices.azure.com",
+    "CUSTOM_VISION_PREDICTION_KEY": "fake",
+    "CUSTOM_VISION_PROJECT_ID": "fake",
+    "CUSTOM_VISION_ITERATION_PUBLISHED_NAME": "fake",
+    "OPENAI_ENDPOINT": "https://fake.openai.azure.com",
+    "OPENAI_KEY": "fake",
+    "OPENAI_MODEL": "gpt-4o",
+    "RESULT_CACHE_BACKEND": "none",
+}
+
+
+def _legend_bytes():
+    """Small synthetic legend: a few symbols, each followed by a line of text."""
+    image = Image.new("RGB", (400, 200), "white")
+    draw = ImageDraw.Draw(image)
+    for row in range(4):
+        top = 20 + row * 45
+        draw.ellipse((20, top, 50, top + 30), outline="black", width=3)
+        draw.text((70, top + 10), f"Symbol {row + 1}", fill="black")
+    buffered = BytesIO()
+    image.save(buffered, format="PNG")
+    return buffered.getvalue()
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class StageRecorder:
+    """Latency, retried failures and payload bytes of every stage."""
+
+    def __init__(self, retry_attempts):
+        self.retry_attempts = retry_attempts
+        self.durations = defaultdict(list)
+        self.failures = defaultdict(int)
+        self.payload_bytes = defaultdict(list)
+
+    def run(self, stage, activity, payload):
+        """Run the activity, retrying failures, and return its JSON round-tripped result."""
+        start = time.perf_counter()
+        for attempt in range(1, self.retry_attempts + 1):
+            try:
+                result = activity(payload)
+                break
+            except Exception:
+                self.failures[stage] += 1
+                if attempt == self.retry_attempts:
+                    raise
+        output = json.dumps(result)
+        self.durations[stage].append((time.perf_counter() - start) * 1000)
+        self.payload_bytes[stage].append(len(payload) + len(output))
+        return json.loads(output)
+
+    def report(self):
+        print(
+            f"{'stage':<32}{'calls':>7}{'p50 ms':>10}{'p95 ms':>10}"
+            f"{'failures':>10}{'mean KB':>10}"
+        )
+        for stage, durations in self.durations.items():
+            print(
+                f"{stage:<32}{len(durations):>7}"
+                f"{_percentile(durations, 0.5):>10.1f}"
+                f"{_percentile(durations, 0.95):>10.1f}"
+                f"{self.failures[stage]:>10}"
+                f"{statistics.mean(self.payload_bytes[stage]) / 1024:>10.1f}"
+            )
+
+
+def _activity(function_builder):
+    return function_builder._function._func
+
+
+def run_plan(function_app, recorder, pool, filename, reference, args):
+    """Run one plan through the activities, in the order of the orchestrator."""
+    image_data = recorder.run(
+        "read_image",
+        _activity(function_app.read_image),
+        json.dumps(
+            {
+                "container": CONTAINER,
+                "filename": filename,
+                "as_artifact": args.artifact_mode,
+            }
+        ),
+    )["image"]
+    detections = function_app.metrics.result_of(
+        recorder.run(
+            "object_detection",
+            _activity(function_app.object_detection),
+            json.dumps({"image_data": image_data}),
+        )
+    )
+    aggregation = recorder.run(
+        "aggregate_detections_activity",
+        _activity(function_app.aggregate_detections_activity),
+        json.dumps(
+            {
+                "detections": detections,
+                "min_probability": args.prediction_threshold,
+                "iou_threshold": function_app.DEFAULT_NMS_IOU_THRESHOLD,
+            }
+        ),
+    )
+    table = function_app.detection_utils.DetectionTable.from_dict(aggregation["table"])
+    retained = [
+        function_app.Prediction.model_validate(p) for p in table.to_predictions()
+    ]
+    crops = function_app.metrics.result_of(
+        recorder.run(
+            "crop_detections",
+            _activity(function_app.crop_detections),
+            json.dumps(
+                {
+                    "image_data": image_data,
+                    "detections": [p.model_dump() for p in retained],
+                    "as_artifact": args.artifact_mode,
+                    "dedup_threshold": args.dedup_threshold,
+                }
+            ),
+        )
+    )
+
+    representatives = [
+        index for index, crop in enumerate(crops) if crop["representative"] == index
+    ]
+    analyze = _activity(function_app.azure_openai_processing)
+    payloads = [
+        json.dumps(
+            {
+                "image": crops[index]["image"],
+                "bounding_box": retained[index].bounding_box.model_dump(),
+                "tag": retained[index].tag,
+                "probability": retained[index].probability,
+                "reference_img": reference,
+                "analyze_prompt": "Which legend symbol is this?",
+                "use_cache": False,
+            }
+        )
+        for index in representatives
+    ]
+    answers = dict(
+        zip(
+            representatives,
+            pool.map(
+                lambda payload: recorder.run(
+                    "azure_openai_processing", analyze, payload
+                ),
+                payloads,
+            ),
+        )
+    )
+
+    results = [
+        {
+            "openai_response": answers[crop["representative"]]["openai_response"],
+            "custom_vision_tag": prediction.tag,
+            "probability": prediction.probability,
+        }
+        for crop, prediction in zip(crops, retained)
+    ]
+    recorder.run(
+        "generate_summary",
+        _activity(function_app.generate_summary),
+        json.dumps({"detections": results, "stats": aggregation["stats"]}),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--images", default="images-dumb-training")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--detections", type=int, default=30)
+    parser.add_argument("--prediction-threshold", type=float, default=0.5)
+    parser.add_argument("--dedup-threshold", type=int)
+    parser.add_argument("--artifact-mode", action="store_true")
+    parser.add_argument("--blob-ms", type=float, default=5.0)
+    parser.add_argument("--custom-vision-ms", type=float, default=150.0)
+    parser.add_argument("--openai-ms", type=float, default=400.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after-ms", type=int, default=200)
+    parser.add_argument("--retry-attempts", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for name, value in ENVIRONMENT.items():
+        os.environ.setdefault(name, value)
+    import function_app
+
+    def profile(median_ms, seed):
+        return FaultProfile(
+            median_ms,
+            error_rate=args.error_rate,
+            throttle_rate=args.throttle_rate,
+            retry_after_ms=args.retry_after_ms,
+            seed=args.seed + seed,
+        )
+
+    backends = FakeBackends(
+        profile(args.blob_ms, 0),
+        profile(args.custom_vision_ms, 1),
+        profile(args.openai_ms, 2),
+        detections=args.detections,
+    )
+    filenames = sorted(
+        path.name
+        for path in Path(args.images).iterdir()
+        if path.suffix.lower() in IMAGE_EXTENSIONS
+    )
+    for filename in filenames:
+        backends.blob.blobs[(CONTAINER, filename)] = (
+            Path(args.images) / filename
+        ).read_bytes()
+    backends.blob.blobs[(CONTAINER, LEGEND)] = _legend_bytes()
+
+    recorder = StageRecorder(args.retry_attempts)
+    failed = 0
+    with backends, ThreadPoolExecutor(args.workers) as pool:
+        reference = recorder.run(
+            "read_image (legend)",
+            _activity(function_app.read_image),
+            json.dumps(
+                {
+                    "container": CONTAINER,
+                    "filename": LEGEND,
+                    "as_artifact": args.artifact_mode,
+                }
+            ),
+        )["image"]
+        if not args.artifact_mode:
+            reference = f"data:image/png;base64,{reference}"
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for filename in filenames:
+                try:
+                    run_plan(function_app, recorder, pool, filename, reference, args)
+                except Exception as e:
+                    failed += 1
+                    print(f"{filename} failed: {e}")
+        elapsed = time.perf_counter() - start
+
+    recorder.report()
+    plans = args.repeat * len(filenames)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(
+        f"\n{plans} plans ({failed} failed) in {elapsed:.1f} s: "
+        f"{plans / elapsed * 60:.1f} plans/min, peak RSS {peak_rss:.0f} MB"
+    )
+    for backend, stats in backends.stats().items():
+        print(
+            f"{backend}: {stats['calls']} calls, {stats['errors']} errors, "
+            f"{stats['throttled']} throttled"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+"""
+End-to-end latency of vision_agent_orchestrator with and without pipelined.
+
+The orchestrator is driven on a simulated clock: every activity really runs
+against the offline fake backends of benchmarks.fake_backends, so the tasks and
+their results are the ones of a real run, but it completes after a simulated
+latency of --latency-scale times its base time in LATENCIES, plus a time per KB
+of payload for the Azure OpenAI calls whose prompt grows with it. At most
+--workers activities run at once, the others waiting for a free worker like on
+a function app. Custom Vision detects the same --objects symbols scattered over
+the plan on every tile that fully holds them, so that the overlaps hold
+duplicates like on a real plan. For every mode the report gives the simulated end-to-end time,
+the wall time of every stage, and the critical path: the longest chain of tasks
+each waiting for the previous one, the latency left with unlimited workers.
+
+Run from the repository root with: python -m benchmarks.pipelined_latency
+"""
+
+import argparse
+import heapq
+import json
+import os
+import random
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+from pathlib import Path
+
+from PIL import Image
+
+from benchmarks.fake_backends import FakeBackends
+from benchmarks.pipeline_benchmark import ENVIRONMENT, LEGEND, _legend_bytes
+
+CONTAINER = "plans"
+PLAN = "plan.png"
+# Simulated (base ms, ms per KB of payload) of every activity
+LATENCIES = {
+    "lookup_result": (50, 0),
+    "read_image": (400, 0),
+    "prepare_reference": (900, 0),
+    "create_tiles": (500, 0),
+    "object_detection": (700, 0),
+    "aggregate_detections_activity": (60, 0),
+    "crop_detections": (250, 0),
+    "label_legend": (3500, 0),
+    "local_match": (300, 0),
+    "azure_openai_processing": (2500, 1),
+    "azure_openai_batch_processing": (3500, 1),
+    "generate_summary": (3000, 4),
+    "store_result": (150, 0),
+}
+START = datetime(2025, 1, 1, tzinfo=timezone.utc)
+TAGS = ("door", "window", "outlet", "switch")
+
+
+class _Task:
+    def __init__(self, result, error, done_at, chain_ms):
+        self._result = result
+        self._error = error
+        self.done_at = done_at
+        # Longest chain of dependent tasks ending with this one
+        self.chain_ms = chain_ms
+
+    @property
+    def result(self):
+        if self._error is not None:
+            return self._error
+        return self._result
+
+
+class _Group:
+    def __init__(self, tasks, any_of):
+        self.tasks = tasks
+        self.any_of = any_of
+
+
+class SimulatedContext:
+    """Orchestration context running the activities on a simulated clock."""
+
+    def __init__(self, simulation, orchestration_input, now, instance_id="plan"):
+        self.simulation = simulation
+        self._input = orchestration_input
+        self.now = now
+        self.instance_id = instance_id
+        self.chain_ms = 0.0
+        # The custom status is only computed outside of replays
+        self.is_replaying = True
+
+    @property
+    def current_utc_datetime(self):
+        return self.now
+
+    def get_input(self):
+        return self._input
+
+    def call_activity(self, name, payload=None):
+        return self.simulation.run_activity(name, payload, self.now, self.chain_ms)
+
+    def call_activity_with_retry(self, name, retry_options, payload=None):
+        return self.call_activity(name, payload)
+
+    def call_sub_orchestrator(self, name, payload=None, instance_id=None):
+        return self.simulation.run_orchestrator(
+            name, payload, self.now, instance_id, self.chain_ms
+        )
+
+    def task_all(self, tasks):
+        return _Group(tasks, any_of=False)
+
+    def task_any(self, tasks):
+        return _Group(tasks, any_of=True)
+
+    def set_custom_status(self, status):
+        pass
+
+
+class Simulation:
+    def __init__(self, function_app, objects, workers, latency_scale):
+        self.function_app = function_app
+        self.objects = objects
+        self.latency_scale = latency_scale
+        # Times at which the workers become free
+        self.workers = [START] * workers
+
+    def detect(self, region):
+        """Predictions of the objects fully inside a region of the plan."""
+        region = region or {"left": 0, "top": 0, "width": 1, "height": 1}
+        return [
+            json.dumps(prediction)
+            for prediction in self.objects
+            if region["left"] <= prediction["bounding_box"]["left"]
+            and region["top"] <= prediction["bounding_box"]["top"]
+            and prediction["bounding_box"]["left"] + prediction["bounding_box"]["width"]
+            <= region["left"] + region["width"]
+            and prediction["bounding_box"]["top"] + prediction["bounding_box"]["height"]
+            <= region["top"] + region["height"]
+        ]
+
+    def run_activity(self, name, payload, now, chain_ms):
+        activity = getattr(self.function_app, name)._function._func
+        try:
+            if name == "object_detection":
+                result = self.detect(json.loads(payload).get("region"))
+            else:
+                result = json.loads(json.dumps(activity(payload)))
+            error = None
+        except Exception as e:
+            result, error = None, e
+        base_ms, kb_ms = LATENCIES[name.removesuffix("_async")]
+        duration_ms = (base_ms + kb_ms * len(payload or "") / 1024) * self.latency_scale
+        started = max(now, heapq.heappop(self.workers))
+        done_at = started + timedelta(milliseconds=duration_ms)
+        heapq.heappush(self.workers, done_at)
+        return _Task(result, error, done_at, chain_ms + duration_ms)
+
+    def run_orchestrator(
+        self, name, orchestration_input, now, instance_id="plan", chain_ms=0.0
+    ):
+        orchestrator = getattr(self.function_app, name)._function._func
+        orchestrator = getattr(orchestrator, "orchestrator_function", orchestrator)
+        context = SimulatedContext(self, orchestration_input, now, instance_id)
+        context.chain_ms = chain_ms
+        generator = orchestrator(context)
+        try:
+            task = generator.send(None)
+            while True:
+                if isinstance(task, _Group) and task.any_of:
+                    # The first task to complete, in the order of the list on ties
+                    first = min(task.tasks, key=lambda t: t.done_at)
+                    context.now = max(context.now, first.done_at)
+                    context.chain_ms = max(context.chain_ms, first.chain_ms)
+                    task = generator.send(first)
+                    continue
+                tasks = task.tasks if isinstance(task, _Group) else [task]
+                context.now = max([context.now, *(t.done_at for t in tasks)])
+                context.chain_ms = max([context.chain_ms, *(t.chain_ms for t in tasks)])
+                errors = [t.result for t in tasks if isinstance(t.result, Exception)]
+                if errors:
+                    task = generator.throw(errors[0])
+                elif isinstance(task, _Group):
+                    task = generator.send([t.result for t in tasks])
+                else:
+                    task = generator.send(task.result)
+        except StopIteration as stop:
+            return _Task(stop.value, None, context.now, context.chain_ms)
+
+
+def plan_objects(count, seed):
+    """Symbols of 1 to 2% of the plan side scattered over the plan."""
+    generator = random.Random(seed)
+    objects = []
+    for _ in range(count):
+        width, height = generator.uniform(0.01, 0.02), generator.uniform(0.01, 0.02)
+        objects.append(
+            {
+                "tag": generator.choice(TAGS),
+                "probability": round(generator.uniform(0.5, 1.0), 4),
+                "bounding_box": {
+                    "left": generator.uniform(0, 1 - width),
+                    "top": generator.uniform(0, 1 - height),
+                    "width": width,
+                    "height": height,
+                },
+            }
+        )
+    return objects
+
+
+def _plan_bytes(path):
+    with Image.open(path) as image:
+        buffered = BytesIO()
+        image.convert("RGB").save(buffered, format="PNG")
+    return buffered.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--plan", type=Path)
+    parser.add_argument("--objects", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tile-size", type=int, default=1024)
+    parser.add_argument("--workers", type=int, default=64)
+    parser.add_argument("--max-in-flight", type=int, default=50)
+    parser.add_argument("--latency-scale", type=float, default=1.0)
+    parser.add_argument("--dedup-threshold", type=int)
+    parser.add_argument("--local-match-threshold", type=float)
+    args = parser.parse_args()
+
+    for name, value in ENVIRONMENT.items():
+        os.environ.setdefault(name, value)
+    import function_app
+
+    backends = FakeBackends()
+    if args.plan:
+        backends.blob.blobs[(CONTAINER, PLAN)] = _plan_bytes(args.plan)
+    else:
+        backends.blob.blobs[(CONTAINER, PLAN)] = _plan_bytes(
+            sorted(Path("images-dumb-training").glob("*.jpg"))[0]
+        )
+    backends.blob.blobs[(CONTAINER, LEGEND)] = _legend_bytes()
+    orchestration_input = {
+        "container": CONTAINER,
+        "filename": PLAN,
+        "reference_filename": LEGEND,
+        "analyze_prompt": "Which legend symbol is this?",
+        "tile_size": args.tile_size,
+        "max_in_flight": args.max_in_flight,
+        "dedup_threshold": args.dedup_threshold,
+        "local_match_threshold": args.local_match_threshold,
+        "use_cache": False,
+    }
+
+    with backends:
+        for pipelined in (False, True):
+            simulation = Simulation(
+                function_app,
+                plan_objects(args.objects, args.seed),
+                args.workers,
+                args.latency_scale,
+            )
+            run = simulation.run_orchestrator(
+                "vision_agent_orchestrator",
+                {**orchestration_input, "pipelined": pipelined},
+                START,
+            )
+            output = run.result
+            run_metrics = output["metrics"]
+            print(
+                f"\n{'pipelined' if pipelined else 'barrier'}: "
+                f"{run_metrics['total_ms'] / 1000:.1f} s end to end, critical path "
+                f"{run.chain_ms / 1000:.1f} s, "
+                f"{len(output['detections'])} detections"
+            )
+            for stage in run_metrics["stages"]:
+                print(
+                    f"  {stage['stage']:<12}{stage['calls']:>6} calls"
+                    f"{stage['wall_ms'] / 1000:>8.1f} s"
+                )
+
+
+if __name__ == "__main__":
+    main()
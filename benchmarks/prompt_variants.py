@@ -0,0 +1,138 @@
+"""
+Comparison of the analysis prompt variants over the stored results.
+
+The records of the result store configured by RESULT_STORE_BACKEND (see
+shared_code.result_store) are grouped by prompt version, the most recent record
+of each plan being kept, so the variants are compared over the plans already
+analyzed without running them again. The prompt versions are dated from the
+prompts saved by the frontend in --prompts. For every version the report gives
+its plans, detections, distinct answers, mean latency and tokens per plan, and:
+
+- with --labels, a JSON file mapping plan filenames or image hashes to the
+  expected number of detections of each answer, the mean accuracy over the
+  labeled plans: the matching answers over the larger of the expected and found
+  totals, so that missed and spurious answers both count
+- with --baseline, the share of the detections of the plans also analyzed by
+  the baseline prompt version (a prefix of its hash) with the same answer
+
+Run from the repository root with: python -m benchmarks.prompt_variants
+"""
+
+import argparse
+import json
+from pathlib import Path
+
+from shared_code import result_store
+
+
+def saved_prompts(path):
+    """Timestamp of the first save of every prompt version of prompts.jsonl."""
+    saved = {}
+    if path.exists():
+        for line in path.read_text().splitlines():
+            if line.strip():
+                entry = json.loads(line)
+                version = entry.get("prompt_hash") or result_store.prompt_hash(
+                    entry["prompt"]
+                )
+                saved.setdefault(version, entry["timestamp"])
+    return saved
+
+
+def latest_per_plan(records):
+    """Most recent record of every prompt version and plan, from the newest first."""
+    latest = {}
+    for record in records:
+        latest.setdefault(record["prompt_hash"], {}).setdefault(
+            record["image_hash"], record
+        )
+    return latest
+
+
+def answer_counts(record):
+    counts = {}
+    for answer in record["output"]["detections"]["answers"]:
+        counts[answer] = counts.get(answer, 0) + 1
+    return counts
+
+
+def accuracy(found, expected):
+    matching = sum(
+        min(count, found.get(answer, 0)) for answer, count in expected.items()
+    )
+    return matching / max(sum(found.values()), sum(expected.values()), 1)
+
+
+def box_answers(record):
+    columns = record["output"]["detections"]
+    return {
+        tuple(round(side, 4) for side in box): answer
+        for box, answer in zip(columns["boxes"], columns["answers"])
+    }
+
+
+def agreement(plans, baseline_plans):
+    """Share of the boxes of the plans in common answered like the baseline."""
+    same = total = 0
+    for image_hash, record in plans.items():
+        if image_hash not in baseline_plans:
+            continue
+        baseline = box_answers(baseline_plans[image_hash])
+        for box, answer in box_answers(record).items():
+            if box in baseline:
+                total += 1
+                same += answer == baseline[box]
+    return same / total if total else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--prompts", type=Path, default=Path("prompts.jsonl"))
+    parser.add_argument("--labels", type=Path)
+    parser.add_argument("--baseline")
+    args = parser.parse_args()
+
+    latest = latest_per_plan(result_store.get_result_store().query())
+    saved = saved_prompts(args.prompts)
+    labels = json.loads(args.labels.read_text()) if args.labels else {}
+    baseline_plans = next(
+        (
+            plans
+            for version, plans in latest.items()
+            if args.baseline and version.startswith(args.baseline)
+        ),
+        {},
+    )
+
+    print(
+        f"{'prompt':<14}{'saved':<21}{'plans':>6}{'detections':>11}{'answers':>8}"
+        f"{'mean s':>8}{'tokens':>9}{'accuracy':>9}{'agreement':>10}"
+    )
+    for version, plans in sorted(
+        latest.items(), key=lambda item: saved.get(item[0], "")
+    ):
+        records = list(plans.values())
+        answers = [record["output"]["detections"]["answers"] for record in records]
+        run_metrics = [record["output"].get("metrics", {}) for record in records]
+        total_seconds = sum(m.get("total_ms", 0) for m in run_metrics) / 1000
+        total_tokens = sum(sum(m.get("tokens", {}).values()) for m in run_metrics)
+        scores = []
+        for record in records:
+            expected = labels.get(record["filename"]) or labels.get(
+                record["image_hash"]
+            )
+            if expected:
+                scores.append(accuracy(answer_counts(record), expected))
+        agreed = agreement(plans, baseline_plans) if baseline_plans else None
+        print(
+            f"{version[:12]:<14}{saved.get(version, '-')[:19]:<21}{len(records):>6}"
+            f"{sum(map(len, answers)):>11}"
+            f"{len(set().union(*answers)):>8}"
+            f"{total_seconds / len(records):>8.1f}{total_tokens / len(records):>9.0f}"
+            f"{f'{sum(scores) / len(scores):.1%}' if scores else '-':>9}"
+            f"{f'{agreed:.1%}' if agreed is not None else '-':>10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
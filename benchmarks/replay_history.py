@@ -0,0 +1,215 @@
+"""
+Replay cost of vision_agent_orchestrator against the number of detections, with
+the analysis run inline or split in sub-orchestrations of chunk_size detections.
+
+Durable Functions replays an orchestrator from its start every time one of its
+tasks completes, reading the results already recorded in its history. This
+benchmark drives the orchestrator the same way with instant fake activities, one
+completion at a time, and reports the history size and the time spent replaying
+the parent orchestration and the whole instance tree.
+
+Run from the repository root with: python -m benchmarks.replay_history
+"""
+
+import argparse
+import json
+import time
+from datetime import datetime, timezone
+from typing import NamedTuple
+
+REFERENCE = "artifact://vision-agent-artifacts/" + "0" * 64 + ".png"
+
+
+class _Call(NamedTuple):
+    kind: str
+    name: str
+    payload: object
+
+
+class _Group(NamedTuple):
+    tasks: list
+
+
+class ReplayContext:
+    """Orchestration context recording the tasks scheduled by the orchestrator."""
+
+    def __init__(self, instance_id, orchestration_input):
+        self.instance_id = instance_id
+        self._input = orchestration_input
+        self.is_replaying = True
+        self.current_utc_datetime = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+    def get_input(self):
+        return self._input
+
+    def call_activity(self, name, payload=None):
+        return _Call("activity", name, payload)
+
+    def call_activity_with_retry(self, name, retry_options, payload=None):
+        return self.call_activity(name, payload)
+
+    def call_sub_orchestrator(self, name, payload=None, instance_id=None):
+        return _Call("orchestrator", name, payload)
+
+    def task_all(self, tasks):
+        return _Group(tasks)
+
+    def set_custom_status(self, status):
+        pass
+
+
+def _replay(orchestrator, instance_id, orchestration_input, history):
+    """
+    Run the orchestrator from its start against the recorded history. Returns
+    ("done", output) or ("pending", first task without a recorded result).
+    """
+    generator = orchestrator(ReplayContext(instance_id, orchestration_input))
+    position = 0
+    try:
+        task = generator.send(None)
+        while True:
+            tasks = task.tasks if isinstance(task, _Group) else [task]
+            if position + len(tasks) > len(history):
+                return "pending", tasks[len(history) - position]
+            events = history[position : position + len(tasks)]
+            results = [json.loads(event) for event in events]
+            position += len(tasks)
+            task = generator.send(results if isinstance(task, _Group) else results[0])
+    except StopIteration as stop:
+        return "done", stop.value
+
+
+class FakeActivities:
+    """Instant results shaped like the ones of the real activities."""
+
+    def __init__(self, detections):
+        from function_app import BoundingBox, Prediction
+        from shared_code.detections import DetectionTable
+
+        self.predictions = [
+            Prediction(
+                tag=f"tag{index % 8}",
+                probability=0.9,
+                bounding_box=BoundingBox(
+                    left=(index % 40) / 40,
+                    top=(index // 40) / 40,
+                    width=0.02,
+                    height=0.02,
+                ),
+            ).model_dump_json()
+            for index in range(detections)
+        ]
+        table = DetectionTable.from_predictions(self.predictions).sort()
+        self.aggregation = {"table": table.to_dict(), "stats": table.tag_stats()}
+
+    def __call__(self, name, payload):
+        if name in ("lookup_result", "store_result"):
+            return {}
+        if name.startswith("read_image"):
+            return {"image": REFERENCE, "content_hash": "plan"}
+        if name == "prepare_reference":
+            stats = {"original_tokens": 1105, "prepared_tokens": 765}
+            return {
+                "reference": REFERENCE,
+                "content_hash": "legend",
+                "detail": "high",
+                "stats": stats,
+            }
+        if name == "object_detection":
+            return self.predictions
+        if name == "aggregate_detections_activity":
+            return self.aggregation
+        if name == "crop_detections":
+            count = len(json.loads(payload)["detections"])
+            return [{"image": REFERENCE, "representative": i} for i in range(count)]
+        if name.startswith("azure_openai_processing"):
+            return {"openai_response": "outlet", "cache_hit": False}
+        if name.startswith("generate_summary"):
+            return {"summary": "summary", "estimated_tokens": 0}
+        raise ValueError(f"Unexpected activity {name}")
+
+
+def run_instance(app, activities, name, instance_id, orchestration_input, stats):
+    """Drive one orchestration to completion, one task completion at a time."""
+    orchestrator = getattr(app, name)._function._func.orchestrator_function
+    history = []
+    history_bytes = 0
+    replay_seconds = 0.0
+    while True:
+        start = time.perf_counter()
+        state, value = _replay(orchestrator, instance_id, orchestration_input, history)
+        replay_seconds += time.perf_counter() - start
+        if state == "done":
+            break
+        if value.kind == "orchestrator":
+            sub_id = f"{instance_id}:{len(history)}"
+            result = run_instance(
+                app, activities, value.name, sub_id, value.payload, stats
+            )
+        else:
+            result = activities(value.name, value.payload)
+        event = json.dumps(result)
+        history.append(event)
+        history_bytes += len(event) + len(json.dumps(value.payload))
+
+    stats.append(
+        {
+            "instance": instance_id,
+            "events": len(history),
+            "bytes": history_bytes,
+            "replay_seconds": replay_seconds,
+        }
+    )
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--detections", type=int, nargs="+", default=[10, 100, 500, 1000]
+    )
+    parser.add_argument("--chunk-size", type=int, default=100)
+    parser.add_argument("--max-in-flight", type=int, default=50)
+    args = parser.parse_args()
+
+    import function_app
+
+    print(
+        f"{'detections':>10} {'mode':>8} {'instances':>9} {'parent events':>13} "
+        f"{'parent KB':>9} {'max events':>10} {'parent replay s':>15} "
+        f"{'total replay s':>14}"
+    )
+    for detections in args.detections:
+        activities = FakeActivities(detections)
+        for mode, chunk_size in (("inline", 0), ("chunked", args.chunk_size)):
+            orchestration_input = {
+                "container": "plans",
+                "filename": "plan.png",
+                "reference_filename": "legend.png",
+                "analyze_prompt": "benchmark",
+                "artifact_mode": True,
+                "prediction_threshold": 0.5,
+                "max_in_flight": args.max_in_flight,
+                "chunk_size": chunk_size,
+            }
+            stats = []
+            run_instance(
+                function_app,
+                activities,
+                "vision_agent_orchestrator",
+                "parent",
+                orchestration_input,
+                stats,
+            )
+            parent = stats[-1]
+            print(
+                f"{detections:>10} {mode:>8} {len(stats):>9} {parent['events']:>13} "
+                f"{parent['bytes'] / 1024:>9.1f} "
+                f"{max(s['events'] for s in stats):>10} "
+                f"{parent['replay_seconds']:>15.3f} "
+                f"{sum(s['replay_seconds'] for s in stats):>14.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
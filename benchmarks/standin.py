@@ -0,0 +1,169 @@
+"""
+Local HTTP stand-in for the Azure services called by the activities.
+
+It answers the Blob Storage download, Custom Vision detect_image and Azure
+OpenAI chat completion requests with canned responses, after a configurable
+latency, so the activities can be exercised without any Azure resource.
+"""
+
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ACCOUNT_NAME = "devstoreaccount1"
+# Well-known key of the storage emulator
+ACCOUNT_KEY = (
+    "Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/"
+    "KBHBeksoGMGw=="
+)
+
+_DETECT_PATH = re.compile(r"/customvision/.*/detect/iterations/[^/]+/image")
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def _send(self, status, body, content_type="application/json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        blob = self.server.blobs.get(self.path.split("?", 1)[0])
+        if blob is None:
+            self._send(404, b"", headers={"x-ms-error-code": "BlobNotFound"})
+            return
+        headers = {
+            "x-ms-blob-type": "BlockBlob",
+            "ETag": '"0x1"',
+            "Last-Modified": "Wed, 01 Jan 2025 00:00:00 GMT",
+        }
+        byte_range = self.headers.get("x-ms-range") or self.headers.get("Range")
+        if byte_range:
+            start, _, end = byte_range.split("=", 1)[1].partition("-")
+            start, end = int(start), min(int(end or len(blob) - 1), len(blob) - 1)
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(blob)}"
+            self._send(206, blob[start : end + 1], "application/octet-stream", headers)
+        else:
+            self._send(200, blob, "application/octet-stream", headers)
+
+    def do_POST(self):
+        self._read_body()
+        time.sleep(self.server.latency)
+        if self.server.random.random() < self.server.throttle_rate:
+            self._send(
+                429,
+                b'{"error": {"code": "429", "message": "Rate limit is exceeded."}}',
+                headers={"retry-after-ms": str(self.server.retry_after_ms)},
+            )
+            return
+        if _DETECT_PATH.search(self.path):
+            self._send(200, json.dumps(self.server.detection_response).encode())
+        elif self.path.split("?", 1)[0].endswith("/chat/completions"):
+            self._send(200, json.dumps(self.server.completion_response).encode())
+        else:
+            self._send(404, b"{}")
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, throttle_rate=0.0, retry_after_ms=100, seed=0):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.latency = latency
+        # Share of the POST requests answered with 429 Too Many Requests
+        self.throttle_rate = throttle_rate
+        self.retry_after_ms = retry_after_ms
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.blobs = {}
+        self.detection_response = {
+            "id": "00000000-0000-0000-0000-000000000000",
+            "project": "00000000-0000-0000-0000-000000000000",
+            "iteration": "00000000-0000-0000-0000-000000000000",
+            "created": "2025-01-01T00:00:00Z",
+            "predictions": [
+                {
+                    "probability": 0.9,
+                    "tagId": "00000000-0000-0000-0000-000000000000",
+                    "tagName": "symbol",
+                    "boundingBox": {
+                        "left": 0.1,
+                        "top": 0.1,
+                        "width": 0.05,
+                        "height": 0.05,
+                    },
+                }
+            ],
+        }
+        self.completion_response = {
+            "id": "chatcmpl-standin",
+            "object": "chat.completion",
+            "created": 0,
+            "model": "gpt-4o",
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": "NO MATCH"},
+                }
+            ],
+            "usage": {
+                "prompt_tokens": 1000,
+                "completion_tokens": 3,
+                "total_tokens": 1003,
+            },
+        }
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def put_blob(self, container, name, data):
+        self.blobs[f"/{ACCOUNT_NAME}/{container}/{name}"] = data
+
+    def environment(self):
+        """Application settings pointing the activities to the stand-in."""
+        return {
+            "BLOB_CONNECTION_STRING": (
+                f"DefaultEndpointsProtocol=http;AccountName={ACCOUNT_NAME};"
+                f"AccountKey={ACCOUNT_KEY};BlobEndpoint={self.url}/{ACCOUNT_NAME};"
+            ),
+            "CUSTOM_VISION_PREDICTION_URL": self.url,
+            "CUSTOM_VISION_PREDICTION_KEY": "standin",
+            "CUSTOM_VISION_PROJECT_ID": "00000000-0000-0000-0000-000000000000",
+            "CUSTOM_VISION_ITERATION_PUBLISHED_NAME": "standin",
+            "OPENAI_ENDPOINT": self.url,
+            "OPENAI_KEY": "standin",
+            "OPENAI_MODEL": "gpt-4o",
+        }
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_details):
+        self.shutdown()
+        self.server_close()
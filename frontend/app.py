@@ -1,12 +1,17 @@
 import streamlit as st
 import requests
+import threading
 import time
+from azure.core.exceptions import ResourceExistsError
 from azure.storage.blob import BlobServiceClient
-import uuid
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import json
+import math
 from datetime import datetime
 from PIL import Image, ImageDraw
 import os
+from io import BytesIO
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -16,6 +21,22 @@ STORAGE_CONN_STR = os.getenv("STORAGE_CONN_STR")
 CONTAINER_NAME = os.getenv("CONTAINER_NAME")
 FUNCTION_START_URL = os.getenv("FUNCTION_START_URL")
 
+# Status polling starts fast and backs off while the status does not change
+POLL_MIN_INTERVAL = 0.5
+POLL_MAX_INTERVAL = 5.0
+POLL_BACKOFF = 1.5
+# Largest side of the floor plan preview drawn while the analysis runs
+PREVIEW_SIZE = 1024
+# Pixels of the copy of the floor plan displayed and cropped by the app, large
+# scans are downscaled once when uploaded instead of being decoded in full
+DISPLAY_MAX_PIXELS = 16_000_000
+# Largest side of the thumbnails of the detected regions
+THUMBNAIL_SIZE = 100
+# Largest upload accepted, as in the function app. Pillow's own limit of about
+# 89 megapixels is only raised to it while the header of an upload is read
+MAX_SOURCE_PIXELS = int(os.getenv("MAX_SOURCE_PIXELS", 1_000_000_000))
+_pixel_limit_lock = threading.Lock()
+
 
 def read_default_prompt():
     """Read the default prompt from the default_aoai_prompt.txt file."""
@@ -27,12 +48,80 @@ def read_default_prompt():
     return default_prompt
 
 
+def content_hash(data):
+    """SHA-256 hex digest of bytes, naming and caching uploads by their content."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def results_hash(detections):
+    return content_hash(json.dumps(detections, sort_keys=True).encode("utf-8"))
+
+
+def open_display_image(data, max_pixels=DISPLAY_MAX_PIXELS):
+    """
+    Decoded RGB copy of image bytes of at most max_pixels. JPEG images are
+    decoded directly at a reduced scale, so the full resolution is never held.
+    Raises ValueError for images of more than MAX_SOURCE_PIXELS pixels.
+    """
+    with _pixel_limit_lock:
+        previous = Image.MAX_IMAGE_PIXELS
+        if previous is not None:
+            Image.MAX_IMAGE_PIXELS = max(previous, MAX_SOURCE_PIXELS)
+        try:
+            image = Image.open(BytesIO(data))
+        except Image.DecompressionBombError as e:
+            raise ValueError(f"Image exceeds MAX_SOURCE_PIXELS: {e}") from e
+        finally:
+            Image.MAX_IMAGE_PIXELS = previous
+    if image.width * image.height > MAX_SOURCE_PIXELS:
+        raise ValueError(
+            f"Image of {image.width}x{image.height} pixels exceeds MAX_SOURCE_PIXELS"
+        )
+    factor = math.ceil((image.width * image.height / max_pixels) ** 0.5)
+    if factor > 1:
+        image.draft("RGB", (image.width // factor, image.height // factor))
+        factor = math.ceil((image.width * image.height / max_pixels) ** 0.5)
+        if factor > 1:
+            image = image.reduce(factor)
+    return image.convert("RGB")
+
+
+@st.cache_resource(max_entries=8)
+def load_display_image(image_hash, _data):
+    """
+    Display copy of an uploaded image, decoded once per content. The image is
+    shared by all the reruns and sessions, so it must be copied before drawing.
+    """
+    return open_display_image(_data)
+
+
 # --- Upload Helper ---
-def upload_to_blob(file, blob_name):
-    blob_service = BlobServiceClient.from_connection_string(STORAGE_CONN_STR)
-    blob_client = blob_service.get_blob_client(container=CONTAINER_NAME, blob=blob_name)
-    blob_client.upload_blob(file, overwrite=True)
-    return blob_client.url
+@st.cache_resource
+def get_blob_service_client():
+    """Blob service client shared by all the uploads, keeping its connections open."""
+    return BlobServiceClient.from_connection_string(STORAGE_CONN_STR)
+
+
+def upload_to_blob(data, prefix, extension):
+    """
+    Upload image bytes under a name derived from their content and return the
+    name. Blobs are never overwritten: a file uploaded before is already there.
+    """
+    blob_name = f"{prefix}-{content_hash(data)}{extension}"
+    blob_client = get_blob_service_client().get_blob_client(
+        container=CONTAINER_NAME, blob=blob_name
+    )
+    try:
+        blob_client.upload_blob(data, overwrite=False)
+    except ResourceExistsError:
+        pass
+    return blob_name
+
+
+@st.cache_resource
+def get_http_session():
+    """HTTP session shared by all the requests to the function app, keeping its connections open."""
+    return requests.Session()
 
 
 # --- Trigger Function ---
@@ -44,21 +133,51 @@ def start_durable_function(fp_url, ref_url, prompt):
         "analyze_prompt": prompt,
     }
     # headers = {"x-functions-key": FUNCTION_KEY}  # Optional
-    response = requests.post(FUNCTION_START_URL, json=data)
+    response = get_http_session().post(FUNCTION_START_URL, json=data)
     response.raise_for_status()
     status_query_url = response.json()["statusQueryGetUri"]
     return status_query_url
 
 
 # --- Poll Function ---
-def poll_function_status(status_url):
+def poll_function_status(status_url, on_progress=None):
+    """
+    Poll the orchestration status until it ends. The interval grows while the
+    status stays the same and is reset when it changes, and on_progress is
+    called with every new custom status.
+    """
+    session = get_http_session()
+    interval = POLL_MIN_INTERVAL
+    last_status = None
     while True:
-        res = requests.get(status_url)
+        res = session.get(status_url)
         res.raise_for_status()
         result = res.json()
+        custom_status = result.get("customStatus")
+        if custom_status and custom_status != last_status:
+            last_status = custom_status
+            interval = POLL_MIN_INTERVAL
+            if on_progress:
+                on_progress(custom_status)
+        else:
+            interval = min(interval * POLL_BACKOFF, POLL_MAX_INTERVAL)
         if result["runtimeStatus"] in ["Completed", "Failed", "Terminated"]:
             return result
-        time.sleep(5)
+        time.sleep(interval)
+
+
+def draw_progress_boxes(image, boxes):
+    """Draw the compact [left, top, width, height, tag] boxes of the progress status."""
+    image = image.copy()
+    draw = ImageDraw.Draw(image)
+    img_width, img_height = image.size
+    for left, top, width, height, tag in boxes:
+        left, top = int(left * img_width), int(top * img_height)
+        right = left + int(width * img_width)
+        bottom = top + int(height * img_height)
+        draw.rectangle([left, top, right, bottom], outline="orange", width=2)
+        draw.text((left, top - 10), tag, fill="orange")
+    return image
 
 
 def draw_bounding_boxes(image, detections):
@@ -95,13 +214,29 @@ def crop_detected_regions(image, detections):
     return cropped_images
 
 
+@st.cache_resource(max_entries=8)
+def render_detections(image_hash, detections_hash, _image, _detections):
+    """
+    Floor plan with the detection boxes drawn and thumbnails of the detected
+    regions, cached by image and results hash so that reruns do not redraw them.
+    """
+    image_with_boxes = draw_bounding_boxes(_image.copy(), _detections)
+    thumbnails = []
+    for cropped_img, _ in crop_detected_regions(_image, _detections):
+        cropped_img.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        thumbnails.append(cropped_img)
+    return image_with_boxes, thumbnails
+
+
 st.set_page_config(
     layout="wide",
     page_title="Azure AI Vision Agent Floorplans",
     page_icon=":house_with_garden:",
 )
 st.title("Azure AI Vision Agent Floorplans")
-tab1, tab3, tab2 = st.tabs(["Settings", "Analysis Summary", "Analysis Detailed Output"])
+tab1, tab3, tab2, tab4 = st.tabs(
+    ["Settings", "Analysis Summary", "Analysis Detailed Output", "Performance"]
+)
 
 # Settings tab
 with tab1:
@@ -120,9 +255,14 @@ with tab1:
         )
         # Store the uploaded image in session state
         if fp_image is not None:
-            st.image(
-                Image.open(st.session_state.floorplan), caption="Uploaded Floor Plan"
-            )
+            fp_bytes = fp_image.getvalue()
+            fp_hash = content_hash(fp_bytes)
+            try:
+                fp_display = load_display_image(fp_hash, fp_bytes)
+            except ValueError as e:
+                st.error(str(e))
+                st.stop()
+            st.image(fp_display, caption="Uploaded Floor Plan")
 
     # Reference Image upload column
     with col2:
@@ -131,7 +271,13 @@ with tab1:
             "Upload Reference Image", type=["jpg", "jpeg", "png"], key="legend"
         )
         if ref_image is not None:
-            st.image(Image.open(st.session_state.legend), caption="Uploaded Reference")
+            ref_bytes = ref_image.getvalue()
+            try:
+                ref_display = load_display_image(content_hash(ref_bytes), ref_bytes)
+            except ValueError as e:
+                st.error(str(e))
+                st.stop()
+            st.image(ref_display, caption="Uploaded Reference")
 
     # Analysis Prompt column
     with col3:
@@ -141,83 +287,170 @@ with tab1:
         save_prompt = st.button("Save Prompt")
 
         if save_prompt:
-            # Create a file with the prompt
-            entry = {"timestamp": datetime.now().isoformat(), "prompt": prompt}
+            # Create a file with the prompt, and its version in the result store
+            entry = {
+                "timestamp": datetime.now().isoformat(),
+                "prompt": prompt,
+                "prompt_hash": content_hash(prompt.encode("utf-8")),
+            }
             prompts_file_path = os.path.join(os.getcwd(), "prompts.jsonl")
             with open(prompts_file_path, "a") as f:
                 f.write(json.dumps(entry) + "\n")
             st.success("Prompt saved successfully!")
 
-    result = None  # Initialize result to avoid undefined reference
-
     # Reaction to Run Analysis button click
     if run_analysis and fp_image and ref_image and prompt:
         # Launch Analysis
         with topcol1:
             with st.spinner("Uploading files to Azure Blob Storage..."):
-                # Upload Floor plan image to Azure Blob Storage
-                fp_name = f"floorplan-{uuid.uuid4()}.png"
-                fp_url = upload_to_blob(fp_image, fp_name)
-
-                # Upload Reference image to Azure Blob Storage
-                ref_name = f"reference-{uuid.uuid4()}.png"
-                ref_url = upload_to_blob(ref_image, ref_name)
+                # Upload the floor plan and reference images concurrently, files
+                # already uploaded by a previous run are not sent again
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    fp_upload = executor.submit(
+                        upload_to_blob,
+                        fp_bytes,
+                        "floorplan",
+                        os.path.splitext(fp_image.name)[1].lower(),
+                    )
+                    ref_upload = executor.submit(
+                        upload_to_blob,
+                        ref_bytes,
+                        "reference",
+                        os.path.splitext(ref_image.name)[1].lower(),
+                    )
+                    fp_name = fp_upload.result()
+                    ref_name = ref_upload.result()
 
             with st.spinner("Starting Azure Durable Function..."):
                 status_url = start_durable_function(fp_name, ref_name, prompt)
 
+            # Live progress, boxes and per-tag counts published by the orchestration
+            with topcol2:
+                progress_bar = st.progress(0.0, text="Starting analysis...")
+                counts_placeholder = st.empty()
+                preview_placeholder = st.empty()
+            preview_image = fp_display.copy()
+            preview_image.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE))
+            drawn_boxes = None
+
+            def show_progress(status):
+                global drawn_boxes
+                total = status.get("total", 0)
+                done = status.get("done", 0)
+                progress_bar.progress(
+                    done / total if total else 0.0,
+                    text=f"{status['stage'].capitalize()}: {done}/{total} detections analyzed",
+                )
+                counts_placeholder.markdown(
+                    "\n".join(
+                        f"- **{counts['found']} {tag}** ({counts['answered']} analyzed)"
+                        for tag, counts in status.get("tags", {}).items()
+                    )
+                )
+                boxes = status.get("boxes")
+                if boxes and boxes != drawn_boxes:
+                    drawn_boxes = boxes
+                    caption = "Detected objects"
+                    if status.get("boxes_truncated"):
+                        caption += f" (most probable {len(boxes)} of {total})"
+                    preview_placeholder.image(
+                        draw_progress_boxes(preview_image, boxes), caption=caption
+                    )
+
             with st.spinner("Waiting for analysis to complete..."):
-                final_results = poll_function_status(status_url)
+                final_results = poll_function_status(status_url, show_progress)
 
         # Analysis completed
         with topcol1:
             st.success("Analysis completed successfully!")
+        # Kept for the reruns, which display it again from the cached renderings
+        st.session_state["analysis"] = (fp_hash, final_results)
 
+    # Results of the last analysis of the uploaded floor plan
+    analysis = st.session_state.get("analysis")
+    if fp_image is not None and analysis and analysis[0] == fp_hash:
+        final_results = analysis[1]
         if final_results and final_results["runtimeStatus"] == "Completed":
             # Analysis Summary tab
             with tab3:
                 cola, colb = st.columns([1.5, 2.5])
                 with colb:
                     st.subheader("Analysis")
+                    stored_record = final_results["output"].get("stored_record")
+                    if stored_record:
+                        st.caption(
+                            f"Stored result of a previous run of "
+                            f"{stored_record['created']}"
+                        )
                     st.markdown(final_results["output"]["summary"])
 
                 with cola:
                     # Display aggregated detections
                     st.subheader("Detected Elements")
                     st.write("Elements found in the floor plan:")
-                    for custom_vision_tag, detections in final_results["output"][
-                        "aggregated_detections"
-                    ].items():
-                        count = len(detections)
-                        confidence_avg = (
-                            sum(d["probability"] for d in detections) / count
-                        )
+                    # Per-tag statistics computed once by the orchestration
+                    detection_stats = final_results["output"]["detection_stats"]
+                    for custom_vision_tag, tag_stats in detection_stats.items():
+                        count = tag_stats["count"]
                         st.write(
                             f"- **{count} {custom_vision_tag}{'s' if count > 1 else ''}** "
-                            f"(average confidence of: {confidence_avg:.1%})"
+                            f"(average confidence of: {tag_stats['mean_probability']:.1%}, "
+                            f"from {tag_stats['min_probability']:.1%} to {tag_stats['max_probability']:.1%})"
                         )
 
             # Analysis Detailed Output tab
             with tab2:
                 st.success("Analysis completed successfully!")
                 cola, colb = st.columns([2.5, 1.5])
+                detections = final_results["output"]["detections"]
+                image_with_boxes, thumbnails = render_detections(
+                    fp_hash, results_hash(detections), fp_display, detections
+                )
                 with cola:
                     st.subheader("Object Detection Output")
-                    image = Image.open(fp_image)
-                    detections = final_results["output"]["detections"]
-                    image_with_boxes = draw_bounding_boxes(image, detections)
                     st.image(image_with_boxes, caption="Detected Objects")
                 with colb:
-                    cropped_images = crop_detected_regions(
-                        image, final_results["output"]["detections"]
-                    )
                     st.subheader("Outputs")
-                    for cropped_img, detection in cropped_images:
+                    for thumbnail, detection in zip(thumbnails, detections):
                         sub_col1, sub_col2 = st.columns([0.5, 2])
                         with sub_col1:
-                            st.image(cropped_img, width=50)
+                            st.image(thumbnail, width=50)
                         with sub_col2:
-                            st.json(detection)
+                            st.json(detection, expanded=False)
+            # Performance tab
+            with tab4:
+                run_metrics = final_results["output"]["metrics"]
+                stages = run_metrics["stages"]
+                tokens = run_metrics["tokens"]
+                col_total, col_tokens, col_image = st.columns(3)
+                col_total.metric(
+                    "Total time", f"{run_metrics['total_ms'] / 1000:.1f} s"
+                )
+                col_tokens.metric(
+                    "Azure OpenAI tokens",
+                    f"{tokens['prompt'] + tokens['completion']:,}",
+                    f"{tokens['completion']:,} completion",
+                    delta_color="off",
+                )
+                if run_metrics["image"]["width"]:
+                    col_image.metric(
+                        "Image size",
+                        f"{run_metrics['image']['width']} x {run_metrics['image']['height']}",
+                    )
+                if stages:
+                    slowest = max(stages, key=lambda stage: stage["wall_ms"])
+                    st.write(
+                        f"Slowest stage: **{slowest['stage']}** "
+                        f"({slowest['wall_ms'] / 1000:.1f} s over {slowest['calls']} calls)"
+                    )
+                    st.bar_chart(stages, x="stage", y="wall_ms")
+                    st.dataframe(stages, use_container_width=True)
+                st.write(
+                    f"Result cache: {run_metrics['cache']['hits']} hits, "
+                    f"{run_metrics['cache']['misses']} misses. "
+                    f"Deduplication: {run_metrics['dedup']['analyzed']} of "
+                    f"{run_metrics['dedup']['detections']} detections analyzed."
+                )
         else:
             st.error(f"Function failed with status: {final_results['runtimeStatus']}")
-            st.json(result)
+            st.json(final_results)
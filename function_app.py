@@ -1,18 +1,19 @@
 import azure.functions as func
 import azure.durable_functions as df
-from azure.cognitiveservices.vision.customvision.prediction import (
-    CustomVisionPredictionClient,
-)
-from azure.storage.blob import BlobServiceClient
-from msrest.authentication import ApiKeyCredentials
 import os
+import math
+import asyncio
+import hashlib
 import json
 import base64
-from openai import AzureOpenAI
 from PIL import Image
 from io import BytesIO
 from pydantic import BaseModel
 import logging
+from shared_code import artifacts, dedup, detections as detection_utils
+from shared_code import clients, large_images, metrics, rate_limit, reference
+from shared_code import result_cache, result_store, summaries, symbol_analysis
+from shared_code import onnx_detection, template_matching
 
 
 class BoundingBox(BaseModel):
@@ -28,6 +29,1208 @@ class Prediction(BaseModel):
     bounding_box: BoundingBox
 
 
+# Pixels added around each bounding box when cropping detections
+DEFAULT_CROP_PADDING = 10
+# Image format used to encode the cropped detections sent to Azure OpenAI
+DEFAULT_CROP_FORMAT = "JPEG"
+# Tiled object detection: overlap between tiles in pixels, and the IoU above
+# which detections of the same tag coming from different tiles are merged
+DEFAULT_TILE_OVERLAP = 128
+DEFAULT_NMS_IOU_THRESHOLD = 0.5
+# Object detection with the Custom Vision prediction endpoint (custom_vision) or
+# with the model exported to ONNX, run in the function app (onnx)
+DEFAULT_DETECTION_BACKEND = "custom_vision"
+# Azure OpenAI activities started at once by an orchestration, and their retries
+DEFAULT_MAX_IN_FLIGHT = 50
+DEFAULT_RETRY_INTERVAL_MS = 2000
+DEFAULT_RETRY_ATTEMPTS = 3
+# Detections analyzed by one sub-orchestration when a plan is split in chunks
+DEFAULT_CHUNK_SIZE = 200
+# Plans analyzed at once by batch_orchestrator, the perceptual hash distance
+# under which symbols of different plans are analyzed once, and the number of
+# answered symbols shared with the next plans
+DEFAULT_MAX_CONCURRENT_PLANS = 4
+DEFAULT_SEED_PLANS = 1
+DEFAULT_BATCH_DEDUP_THRESHOLD = 0
+MAX_KNOWN_SYMBOLS = 1000
+PLAN_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".bmp", ".tif", ".tiff", ".webp")
+# Durable Functions limits the custom status to 16 KB once serialized
+MAX_CUSTOM_STATUS_BYTES = 15 * 1024
+
+
+def padded_box(bounding_box, width, height, padding=DEFAULT_CROP_PADDING):
+    """
+    Pixel box (left, top, right, bottom) of a normalized bounding box in a width x
+    height image, with padding in pixels.
+    """
+    left = max(0, int(bounding_box["left"] * width) - padding)
+    top = max(0, int(bounding_box["top"] * height) - padding)
+    right = min(
+        width,
+        int((bounding_box["left"] + bounding_box["width"]) * width) + padding,
+    )
+    bottom = min(
+        height,
+        int((bounding_box["top"] + bounding_box["height"]) * height) + padding,
+    )
+    return left, top, right, bottom
+
+
+def crop_bounding_box(image, bounding_box, padding=DEFAULT_CROP_PADDING):
+    """Crop a normalized bounding box out of a PIL image, with padding in pixels."""
+    return image.crop(padded_box(bounding_box, image.width, image.height, padding))
+
+
+def download_plan(plan):
+    """Download the original plan of a working copy to a temporary file."""
+    blob_client = clients.get_blob_service_client().get_blob_client(
+        container=plan["container"], blob=plan["filename"]
+    )
+    return large_images.download_to_file(blob_client)
+
+
+def encode_image(image, image_format=DEFAULT_CROP_FORMAT):
+    """Encode a PIL image to bytes in the requested format."""
+    buffered = BytesIO()
+    if image_format == "JPEG":
+        image = image.convert("RGB")
+    image.save(buffered, format=image_format)
+    return buffered.getvalue()
+
+
+def jittered_retry_options(index, first_retry_interval_ms, max_attempts):
+    """
+    Durable retry options whose first retry interval is spread by the task index,
+    so that the retries of throttled activities do not all fire together. The
+    spread is deterministic, as required for orchestrator replays.
+    """
+    if not first_retry_interval_ms or first_retry_interval_ms <= 0:
+        raise ValueError(
+            f"retry_interval_ms must be a positive number of milliseconds, "
+            f"got {first_retry_interval_ms}"
+        )
+    jitter = (index * 7919) % first_retry_interval_ms
+    return df.RetryOptions(first_retry_interval_ms + jitter, max_attempts)
+
+
+def compact_boxes(predictions, budget=MAX_CUSTOM_STATUS_BYTES // 2):
+    """
+    [left, top, width, height, tag] of the most probable detections, rounded and
+    limited to about budget bytes of JSON so that they fit in the custom status.
+    """
+    boxes = []
+    size = 0
+    for prediction in sorted(predictions, key=lambda p: -p["probability"]):
+        bbox = prediction["bounding_box"]
+        box = [
+            round(bbox["left"], 4),
+            round(bbox["top"], 4),
+            round(bbox["width"], 4),
+            round(bbox["height"], 4),
+            prediction["tag"],
+        ]
+        size += len(json.dumps(box)) + 1
+        if size > budget:
+            break
+        boxes.append(box)
+    return boxes
+
+
+def progress_status(stage, retained=(), representatives=None, answered=(), boxes=()):
+    """
+    Custom status published as the orchestration progresses: the current stage,
+    the retained detections answered so far out of their total, the per-tag
+    found and answered counts, and the compact boxes of the detections.
+    """
+    if representatives is None:
+        representatives = range(len(retained))
+    answered = set(answered)
+    tags = {}
+    for prediction, representative in zip(retained, representatives):
+        counts = tags.setdefault(prediction["tag"], {"found": 0, "answered": 0})
+        counts["found"] += 1
+        counts["answered"] += representative in answered
+    return {
+        "stage": stage,
+        "done": sum(counts["answered"] for counts in tags.values()),
+        "total": len(retained),
+        "tags": tags,
+        "boxes": boxes,
+        "boxes_truncated": len(boxes) < len(retained),
+    }
+
+
+def labeling_payload(prepared_reference, reference_detail, analyze_prompt, use_cache):
+    """Payload of the label_legend activity labeling the patches of the legend."""
+    return json.dumps(
+        {
+            "reference_img": prepared_reference["reference"],
+            "reference_detail": reference_detail,
+            "analyze_prompt": analyze_prompt,
+            "use_cache": use_cache,
+        }
+    )
+
+
+def analysis_calls(items, analysis, batch_size, suffix=""):
+    """
+    (activity name, payload) of the Azure OpenAI calls analyzing the items, with
+    the settings shared by all the calls in analysis.
+    """
+    if batch_size > 1:
+        # Pack several crops in each Azure OpenAI call
+        return [
+            (
+                "azure_openai_batch_processing",
+                json.dumps({"items": items[start : start + batch_size], **analysis}),
+            )
+            for start in range(0, len(items), batch_size)
+        ]
+    # Call Azure OpenAI to analyze each cropped image
+    return [
+        (f"azure_openai_processing{suffix}", json.dumps({**item, **analysis}))
+        for item in items
+    ]
+
+
+def compact_results(result):
+    """
+    Compact result of each symbol analyzed by an Azure OpenAI activity, batched
+    results being flattened, and the metrics of the call.
+    """
+    symbols = metrics.result_of(result)
+    compact = [
+        {
+            "openai_response": symbol["openai_response"],
+            "cache_hit": symbol.get("cache_hit", False),
+        }
+        for symbol in (symbols if isinstance(symbols, list) else [symbols])
+    ]
+    return compact, metrics.call_metrics(result)
+
+
+def detection_results(retained, crops, answers, indices=None):
+    """
+    Output record of the retained detections, all of them or the given indices,
+    each with the (answer, source, score) in answers of the representative of
+    its group of near-identical crops.
+    """
+    if indices is None:
+        indices = range(len(retained))
+    results = []
+    for index in indices:
+        prediction = retained[index]
+        answer, source, score = answers[crops[index]["representative"]]
+        results.append(
+            {
+                "openai_response": answer,
+                "bounding_box": prediction["bounding_box"],
+                "custom_vision_tag": prediction["tag"],
+                "probability": prediction["probability"],
+                "match_source": source,
+                "match_score": score,
+            }
+        )
+    return results
+
+
+def plan_metrics(started, finished, stages, image_metrics, cache, dedup, match):
+    """
+    Metrics block of the output of a plan: its total time, the metrics of its
+    stages, the image size recorded by image_metrics and the token totals.
+    """
+    return {
+        "total_ms": round((finished - started).total_seconds() * 1000),
+        "stages": stages,
+        "image": {
+            "width": image_metrics.get("image_width"),
+            "height": image_metrics.get("image_height"),
+        },
+        "tokens": {
+            name: sum(stage.get(f"{name}_tokens", 0) for stage in stages)
+            for name in ("prompt", "completion")
+        },
+        "cache": cache,
+        "dedup": dedup,
+        "match": match,
+    }
+
+
+def plan_output(
+    retained,
+    crops,
+    answers,
+    results,
+    summary,
+    run_metrics,
+    detection_stats,
+    cache_stats,
+    dedup_stats,
+    reference_stats,
+    match_stats,
+    summary_stats,
+):
+    """Output of vision_agent_orchestrator for a plan analyzed in either mode."""
+    aggregated_detections = {}
+    for prediction in retained:
+        aggregated_detections.setdefault(prediction["tag"], []).append(prediction)
+    return {
+        "detections": results,
+        "summary": summary,
+        "aggregated_detections": aggregated_detections,
+        "metrics": run_metrics,
+        "detection_stats": detection_stats,
+        "cache_stats": cache_stats,
+        "dedup_stats": dedup_stats,
+        "reference_stats": reference_stats,
+        "match_stats": match_stats,
+        "summary_stats": summary_stats,
+        # Perceptual hashes of the symbols answered by this plan, reused by the
+        # next plans of a batch
+        "symbols": [
+            {
+                "tag": retained[index]["tag"],
+                "hash": crop["hash"],
+                "answer": answers[index][0],
+            }
+            for index, crop in enumerate(crops)
+            if crop["representative"] == index
+            and "known" not in crop
+            and "hash" in crop
+        ],
+    }
+
+
+def analyze_in_waves(
+    context,
+    calls,
+    max_in_flight,
+    retry_interval_ms,
+    retry_attempts,
+    offset=0,
+    on_progress=None,
+):
+    """
+    Run the Azure OpenAI activities in waves of at most max_in_flight, to be
+    used with yield from in an orchestrator. Returns the compact result of each
+    analyzed symbol, batched results being flattened, and the metrics of each
+    call. offset is the position of the first call in the whole plan, used to
+    spread the retries, and on_progress is called with the results so far after
+    every wave.
+    """
+    results = []
+    calls_metrics = []
+    for start in range(0, len(calls), max_in_flight):
+        wave = [
+            context.call_activity_with_retry(
+                name,
+                jittered_retry_options(
+                    offset + start + index, retry_interval_ms, retry_attempts
+                ),
+                activity_payload,
+            )
+            for index, (name, activity_payload) in enumerate(
+                calls[start : start + max_in_flight]
+            )
+        ]
+        wave_results = yield context.task_all(wave)
+        for result in wave_results:
+            compact, call = compact_results(result)
+            results.extend(compact)
+            calls_metrics.append(call)
+        if on_progress:
+            on_progress(results)
+    return results, calls_metrics
+
+
+def summarize(context, rows, stats, token_budget, suffix=""):
+    """
+    Summarize the table rows of the analyzed detections and their per-tag stats
+    with generate_summary, to be used with yield from in an orchestrator. When
+    the table exceeds token_budget, its parts are summarized in parallel and
+    their summaries combined, again in parts while they exceed it. Returns the
+    summary, the payloads and results of every call, and the summary stats:
+    table size, estimated and measured tokens, calls and levels.
+    """
+    name = f"generate_summary{suffix}"
+    summary_payload = json.dumps(
+        {"rows": rows, "stats": stats, "token_budget": token_budget}
+    )
+    result = yield context.call_activity(name, summary_payload)
+    payloads, results = [summary_payload], [result]
+    levels = 1
+    while "parts" in result:
+        parts = result["parts"]
+        part_payloads = [
+            json.dumps({"lines": lines, "part": position, "parts": len(parts)})
+            for position, lines in enumerate(parts, 1)
+        ]
+        part_results = yield context.task_all(
+            [
+                context.call_activity(name, part_payload)
+                for part_payload in part_payloads
+            ]
+        )
+        summary_payload = json.dumps(
+            {
+                "summaries": [part["summary"] for part in part_results],
+                "token_budget": token_budget,
+            }
+        )
+        result = yield context.call_activity(name, summary_payload)
+        payloads.extend([*part_payloads, summary_payload])
+        results.extend([*part_results, result])
+        levels += 1
+    calls = [metrics.call_metrics(call_result) for call_result in results]
+    summary_stats = {
+        "rows": len(rows),
+        "estimated_tokens": results[0]["estimated_tokens"],
+        "calls": len(payloads),
+        "levels": levels,
+        **{
+            f"{kind}_tokens": sum(call.get(f"{kind}_tokens", 0) for call in calls)
+            for kind in ("prompt", "completion")
+        },
+    }
+    return result["summary"], payloads, results, summary_stats
+
+
+# Options determining the result of a plan, part of the run key of the stored
+# results
+RESULT_OPTIONS = (
+    "prediction_threshold",
+    "crop_padding",
+    "crop_format",
+    "dedup_threshold",
+    "batch_size",
+    "batch_strategy",
+    "tile_size",
+    "tile_overlap",
+    "nms_iou_threshold",
+    "detection_backend",
+    "reference_detail",
+    "reference_max_tokens",
+    "local_match_threshold",
+    "local_match_margin",
+    "pipelined",
+    "summary_token_budget",
+)
+
+
+def plan_options(payload):
+    """Settings of a plan analysis, read from the input of vision_agent_orchestrator."""
+    return {
+        "container": payload.get("container"),
+        "filename": payload.get("filename"),
+        "analyze_prompt": payload.get("analyze_prompt"),
+        "reference_filename": payload.get("reference_filename"),
+        "prediction_threshold": payload.get("prediction_threshold", 0.5),
+        "crop_padding": payload.get("crop_padding", DEFAULT_CROP_PADDING),
+        "crop_format": payload.get("crop_format", DEFAULT_CROP_FORMAT),
+        # Exchange artifact references instead of base64 images between the
+        # activities
+        "artifact_mode": payload.get("artifact_mode", False),
+        # Reuse the cached answers of identical symbol analysis requests
+        "use_cache": payload.get("use_cache", True),
+        # Maximum number of differing perceptual hash bits for two crops of the
+        # same tag to be analyzed once, deduplication is disabled when not set
+        "dedup_threshold": payload.get("dedup_threshold"),
+        # Number of crops analyzed by a single chat completion, and how they are
+        # packed
+        "batch_size": payload.get("batch_size", 1),
+        "batch_strategy": payload.get("batch_strategy", "parts"),
+        # Detect objects on overlapping tiles of at most tile_size pixels
+        "tile_size": payload.get("tile_size"),
+        "tile_overlap": payload.get("tile_overlap", DEFAULT_TILE_OVERLAP),
+        "nms_iou_threshold": payload.get(
+            "nms_iou_threshold", DEFAULT_NMS_IOU_THRESHOLD
+        ),
+        "detection_backend": payload.get(
+            "detection_backend", DEFAULT_DETECTION_BACKEND
+        ),
+        # Use the asynchronous versions of the I/O bound activities
+        "suffix": "_async" if payload.get("async_activities", False) else "",
+        # Azure OpenAI activities are started in waves of at most max_in_flight,
+        # and retried with a jittered interval
+        "max_in_flight": payload.get("max_in_flight", DEFAULT_MAX_IN_FLIGHT),
+        "retry_interval_ms": payload.get(
+            "retry_interval_ms", DEFAULT_RETRY_INTERVAL_MS
+        ),
+        "retry_attempts": payload.get("retry_attempts", DEFAULT_RETRY_ATTEMPTS),
+        # Larger plans are analyzed by sub-orchestrations of chunk_size
+        # detections, which keeps the history of every orchestration bounded
+        "chunk_size": payload.get("chunk_size", DEFAULT_CHUNK_SIZE),
+        # Detail level of the legend sent to the model, and its optional token
+        # budget
+        "reference_detail": payload.get("reference_detail", "high"),
+        "reference_max_tokens": payload.get("reference_max_tokens"),
+        # Crops matching a legend patch with at least this correlation, and ahead
+        # of any other symbol by local_match_margin, are answered without the
+        # model
+        "local_match_threshold": payload.get("local_match_threshold"),
+        "local_match_margin": payload.get(
+            "local_match_margin", template_matching.DEFAULT_MATCH_MARGIN
+        ),
+        # Set by batch_orchestrator: the legend prepared once for all the plans,
+        # with its patches labeled for local matching, and the symbols already
+        # answered on other plans of the batch
+        "prepared_reference": payload.get("prepared_reference"),
+        "legend_patches": payload.get("legend_patches"),
+        "known_symbols": payload.get("known_symbols", []),
+        # Estimated prompt tokens of one summary call, larger summary tables
+        # being summarized in parts
+        "summary_token_budget": payload.get(
+            "summary_token_budget", summaries.DEFAULT_TOKEN_BUDGET
+        ),
+        # Answer the plan from a stored result of the same inputs, when a result
+        # store is configured and use_cache is set
+        "use_stored_result": payload.get("use_stored_result", False),
+        # Overlap the stages, see pipelined_analysis
+        "pipelined": payload.get("pipelined", False),
+    }
+
+
+def end_stage(context, stages, stage, started, payloads, results, concurrency=1):
+    """Append the metrics of a stage ending now to stages."""
+    stages.append(
+        metrics.stage_metrics(
+            stage,
+            started,
+            context.current_utc_datetime,
+            payloads,
+            [metrics.call_metrics(result) for result in results],
+            concurrency,
+        )
+    )
+
+
+def read_calls(options):
+    """
+    (activity name, payload) of the calls reading the plan and, unless it was
+    prepared for the whole batch, preparing the legend.
+    """
+    calls = [
+        (
+            f"read_image{options['suffix']}",
+            json.dumps(
+                {
+                    "container": options["container"],
+                    "filename": options["filename"],
+                    "as_artifact": options["artifact_mode"],
+                }
+            ),
+        )
+    ]
+    if options["prepared_reference"] is None:
+        calls.append(
+            (
+                "prepare_reference",
+                json.dumps(
+                    {
+                        "container": options["container"],
+                        "filename": options["reference_filename"],
+                        "detail": options["reference_detail"],
+                        "max_tokens": options["reference_max_tokens"],
+                        "as_artifact": options["artifact_mode"],
+                        "use_cache": options["use_cache"],
+                    }
+                ),
+            )
+        )
+    return calls
+
+
+def read_inputs(context, options, stages):
+    """
+    Read the plan and prepare the legend, to be used with yield from. Returns
+    the result of read_image and the prepared legend.
+    """
+    calls = read_calls(options)
+    started = context.current_utc_datetime
+    read_results = yield context.task_all(
+        [context.call_activity(name, read_payload) for name, read_payload in calls]
+    )
+    end_stage(
+        context,
+        stages,
+        "reading",
+        started,
+        [read_payload for _, read_payload in calls],
+        read_results,
+        len(calls),
+    )
+    prepared_reference = (
+        read_results[1]
+        if options["prepared_reference"] is None
+        else options["prepared_reference"]
+    )
+    return read_results[0], prepared_reference
+
+
+def plan_location(options):
+    """
+    Container and filename of the plan, of which the tiles and crops of the plans
+    above MAX_IMAGE_PIXELS are cut out.
+    """
+    return {"container": options["container"], "filename": options["filename"]}
+
+
+def tiles_payload(options, image_data):
+    """Payload of the create_tiles activity splitting the plan into tiles."""
+    return json.dumps(
+        {
+            "image_data": image_data,
+            "tile_size": options["tile_size"],
+            "tile_overlap": options["tile_overlap"],
+            "as_artifact": options["artifact_mode"],
+            "plan": plan_location(options),
+        }
+    )
+
+
+def plan_detection_payload(options, image_data):
+    """
+    Payload of the object_detection activity detecting the whole plan, which the
+    ONNX backend splits into tiles itself.
+    """
+    detection = {"image_data": image_data}
+    if options["detection_backend"] == "onnx":
+        detection.update(
+            backend=options["detection_backend"],
+            tile_size=options["tile_size"],
+            tile_overlap=options["tile_overlap"],
+        )
+    return json.dumps(detection)
+
+
+def aggregation_payload(options, predictions, core=None):
+    """
+    Payload of the aggregate_detections_activity filtering and deduplicating the
+    predictions, only those centered in the core of a tile when it is set.
+    """
+    aggregation = {
+        "detections": predictions,
+        "min_probability": options["prediction_threshold"],
+        "iou_threshold": options["nms_iou_threshold"],
+    }
+    if core is not None:
+        aggregation["core"] = core
+    return json.dumps(aggregation)
+
+
+def crop_payload(options, image_data, predictions, region=None, as_artifact=False):
+    """
+    Payload of the crop_detections activity cropping the predictions out of the
+    plan, or out of the tile covering region when it is set. The crops are
+    stored as artifacts in artifact mode or when as_artifact is set.
+    """
+    cropping = {
+        "image_data": image_data,
+        "plan": plan_location(options),
+        "detections": predictions,
+        "padding": options["crop_padding"],
+        "format": options["crop_format"],
+        "as_artifact": options["artifact_mode"] or as_artifact,
+        "dedup_threshold": options["dedup_threshold"],
+        "known_symbols": options["known_symbols"],
+    }
+    if region is not None:
+        cropping["region"] = region
+    return json.dumps(cropping)
+
+
+def analysis_settings(options, prepared_reference):
+    """Settings shared by all the Azure OpenAI calls analyzing the crops."""
+    return {
+        # Data URL of the prepared reference, or its artifact reference resolved
+        # lazily by azure_openai_processing
+        "reference_img": prepared_reference["reference"],
+        "reference_detail": options["reference_detail"],
+        "analyze_prompt": options["analyze_prompt"],
+        "strategy": options["batch_strategy"],
+    }
+
+
+def analysis_items(retained, crops, indices, use_cache):
+    """Items analyzed by the Azure OpenAI activities, one per given index."""
+    return [
+        {
+            "bounding_box": retained[index]["bounding_box"],
+            "tag": retained[index]["tag"],
+            "probability": retained[index]["probability"],
+            "image": crops[index]["image"],
+            "use_cache": use_cache,
+        }
+        for index in indices
+    ]
+
+
+def local_match_payload(options, items, analysis, patches):
+    """Payload of the local_match activity matching the items against the legend."""
+    return json.dumps(
+        {
+            "items": [{"image": item["image"]} for item in items],
+            "reference_img": analysis["reference_img"],
+            "patches": patches,
+            "threshold": options["local_match_threshold"],
+            "margin": options["local_match_margin"],
+        }
+    )
+
+
+def analysis_chunk_size(options):
+    """
+    Items of an analysis_chunk_orchestrator sub-orchestration, a multiple of the
+    batch size, or None when the plans are not split in chunks.
+    """
+    if not options["chunk_size"]:
+        return None
+    batch_size = options["batch_size"]
+    return max(1, options["chunk_size"] // batch_size) * batch_size
+
+
+def analysis_chunk(options, items, analysis, offset):
+    """
+    Input of the analysis_chunk_orchestrator analyzing the items. It only holds
+    their images, artifact references of the crops, so that the history of the
+    parent orchestration does not grow with the crops.
+    """
+    return {
+        "images": [item["image"] for item in items],
+        "use_cache": options["use_cache"],
+        "analysis": analysis,
+        "batch_size": options["batch_size"],
+        "suffix": options["suffix"],
+        "offset": offset,
+        "max_in_flight": options["max_in_flight"],
+        "retry_interval_ms": options["retry_interval_ms"],
+        "retry_attempts": options["retry_attempts"],
+    }
+
+
+def analysis_stats(analysis_results, crops, analyzed, prepared_reference, calls):
+    """
+    Cache, deduplication and reference stats of a plan, from the compact results
+    of its analyzed symbols and its number of Azure OpenAI calls.
+    """
+    cache_hits = sum(1 for result in analysis_results if result["cache_hit"])
+    cache_stats = {"hits": cache_hits, "misses": len(analysis_results) - cache_hits}
+    dedup_stats = {"detections": len(crops), "analyzed": len(analyzed)}
+    reference_stats = prepared_reference["stats"]
+    reference_stats["estimated_tokens_saved"] = calls * (
+        reference_stats["original_tokens"] - reference_stats["prepared_tokens"]
+    )
+    return cache_stats, dedup_stats, reference_stats
+
+
+def pipelined_analysis(context, options, stages, orchestration_started, plan=None):
+    """
+    Pipelined analysis of a plan, to be used with yield from by
+    vision_agent_orchestrator instead of its stages. The legend is prepared while
+    the plan is read and detected. Each tile is aggregated, cropped, matched and
+    analyzed as soon as it has been detected, the detections of the overlaps
+    belonging to the tile whose core holds their center instead of being merged
+    over the whole plan. Past the first chunk_size symbols, the symbols are
+    analyzed by analysis_chunk_orchestrator sub-orchestrations of chunk_size, as
+    in the other mode. The summary table rows of each tag are built as soon as
+    all its symbols are answered, so the summary starts with the last answer.
+    plan is the result of read_image when the plan was already read, the legend
+    being prepared then. Returns the output of the plan, with the result of
+    read_image and the prepared legend.
+    """
+    max_in_flight = options["max_in_flight"]
+    local_match_threshold = options["local_match_threshold"]
+    batch_size = options["batch_size"]
+    use_cache = options["use_cache"]
+    suffix = options["suffix"]
+    running = []
+    stage_log = {}
+
+    def log(stage, payloads):
+        stage_log.setdefault(
+            stage,
+            {"started": context.current_utc_datetime, "payloads": [], "calls": []},
+        )["payloads"].extend(payloads)
+
+    def start(stage, name, activity_payload, data=None, retry_options=None):
+        log(stage, [activity_payload])
+        if retry_options is None:
+            task = context.call_activity(name, activity_payload)
+        else:
+            task = context.call_activity_with_retry(
+                name, retry_options, activity_payload
+            )
+        running.append((task, stage, data))
+
+    if plan is None:
+        # The legend is prepared while the plan is read and detected
+        reading, *reference_call = read_calls(options)
+        if reference_call:
+            start("reference", *reference_call[0])
+        started = context.current_utc_datetime
+        plan = yield context.call_activity(*reading)
+        end_stage(context, stages, "reading", started, [reading[1]], [plan])
+    b64_image = plan["image"]
+
+    # Retry options of the activities, jittered by the index of their task
+    def retries(index=0):
+        return jittered_retry_options(
+            index, options["retry_interval_ms"], options["retry_attempts"]
+        )
+
+    # Units of detection: the tiles fanned out, or the whole plan
+    image_metrics = {}
+    if options["tile_size"] and options["detection_backend"] != "onnx":
+        started = context.current_utc_datetime
+        tiling_payload = tiles_payload(options, b64_image)
+        tiling = yield context.call_activity("create_tiles", tiling_payload)
+        end_stage(context, stages, "tiling", started, [tiling_payload], [tiling])
+        image_metrics = metrics.call_metrics(tiling)
+        units = [
+            {
+                "detection": json.dumps(
+                    {"image_data": tile["image"], "region": tile["region"]}
+                ),
+                "image": tile["image"],
+                "region": tile["region"],
+                "core": tile["core"],
+            }
+            for tile in metrics.result_of(tiling)
+        ]
+    else:
+        units = [
+            {
+                "detection": plan_detection_payload(options, b64_image),
+                "image": b64_image,
+                "region": None,
+                "core": None,
+            }
+        ]
+    for position, unit in enumerate(units):
+        start(
+            "detecting",
+            "object_detection",
+            unit["detection"],
+            position,
+            retries(position),
+        )
+
+    retained = []
+    crops = []
+    answers = {}
+    scores = {}
+    # Representatives of each tag still waiting for their answer
+    unanswered = {}
+    # Hashes, tags and indices of the representatives of the tiles cropped so
+    # far, the crops of the next tiles close to one of them join its group
+    leader_hashes = []
+    leader_tags = []
+    leader_indices = []
+    tile_stats = []
+    detection_stats = None
+    analysis = None
+    prepared_reference = options["prepared_reference"]
+    patches = options["legend_patches"]
+    # Representatives cropped before the legend was prepared and labeled
+    waiting = []
+    # Azure OpenAI calls and chunks waiting for max_in_flight slots, a chunk
+    # taking as many slots as its calls, up to all of them
+    queued = []
+    in_flight = 0
+    call_count = 0
+    # Symbols still analyzed by the orchestration itself, the next ones are
+    # buffered into chunks
+    chunk_size = analysis_chunk_size(options)
+    inline_left = chunk_size
+    chunk_buffer = []
+    # Predictions sent to cropping, past chunk_size they are cropped as artifacts
+    # as they may be analyzed in chunks
+    cropping_count = 0
+    chunk_count = 0
+    analysis_results = []
+    match_stats = {"known": 0, "local": 0, "model": 0}
+    partials = {}
+    detecting = len(units)
+    # Units not yet through detection, aggregation, cropping and matching, no
+    # tag is complete before they all are
+    units_left = len(units)
+
+    def use_reference(reference):
+        nonlocal prepared_reference, analysis
+        prepared_reference = reference
+        analysis = analysis_settings(options, reference)
+        if local_match_threshold is not None and patches is None:
+            # The patches of the legend are labeled by the model once
+            start(
+                "labeling",
+                "label_legend",
+                labeling_payload(
+                    reference,
+                    options["reference_detail"],
+                    options["analyze_prompt"],
+                    use_cache,
+                ),
+                None,
+                retries(),
+            )
+
+    def ready():
+        # Whether the crops can be matched and analyzed
+        return analysis is not None and (
+            local_match_threshold is None or patches is not None
+        )
+
+    def flush_waiting():
+        nonlocal waiting
+        if ready():
+            for indices in waiting:
+                dispatch(indices)
+            waiting = []
+
+    def queue_chunk(count):
+        nonlocal chunk_buffer, call_count
+        indices, chunk_buffer = chunk_buffer[:count], chunk_buffer[count:]
+        items = analysis_items(retained, crops, indices, use_cache)
+        calls = analysis_calls(items, analysis, batch_size, suffix)
+        queued.append(
+            {
+                "chunk": analysis_chunk(options, items, analysis, call_count),
+                "payloads": [analysis_payload for _, analysis_payload in calls],
+                "indices": indices,
+                "weight": min(len(calls), max_in_flight),
+            }
+        )
+        call_count += len(calls)
+
+    def queue_analysis(indices):
+        nonlocal call_count, inline_left
+        inline, chunked = [], []
+        for index in indices:
+            # Crops inline in the history were cut out of the first chunk_size
+            # predictions, they are analyzed by the orchestration itself
+            if inline_left is None or not artifacts.is_artifact_ref(
+                crops[index]["image"]
+            ):
+                inline.append(index)
+            else:
+                chunked.append(index)
+        if inline_left is not None:
+            inline_left -= len(inline)
+            taken = max(0, min(inline_left, len(chunked)))
+            inline += chunked[:taken]
+            chunked = chunked[taken:]
+            inline_left -= taken
+        items = analysis_items(retained, crops, inline, use_cache)
+        step = max(1, batch_size)
+        for position, call in enumerate(
+            analysis_calls(items, analysis, batch_size, suffix)
+        ):
+            queued.append(
+                {
+                    "call": call,
+                    "offset": call_count,
+                    "indices": inline[position * step : (position + 1) * step],
+                    "weight": 1,
+                }
+            )
+            call_count += 1
+        chunk_buffer.extend(chunked)
+        while chunk_size and len(chunk_buffer) >= chunk_size:
+            queue_chunk(chunk_size)
+
+    def dispatch(indices):
+        nonlocal units_left
+        if local_match_threshold is None:
+            queue_analysis(indices)
+            units_left -= 1
+            return
+        items = [{"image": crops[index]["image"]} for index in indices]
+        start(
+            "matching",
+            "local_match",
+            local_match_payload(options, items, analysis, patches),
+            indices,
+            retries(indices[0]),
+        )
+
+    def publish_progress(stage, answered):
+        # Only the last custom status of an episode is kept, so the status is not
+        # computed again while the past events are replayed
+        if not context.is_replaying:
+            context.set_custom_status(
+                progress_status(
+                    stage,
+                    retained,
+                    [crop["representative"] for crop in crops],
+                    answered,
+                    compact_boxes(retained),
+                )
+            )
+
+    if prepared_reference is not None:
+        use_reference(prepared_reference)
+
+    while True:
+        if units_left == 0 and chunk_buffer:
+            # The last chunk is not full
+            queue_chunk(len(chunk_buffer))
+        while queued and (
+            in_flight == 0 or in_flight + queued[0]["weight"] <= max_in_flight
+        ):
+            entry = queued.pop(0)
+            if "chunk" in entry:
+                log("analyzing", entry["payloads"])
+                running.append(
+                    (
+                        context.call_sub_orchestrator(
+                            "analysis_chunk_orchestrator",
+                            entry["chunk"],
+                            f"{context.instance_id}:chunk:{chunk_count}",
+                        ),
+                        "analyzing",
+                        entry,
+                    )
+                )
+                chunk_count += 1
+            else:
+                start(
+                    "analyzing",
+                    *entry["call"],
+                    entry,
+                    jittered_retry_options(
+                        entry["offset"],
+                        options["retry_interval_ms"],
+                        options["retry_attempts"],
+                    ),
+                )
+            in_flight += entry["weight"]
+        if units_left == 0:
+            if detection_stats is None:
+                detection_stats = detection_utils.merge_tag_stats(tile_stats)
+            # Table rows of every tag whose symbols are all answered
+            for tag, count in unanswered.items():
+                if count == 0 and tag not in partials:
+                    partials[tag] = summaries.table_rows(
+                        detection_results(
+                            retained,
+                            crops,
+                            answers,
+                            [
+                                index
+                                for index, prediction in enumerate(retained)
+                                if prediction["tag"] == tag
+                            ],
+                        )
+                    )
+        if not running:
+            break
+
+        publish_progress("detecting" if detecting else "analyzing", answers)
+        finished = yield context.task_any([task for task, _, _ in running])
+        _, stage, data = next(entry for entry in running if entry[0] is finished)
+        running = [entry for entry in running if entry[0] is not finished]
+        result = finished.result
+        if isinstance(result, Exception):
+            raise result
+        record = stage_log[stage]
+        record["finished"] = context.current_utc_datetime
+        if stage == "analyzing" and "chunk" in data:
+            record["calls"].extend(result["metrics"])
+        else:
+            record["calls"].append(metrics.call_metrics(result))
+
+        if stage == "reference":
+            use_reference(result)
+            flush_waiting()
+        elif stage == "labeling":
+            patches = result
+            flush_waiting()
+        elif stage == "detecting":
+            detecting -= 1
+            start(
+                "aggregating",
+                "aggregate_detections_activity",
+                aggregation_payload(
+                    options, metrics.result_of(result), units[data]["core"]
+                ),
+                data,
+            )
+        elif stage == "aggregating":
+            tile_stats.append(result["stats"])
+            predictions = detection_utils.DetectionTable.from_dict(
+                result["table"]
+            ).to_predictions()
+            if not predictions:
+                units_left -= 1
+                continue
+            cropping_count += len(predictions)
+            start(
+                "cropping",
+                "crop_detections",
+                crop_payload(
+                    options,
+                    units[data]["image"],
+                    predictions,
+                    units[data]["region"],
+                    as_artifact=bool(chunk_size) and cropping_count > chunk_size,
+                ),
+                predictions,
+            )
+        elif stage == "cropping":
+            if not image_metrics:
+                image_metrics = metrics.call_metrics(result)
+            offset = len(retained)
+            retained.extend(data)
+            tile_crops = metrics.result_of(result)
+            for crop in tile_crops:
+                crop["representative"] += offset
+            if options["dedup_threshold"] is not None:
+                # Crops are grouped within a tile by crop_detections, and across
+                # tiles here
+                representatives = [
+                    index
+                    for index, crop in enumerate(tile_crops, offset)
+                    if crop["representative"] == index
+                ]
+                hashes = [
+                    int(tile_crops[index - offset]["hash"], 16)
+                    for index in representatives
+                ]
+                tags = [data[index - offset]["tag"] for index in representatives]
+                matches = dedup.match_known(
+                    hashes,
+                    tags,
+                    leader_hashes,
+                    leader_tags,
+                    options["dedup_threshold"],
+                )
+                leaders = {}
+                for index, image_hash, tag, match in zip(
+                    representatives, hashes, tags, matches
+                ):
+                    if match is None:
+                        leader_hashes.append(image_hash)
+                        leader_tags.append(tag)
+                        leader_indices.append(index)
+                    else:
+                        leaders[index] = leader_indices[match]
+                for crop in tile_crops:
+                    crop["representative"] = leaders.get(
+                        crop["representative"], crop["representative"]
+                    )
+            pending = []
+            for index, (prediction, crop) in enumerate(zip(data, tile_crops), offset):
+                crops.append(crop)
+                unanswered.setdefault(prediction["tag"], 0)
+                if crop["representative"] != index:
+                    continue
+                if "known" in crop:
+                    answers[index] = (crop["known"], "known", None)
+                    match_stats["known"] += 1
+                else:
+                    unanswered[prediction["tag"]] += 1
+                    pending.append(index)
+            if not pending:
+                units_left -= 1
+            elif not ready():
+                waiting.append(pending)
+            else:
+                dispatch(pending)
+        elif stage == "matching":
+            remaining = []
+            for index, match in zip(data, metrics.result_of(result)):
+                scores[index] = match["score"]
+                if match["answer"] is None:
+                    remaining.append(index)
+                    continue
+                answers[index] = (match["answer"], "local", match["score"])
+                unanswered[retained[index]["tag"]] -= 1
+                match_stats["local"] += 1
+            if remaining:
+                queue_analysis(remaining)
+            units_left -= 1
+        elif stage == "analyzing":
+            in_flight -= data["weight"]
+            symbols = (
+                result["results"] if "chunk" in data else compact_results(result)[0]
+            )
+            for index, compact in zip(data["indices"], symbols):
+                answers[index] = (
+                    compact["openai_response"],
+                    "model",
+                    scores.get(index),
+                )
+                analysis_results.append(compact)
+                unanswered[retained[index]["tag"]] -= 1
+                match_stats["model"] += 1
+
+    # Summarize the plan from the table rows of its tags
+    analyzed = [
+        index for index, crop in enumerate(crops) if crop["representative"] == index
+    ]
+    publish_progress("summarizing", analyzed)
+    started = context.current_utc_datetime
+    summary, summary_payloads, summary_results, summary_stats = yield from summarize(
+        context,
+        [row for tag in sorted(partials) for row in partials[tag]],
+        detection_stats,
+        options["summary_token_budget"],
+        suffix,
+    )
+    stage_log["summarizing"] = {
+        "started": started,
+        "finished": context.current_utc_datetime,
+        "payloads": summary_payloads,
+        "calls": [metrics.call_metrics(result) for result in summary_results],
+    }
+
+    for stage, record in stage_log.items():
+        stages.append(
+            metrics.stage_metrics(
+                stage,
+                record["started"],
+                record["finished"],
+                record["payloads"],
+                record["calls"],
+                max_in_flight if stage == "analyzing" else len(record["payloads"]),
+            )
+        )
+    cache_stats, dedup_stats, reference_stats = analysis_stats(
+        analysis_results, crops, analyzed, prepared_reference, call_count
+    )
+    run_metrics = plan_metrics(
+        orchestration_started,
+        context.current_utc_datetime,
+        stages,
+        image_metrics,
+        cache_stats,
+        dedup_stats,
+        match_stats,
+    )
+    logging.info(
+        f"Pipelined {len(units)} units in {chunk_count} chunks: {match_stats}, "
+        f"{cache_stats}, {dedup_stats}"
+    )
+    logging.info(f"Summary: {summary_stats}")
+    logging.info(f"Metrics: {run_metrics}")
+    publish_progress("completed", analyzed)
+    output = plan_output(
+        retained,
+        crops,
+        answers,
+        detection_results(retained, crops, answers),
+        summary,
+        run_metrics,
+        detection_stats,
+        cache_stats,
+        dedup_stats,
+        reference_stats,
+        match_stats,
+        summary_stats,
+    )
+    return output, plan, prepared_reference
+
+
 myApp = df.DFApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 
 
@@ -52,172 +1255,699 @@ def vision_agent_orchestrator(context):
 
     payload = context.get_input()
     logging.info(f"Payload: {payload}")
-    container = payload.get("container")
-    filename = payload.get("filename")
-    analyze_prompt = payload.get("analyze_prompt")
-    reference_filename = payload.get("reference_filename")
-    prediction_threshold = payload.get("prediction_threshold", 0.5)
+    options = plan_options(payload)
+    container = options["container"]
+    filename = options["filename"]
+    reference_filename = options["reference_filename"]
+    analyze_prompt = options["analyze_prompt"]
+    detection_backend = options["detection_backend"]
+    tile_size = options["tile_size"]
+    batch_size = options["batch_size"]
+    max_in_flight = options["max_in_flight"]
+    local_match_threshold = options["local_match_threshold"]
+    legend_patches = options["legend_patches"]
+    suffix = options["suffix"]
+    result_options = {name: options[name] for name in RESULT_OPTIONS}
+    # The answers reused from other plans of a batch are part of the result
+    result_options["known_symbols"] = result_store.symbols_digest(
+        options["known_symbols"]
+    )
+
+    context.set_custom_status(progress_status("reading"))
+    # Wall time, payload sizes and activity records of every stage
+    orchestration_started = context.current_utc_datetime
+    stages = []
+
+    def run_payload(plan, prepared_reference):
+        # Identity of the run in the result store, from the content hashes
+        # computed when the images were read
+        return {
+            "image_hash": plan["content_hash"],
+            "reference_hash": prepared_reference.get("content_hash"),
+            "analyze_prompt": analyze_prompt,
+            "options": result_options,
+        }
 
-    ## Read the candidate image and reference image from blob storage
-    read_tasks = [
-        context.call_activity(
-            "read_image", json.dumps({"container": container, "filename": filename})
+    read = None
+    if options["use_stored_result"] and options["use_cache"]:
+        # Answer the run from the stored result of a previous run with the same
+        # inputs, the images being read first for their content hashes
+        read = yield from read_inputs(context, options, stages)
+        stored = yield context.call_activity(
+            "lookup_result", json.dumps(run_payload(*read))
         )
-        for filename in [filename, reference_filename]
-    ]
+        if stored.get("output") is not None:
+            logging.info(f"Using stored result {stored['output']['stored_record']}")
+            context.set_custom_status(progress_status("completed"))
+            return stored["output"]
+
+    def store(output, plan, prepared_reference):
+        # Write the record of the completed run to the result store, if any
+        yield context.call_activity(
+            "store_result",
+            json.dumps(
+                {
+                    **run_payload(plan, prepared_reference),
+                    "record_id": context.instance_id,
+                    "created": orchestration_started.isoformat(),
+                    "container": container,
+                    "filename": filename,
+                    "reference_filename": reference_filename,
+                    "output": result_store.compact_output(output),
+                }
+            ),
+        )
+        return output
+
+    if options["pipelined"]:
+        plan = None
+        if read is not None:
+            plan, prepared_reference = read
+            options = {**options, "prepared_reference": prepared_reference}
+        output, plan, prepared_reference = yield from pipelined_analysis(
+            context, options, stages, orchestration_started, plan
+        )
+        return (yield from store(output, plan, prepared_reference))
 
-    read_results = yield context.task_all(read_tasks)
-    b64_image = read_results[0]
-    b64_reference_image = read_results[1]
+    ## Read the candidate image and prepare the reference image once
+    if read is None:
+        read = yield from read_inputs(context, options, stages)
+    plan, prepared_reference = read
+    b64_image = plan["image"]
 
+    context.set_custom_status(progress_status("detecting"))
     ## Perform object detection on the candidate image
-    retry_options = df.RetryOptions(200, 3)
-    predictions = yield context.call_activity(
-        "object_detection", json.dumps({"image_data": b64_image})
+    retry_options = jittered_retry_options(
+        0, options["retry_interval_ms"], options["retry_attempts"]
     )
-    detections = [Prediction.model_validate_json(pred) for pred in predictions]
+    if tile_size and detection_backend != "onnx":
+        started = context.current_utc_datetime
+        tiling_payload = tiles_payload(options, b64_image)
+        tiling = yield context.call_activity("create_tiles", tiling_payload)
+        end_stage(context, stages, "tiling", started, [tiling_payload], [tiling])
+        tiles = metrics.result_of(tiling)
+        # Fan out the detection of the tiles, their duplicates are removed when
+        # the detections are aggregated
+        started = context.current_utc_datetime
+        detection_payloads = [
+            json.dumps({"image_data": tile["image"], "region": tile["region"]})
+            for tile in tiles
+        ]
+        tile_predictions = yield context.task_all(
+            [
+                context.call_activity_with_retry(
+                    "object_detection",
+                    jittered_retry_options(
+                        index, options["retry_interval_ms"], options["retry_attempts"]
+                    ),
+                    detection_payload,
+                )
+                for index, detection_payload in enumerate(detection_payloads)
+            ]
+        )
+        end_stage(
+            context,
+            stages,
+            "detecting",
+            started,
+            detection_payloads,
+            tile_predictions,
+            len(detection_payloads),
+        )
+        predictions = [p for tile in tile_predictions for p in metrics.result_of(tile)]
+        logging.info(f"Detected {len(predictions)} objects on {len(tiles)} tiles")
+    else:
+        # The whole plan in a single call, the local model detecting all its tiles
+        # in batches
+        started = context.current_utc_datetime
+        detection_payload = plan_detection_payload(options, b64_image)
+        detection = yield context.call_activity_with_retry(
+            "object_detection", retry_options, detection_payload
+        )
+        end_stage(
+            context, stages, "detecting", started, [detection_payload], [detection]
+        )
+        predictions = metrics.result_of(detection)
 
-    # Aggregate and filter detections
-    aggregated_detections = yield context.call_activity(
-        "aggregate_detections_activity",
-        json.dumps(
-            {"detections": predictions, "min_probability": prediction_threshold}
-        ),
+    # Filter, deduplicate and aggregate detections
+    started = context.current_utc_datetime
+    aggregating_payload = aggregation_payload(options, predictions)
+    aggregation = yield context.call_activity(
+        "aggregate_detections_activity", aggregating_payload
+    )
+    end_stage(
+        context, stages, "aggregating", started, [aggregating_payload], [aggregation]
     )
+    table = detection_utils.DetectionTable.from_dict(aggregation["table"])
+    detection_stats = aggregation["stats"]
     logging.info(
-        f"Detected {len(detections)} objects across {len(aggregated_detections)} unique tags"
+        f"Detected {len(predictions)} objects, {len(table)} retained across {len(detection_stats)} unique tags"
     )
     # Log summary of the detected objects
-    for tag, tag_detections in aggregated_detections.items():
-        count = len(tag_detections)
+    for tag, tag_stats in detection_stats.items():
+        count = tag_stats["count"]
         logging.info(f"Found {count} {tag}{'s' if count > 1 else ''}")
 
+    ### Crop every retained detection in a single activity call
+    retained = table.to_predictions()
+    # Boxes are published as soon as they are known, answers follow by stage
+    boxes = compact_boxes(retained)
+    context.set_custom_status(progress_status("cropping", retained, boxes=boxes))
+    started = context.current_utc_datetime
+    # Crops analyzed in chunks are passed to the sub-orchestrations as artifacts
+    cropping_payload = crop_payload(
+        options,
+        b64_image,
+        retained,
+        as_artifact=bool(options["chunk_size"])
+        and len(retained) > options["chunk_size"],
+    )
+    cropping = yield context.call_activity("crop_detections", cropping_payload)
+    end_stage(context, stages, "cropping", started, [cropping_payload], [cropping])
+    crops = metrics.result_of(cropping)
+
     ### Make a call to Azure OpenAI to analyze the detected objects
-    binary_image_data = base64.b64decode(b64_image)
-    image = Image.open(BytesIO(binary_image_data))
-
-    tasks = []
-    for prediction in detections:
-        # Crop the image based on the bounding box
-        if prediction.probability > prediction_threshold:
-            buffered = BytesIO()
-
-            buffer = 10  # Buffer around the bounding box
-            left = max(0, int(prediction.bounding_box.left * image.width) - buffer)
-            top = max(0, int(prediction.bounding_box.top * image.height) - buffer)
-            right = min(
-                image.width,
-                int(
-                    (prediction.bounding_box.left + prediction.bounding_box.width)
-                    * image.width
-                )
-                + buffer,
+    analysis = analysis_settings(options, prepared_reference)
+    # Only the representative of each group of near-identical crops is analyzed
+    analyzed = [
+        index for index, crop in enumerate(crops) if crop["representative"] == index
+    ]
+    # Symbols already answered on another plan of a batch are not analyzed again
+    known = [index for index in analyzed if "known" in crops[index]]
+    pending = [index for index in analyzed if "known" not in crops[index]]
+    items = analysis_items(retained, crops, pending, options["use_cache"])
+    representatives = [crop["representative"] for crop in crops]
+
+    def publish(stage, answered):
+        context.set_custom_status(
+            progress_status(stage, retained, representatives, answered, boxes)
+        )
+
+    # Answer the confident local matches, the other crops go to the model
+    local_matches = [{"answer": None, "score": None} for _ in pending]
+    if local_match_threshold is not None and items:
+        publish("matching", [])
+        if legend_patches is None:
+            # The patches of the legend are labeled by the model once
+            started = context.current_utc_datetime
+            label_payload = labeling_payload(
+                prepared_reference,
+                options["reference_detail"],
+                analyze_prompt,
+                options["use_cache"],
             )
-            bottom = min(
-                image.height,
-                int(
-                    (prediction.bounding_box.top + prediction.bounding_box.height)
-                    * image.height
-                )
-                + buffer,
+            legend_patches = yield context.call_activity_with_retry(
+                "label_legend", retry_options, label_payload
+            )
+            end_stage(
+                context, stages, "labeling", started, [label_payload], [legend_patches]
             )
+        started = context.current_utc_datetime
+        match_payload = local_match_payload(options, items, analysis, legend_patches)
+        matching = yield context.call_activity_with_retry(
+            "local_match", retry_options, match_payload
+        )
+        end_stage(context, stages, "matching", started, [match_payload], [matching])
+        local_matches = metrics.result_of(matching)
+    model_analyzed = [
+        index for index, match in zip(pending, local_matches) if match["answer"] is None
+    ]
+    items = [
+        item for item, match in zip(items, local_matches) if match["answer"] is None
+    ]
+    locally_answered = known + [
+        index
+        for index, match in zip(pending, local_matches)
+        if match["answer"] is not None
+    ]
 
-            cropped_image = image.crop((left, top, right, bottom))
-            cropped_image.convert("RGB").save(buffered, format="JPEG")
+    def publish_analysis(results_so_far):
+        publish("analyzing", locally_answered + model_analyzed[: len(results_so_far)])
 
-            # Convert the cropped image to base64
-            img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
-            base64_url = f"data:image/jpeg;base64,{img_str}"
-            b64_reference_image_url = f"data:image/jpeg;base64,{b64_reference_image}"
-            detection_payload = json.dumps(
-                {
-                    "bounding_box": {
-                        "left": prediction.bounding_box.left,
-                        "top": prediction.bounding_box.top,
-                        "width": prediction.bounding_box.width,
-                        "height": prediction.bounding_box.height,
-                    },
-                    "tag": prediction.tag,
-                    "probability": prediction.probability,
-                    "image": base64_url,
-                    "reference_img": b64_reference_image_url,
-                    "analyze_prompt": analyze_prompt,
-                }
+    publish_analysis([])
+    call_count = math.ceil(len(items) / batch_size) if batch_size > 1 else len(items)
+    calls = analysis_calls(items, analysis, batch_size, suffix)
+    started = context.current_utc_datetime
+    # Run the Azure OpenAI processing tasks in waves and collect results
+    if options["chunk_size"] and len(items) > options["chunk_size"]:
+        # One sub-orchestration per chunk, so that the parent history only
+        # records the compact result of each chunk
+        chunk_size = analysis_chunk_size(options)
+        chunks = [
+            analysis_chunk(
+                options,
+                items[start : start + chunk_size],
+                analysis,
+                start // max(1, batch_size),
             )
-            # Call Azure OpenAI to analyze the cropped image
-            tasks.append(
-                context.call_activity("azure_openai_processing", detection_payload)
+            for start in range(0, len(items), chunk_size)
+        ]
+        # Keep about max_in_flight activities running over all the chunks
+        calls_per_chunk = math.ceil(chunk_size / batch_size)
+        chunks_in_flight = max(1, max_in_flight // calls_per_chunk)
+        analysis_results = []
+        calls_metrics = []
+        for start in range(0, len(chunks), chunks_in_flight):
+            chunk_results = yield context.task_all(
+                [
+                    context.call_sub_orchestrator(
+                        "analysis_chunk_orchestrator",
+                        chunk,
+                        f"{context.instance_id}:chunk:{start + index}",
+                    )
+                    for index, chunk in enumerate(
+                        chunks[start : start + chunks_in_flight]
+                    )
+                ]
             )
-    # Wait for all Azure OpenAI processing tasks to complete and collect results
-    results = yield context.task_all(tasks)
+            for chunk_result in chunk_results:
+                analysis_results.extend(chunk_result["results"])
+                calls_metrics.extend(chunk_result["metrics"])
+            publish_analysis(analysis_results)
+        logging.info(f"Analyzed {len(items)} symbols in {len(chunks)} chunks")
+    else:
+        analysis_results, calls_metrics = yield from analyze_in_waves(
+            context,
+            calls,
+            max_in_flight,
+            options["retry_interval_ms"],
+            options["retry_attempts"],
+            on_progress=publish_analysis,
+        )
+    stages.append(
+        metrics.stage_metrics(
+            "analyzing",
+            started,
+            context.current_utc_datetime,
+            [analysis_payload for _, analysis_payload in calls],
+            calls_metrics,
+            max_in_flight,
+        )
+    )
+    cache_stats, dedup_stats, reference_stats = analysis_stats(
+        analysis_results, crops, analyzed, prepared_reference, call_count
+    )
+    logging.info(f"Result cache: {cache_stats}")
+    logging.info(f"Deduplication: {dedup_stats}")
+    logging.info(f"Reference: {reference_stats}")
 
-    # Generate a summary of all detections with Azure Open AI
-    summary_result = yield context.call_activity(
-        "generate_summary", json.dumps({"detections": results})
+    # Copy the answer of each representative to the members of its group
+    answers = {index: (crops[index]["known"], "known", None) for index in known}
+    scores = {index: match["score"] for index, match in zip(pending, local_matches)}
+    for index, match in zip(pending, local_matches):
+        if match["answer"] is not None:
+            answers[index] = (match["answer"], "local", match["score"])
+    for index, result in zip(model_analyzed, analysis_results):
+        answers[index] = (result["openai_response"], "model", scores[index])
+    results = detection_results(retained, crops, answers)
+    match_stats = {
+        "known": len(known),
+        "local": len(pending) - len(model_analyzed),
+        "model": len(model_analyzed),
+    }
+    logging.info(f"Local matching: {match_stats}")
+
+    publish("summarizing", analyzed)
+    # Generate a summary of the table of the detections with Azure Open AI
+    started = context.current_utc_datetime
+    summary, summary_payloads, summary_results, summary_stats = yield from summarize(
+        context,
+        summaries.table_rows(results),
+        detection_stats,
+        options["summary_token_budget"],
+        suffix,
+    )
+    end_stage(
+        context,
+        stages,
+        "summarizing",
+        started,
+        summary_payloads,
+        summary_results,
+        len(summary_payloads),
+    )
+    logging.info(f"Summary: {summary_stats}")
+    run_metrics = plan_metrics(
+        orchestration_started,
+        context.current_utc_datetime,
+        stages,
+        metrics.call_metrics(cropping),
+        cache_stats,
+        dedup_stats,
+        match_stats,
     )
+    logging.info(f"Metrics: {run_metrics}")
 
     # Include summary in the final results
     # final_results = {"detections": results, "summary": summary_result["summary"]}
 
+    publish("completed", analyzed)
     logging.info(f"===> Processing finished")
     logging.info("Returning from vision_agent_orchestrator")
-    return {
-        "detections": results,
-        "summary": summary_result["summary"],
-        "aggregated_detections": aggregated_detections,
-    }
+    output = plan_output(
+        retained,
+        crops,
+        answers,
+        results,
+        summary,
+        run_metrics,
+        detection_stats,
+        cache_stats,
+        dedup_stats,
+        reference_stats,
+        match_stats,
+        summary_stats,
+    )
+    return (yield from store(output, plan, prepared_reference))
     # return final_results
     # return results
 
 
+@myApp.orchestration_trigger(context_name="context")
+def batch_orchestrator(context: df.DurableOrchestrationContext):
+    """
+    Orchestrator analyzing a set of floor plans sharing one legend. The plans are
+    the given filenames, or the images of the container whose name starts with
+    prefix. The legend is prepared once, then every plan is analyzed by a
+    vision_agent_orchestrator sub-orchestration, at most max_concurrent_plans at
+    a time, and reuses the answers of the similar symbols of the plans already
+    analyzed. The first seed_plans plans run before the others, so that every
+    later plan starts with their symbols. The other options are passed to every
+    plan.
+    """
+    logging.info("Starting batch_orchestrator orchestration")
+    payload = context.get_input()
+    started = context.current_utc_datetime
+    container = payload.get("container")
+    reference_filename = payload.get("reference_filename")
+    max_concurrent_plans = payload.get(
+        "max_concurrent_plans", DEFAULT_MAX_CONCURRENT_PLANS
+    )
+    seed_plans = payload.get("seed_plans", DEFAULT_SEED_PLANS)
+    options = {
+        key: value
+        for key, value in payload.items()
+        if key not in ("filenames", "prefix", "max_concurrent_plans", "seed_plans")
+    }
+    if options.get("dedup_threshold") is None:
+        options["dedup_threshold"] = DEFAULT_BATCH_DEDUP_THRESHOLD
+
+    filenames = payload.get("filenames")
+    if filenames is None:
+        listing = yield context.call_activity(
+            "list_plans",
+            json.dumps(
+                {
+                    "container": container,
+                    "prefix": payload.get("prefix", ""),
+                    "exclude": [reference_filename],
+                }
+            ),
+        )
+        filenames = metrics.result_of(listing)
+    logging.info(f"Analyzing {len(filenames)} plans")
+
+    prepared_reference = yield context.call_activity(
+        "prepare_reference",
+        json.dumps(
+            {
+                "container": container,
+                "filename": reference_filename,
+                "detail": payload.get("reference_detail", "high"),
+                "max_tokens": payload.get("reference_max_tokens"),
+                "as_artifact": payload.get("artifact_mode", False),
+                "use_cache": payload.get("use_cache", True),
+            }
+        ),
+    )
+    # The legend patches are labeled once for the local matching of all the plans
+    legend_patches = None
+    if payload.get("local_match_threshold") is not None:
+        legend_patches = yield context.call_activity(
+            "label_legend",
+            labeling_payload(
+                prepared_reference,
+                payload.get("reference_detail", "high"),
+                payload.get("analyze_prompt"),
+                payload.get("use_cache", True),
+            ),
+        )
+
+    # Keep max_concurrent_plans plans running, each new plan starting with the
+    # symbols answered by the plans finished so far. The plans started together
+    # share nothing, so the next plans wait for the seed plans to finish. Each
+    # plan gets the most recent MAX_KNOWN_SYMBOLS symbols.
+    plans = {}
+    failed = {}
+    known_symbols = []
+    running = []
+    position = 0
+    while position < len(filenames) or running:
+        while (
+            position < len(filenames)
+            and len(running) < max_concurrent_plans
+            and (position < seed_plans or len(plans) + len(failed) >= seed_plans)
+        ):
+            plan_payload = {
+                **options,
+                "filename": filenames[position],
+                "prepared_reference": prepared_reference,
+                "legend_patches": legend_patches,
+                "known_symbols": known_symbols[-MAX_KNOWN_SYMBOLS:],
+            }
+            task = context.call_sub_orchestrator(
+                "vision_agent_orchestrator",
+                plan_payload,
+                f"{context.instance_id}:plan:{position}",
+            )
+            running.append((task, filenames[position]))
+            position += 1
+        context.set_custom_status(
+            {
+                "stage": "analyzing",
+                "done": len(plans) + len(failed),
+                "total": len(filenames),
+                "known_symbols": len(known_symbols),
+            }
+        )
+        finished = yield context.task_any([task for task, _ in running])
+        filename = next(name for task, name in running if task is finished)
+        running = [(task, name) for task, name in running if task is not finished]
+        if isinstance(finished.result, Exception):
+            logging.warning(f"Plan {filename} failed: {finished.result}")
+            failed[filename] = str(finished.result)
+            continue
+        plan = finished.result
+        known_symbols.extend(plan.pop("symbols", []))
+        plans[filename] = plan
+
+    inventory = {}
+    for plan in plans.values():
+        for detection in plan["detections"]:
+            tag = inventory.setdefault(
+                detection["custom_vision_tag"], {"count": 0, "answers": {}}
+            )
+            tag["count"] += 1
+            answer = detection["openai_response"]
+            tag["answers"][answer] = tag["answers"].get(answer, 0) + 1
+
+    elapsed = (context.current_utc_datetime - started).total_seconds()
+    throughput = {
+        "plans": len(plans),
+        "failed": len(failed),
+        "elapsed_seconds": elapsed,
+        "plans_per_minute": round(len(plans) * 60 / elapsed, 2) if elapsed else None,
+    }
+    dedup_stats = {
+        "known_symbols": len(known_symbols),
+        "answered_from_other_plans": sum(
+            plan["match_stats"]["known"] for plan in plans.values()
+        ),
+    }
+    logging.info(f"Batch throughput: {throughput}")
+    context.set_custom_status(
+        {"stage": "completed", "done": len(filenames), "total": len(filenames)}
+    )
+    return {
+        "plans": plans,
+        "failed": failed,
+        "inventory": inventory,
+        "dedup_stats": dedup_stats,
+        "throughput": throughput,
+    }
+
+
+@myApp.orchestration_trigger(context_name="context")
+def analysis_chunk_orchestrator(context: df.DurableOrchestrationContext):
+    """
+    Sub-orchestrator analyzing one chunk of the detections of a plan. Its input
+    holds the images of the chunk and the settings shared by their Azure OpenAI
+    calls, and it returns the compact result of each analyzed symbol with the
+    metrics of each call.
+    """
+    chunk = context.get_input()
+    items = [
+        {"image": image, "use_cache": chunk["use_cache"]} for image in chunk["images"]
+    ]
+    results, calls_metrics = yield from analyze_in_waves(
+        context,
+        analysis_calls(items, chunk["analysis"], chunk["batch_size"], chunk["suffix"]),
+        chunk["max_in_flight"],
+        chunk["retry_interval_ms"],
+        chunk["retry_attempts"],
+        chunk["offset"],
+    )
+    return {"results": results, "metrics": calls_metrics}
+
+
 # Activity
 @myApp.activity_trigger(input_name="activitypayload")
+@metrics.instrumented
 def read_image(activitypayload):
+    """
+    Activity function to read a plan from blob storage, through a temporary file.
+    Plans above MAX_IMAGE_PIXELS are replaced by a downscaled working copy.
+    Returns the image, base64 encoded or as an artifact reference, with the
+    SHA-256 content hash of the plan, which identifies it in the result store.
+    """
     logging.info("Starting read_image activity")
 
     data = json.loads(activitypayload)
     container = data.get("container")
     filename = data.get("filename")
+    as_artifact = data.get("as_artifact", False)
 
-    conn_str = os.environ["BLOB_CONNECTION_STRING"]
-
-    blob_service_client = BlobServiceClient.from_connection_string(conn_str)
+    blob_service_client = clients.get_blob_service_client()
     blob_client = blob_service_client.get_blob_client(
         container=container, blob=filename
     )
-    image_bytes = blob_client.download_blob().readall()
+    with large_images.download_to_file(blob_client) as source:
+        image_hash = hashlib.file_digest(source, "sha256").hexdigest()
+        image_bytes, content_type = large_images.read_plan(source)
+
+    if as_artifact:
+        # Store a content-addressed copy and return its reference only
+        logging.info("Returning read_image activity")
+        return {
+            "image": artifacts.put_artifact(image_bytes, content_type),
+            "content_hash": image_hash,
+        }
 
     # Optionally encode to base64 if needed downstream
     logging.info("Returning read_image activity")
-    return base64.b64encode(image_bytes).decode("utf-8")
+    return {
+        "image": base64.b64encode(image_bytes).decode("utf-8"),
+        "content_hash": image_hash,
+    }
 
 
 @myApp.activity_trigger(input_name="activitypayload")
+@metrics.instrumented
+async def read_image_async(activitypayload):
+    """Asynchronous version of read_image, using the aio blob client."""
+    logging.info("Starting read_image_async activity")
+
+    data = json.loads(activitypayload)
+    container = data.get("container")
+    filename = data.get("filename")
+    as_artifact = data.get("as_artifact", False)
+
+    blob_service_client = clients.get_async_blob_service_client()
+    blob_client = blob_service_client.get_blob_client(
+        container=container, blob=filename
+    )
+    with await large_images.download_to_file_async(blob_client) as source:
+        # Hashing, decoding and downscaling are CPU bound, they leave the event
+        # loop free
+        image_hash = await asyncio.to_thread(
+            lambda: hashlib.file_digest(source, "sha256").hexdigest()
+        )
+        image_bytes, content_type = await asyncio.to_thread(
+            large_images.read_plan, source
+        )
+
+    if as_artifact:
+        logging.info("Returning read_image_async activity")
+        return {
+            "image": await artifacts.put_artifact_async(image_bytes, content_type),
+            "content_hash": image_hash,
+        }
+
+    logging.info("Returning read_image_async activity")
+    return {
+        "image": base64.b64encode(image_bytes).decode("utf-8"),
+        "content_hash": image_hash,
+    }
+
+
+@myApp.activity_trigger(input_name="activitypayload")
+@metrics.instrumented
+def list_plans(activitypayload):
+    """
+    Activity function to list the floor plan images of a container whose name
+    starts with prefix, except the excluded ones such as the legend.
+    """
+    logging.info("Starting list_plans activity")
+    data = json.loads(activitypayload)
+    exclude = set(data.get("exclude") or [])
+    container_client = clients.get_blob_service_client().get_container_client(
+        data["container"]
+    )
+    filenames = sorted(
+        blob.name
+        for blob in container_client.list_blobs(name_starts_with=data.get("prefix"))
+        if blob.name.lower().endswith(PLAN_EXTENSIONS) and blob.name not in exclude
+    )
+    logging.info(f"Found {len(filenames)} plans")
+    logging.info("Returning from list_plans activity")
+    return filenames
+
+
+@myApp.activity_trigger(input_name="activitypayload")
+@metrics.instrumented
 def object_detection(activitypayload):
+    """
+    Activity function to detect the objects of an image with the Custom Vision
+    prediction endpoint, or with the exported ONNX model when backend is onnx.
+    The onnx backend detects the tiles of tile_size pixels of the image itself,
+    in batches, instead of the tiles being fanned out by the orchestrator.
+    """
     logging.info("Starting object_detection activity")
 
     # logging.info(f"Activity payload: {activitypayload}")
 
-    img_data = json.loads(activitypayload).get("image_data")
+    data = json.loads(activitypayload)
+    img_data = data.get("image_data")
+    # Region of the full image covered by a tile, in normalized coordinates
+    region = data.get("region")
     logging.info(f"Image data: {len(img_data)} bytes")
-    image_data = base64.b64decode(img_data)
+    image_data = artifacts.load_bytes(img_data)
+
+    if data.get("backend", DEFAULT_DETECTION_BACKEND) == "onnx":
+        image = Image.open(BytesIO(image_data))
+        image.load()
+        metrics.record(image_width=image.width, image_height=image.height)
+        predictions = [
+            Prediction.model_validate(p)
+            for p in onnx_detection.detect_image(
+                image,
+                data.get("tile_size"),
+                data.get("tile_overlap", DEFAULT_TILE_OVERLAP),
+            )
+        ]
+        logging.info(f"Detected {len(predictions)} objects with the ONNX model")
+        metrics.record(detections=len(predictions))
+        logging.info("Retuning from object_detection activity")
+        return [pred.json() for pred in predictions]
 
-    endpoint = os.environ["CUSTOM_VISION_PREDICTION_URL"]
-    logging.info(f"Endpoint: {endpoint}")
-    key = os.environ["CUSTOM_VISION_PREDICTION_KEY"]
-    logging.info(f"Key: {key}")
     project_id = os.environ["CUSTOM_VISION_PROJECT_ID"]
-    logging.info(f"Project ID: {project_id}")
     model_name = os.environ["CUSTOM_VISION_ITERATION_PUBLISHED_NAME"]
-    logging.info(f"Model Name: {model_name}")
 
-    credentials = ApiKeyCredentials(in_headers={"Prediction-key": key})
-    logging.info(f"credentials created")
-    predictor = CustomVisionPredictionClient(endpoint, credentials)
-    logging.info(f"Predictor: {predictor}")
+    predictor = clients.get_custom_vision_client()
     try:
         results = predictor.detect_image(project_id, model_name, image_data)
-        logging.info(f"Results: {results}")
+        logging.info(f"Detected {len(results.predictions)} objects")
+        metrics.record(detections=len(results.predictions))
     except Exception as e:
         logging.error(f"Error during prediction: {e}")
         raise
@@ -235,136 +1965,509 @@ def object_detection(activitypayload):
         )
         for p in results.predictions
     ]
+    if region:
+        for prediction in predictions:
+            prediction.bounding_box = BoundingBox(
+                **detection_utils.to_image_coordinates(
+                    prediction.bounding_box.model_dump(), region
+                )
+            )
 
     logging.info("Retuning from object_detection activity")
     return [pred.json() for pred in predictions]
 
 
 @myApp.activity_trigger(input_name="activitypayload")
+@metrics.instrumented
 def azure_openai_processing(activitypayload):
     logging.info("Starting azure_openai_processing activity")
-    client = AzureOpenAI(
-        azure_endpoint=os.environ["OPENAI_ENDPOINT"],
-        api_key=os.environ["OPENAI_KEY"],
-        api_version="2024-02-01",
-    )
-    #     prompt = """
-    #     Here's an image of a symbol and a legend
-    #     please match the symbol to the legend and give me the name of the symbol in the legend.
-    #     Use the exact symbol name as it appears in the legend, all in uppercase
-    #     only return the name of the symbol or No Match if there is no match
-
-    #     Here is the legend
-    # """
-    reference_img = json.loads(activitypayload).get("reference_img")
-    detected_img = json.loads(activitypayload).get("image")
-    sys_prompt = json.loads(activitypayload).get("analyze_prompt")
-    # if analyze_prompt:
-    #     sys_prompt = analyze_prompt
-    # else:
-    #     sys_prompt = prompt
-
-    messages = [
-        {
-            "role": "user",
-            "content": [
-                {"type": "text", "text": sys_prompt},
-                {
-                    "type": "image_url",
-                    "image_url": {
-                        "url": reference_img,
-                    },
-                },
-            ],
-        },
-        {
-            "role": "user",
-            "content": [
-                {"type": "text", "text": "Here is the symbol and the legend"},
-                {
-                    "type": "image_url",
-                    "image_url": {"url": detected_img, "detail": "high"},
-                },
-            ],
-        },
-    ]
+    result = symbol_analysis.analyze_symbol(json.loads(activitypayload))
+    logging.info("Returning from azure_openai_processing activity")
+    return result
 
-    response = client.chat.completions.create(
-        model=os.environ["OPENAI_MODEL"], messages=messages
-    )
 
-    logging.info("Returning from azure_openai_processing activity")
-    return {
-        "openai_response": response.choices[0].message.content,
-        "bounding_box": json.loads(activitypayload).get("bounding_box"),
-        "custom_vision_tag": json.loads(activitypayload).get("tag"),
-        "probability": json.loads(activitypayload).get("probability"),
-    }
+@myApp.activity_trigger(input_name="activitypayload")
+@metrics.instrumented
+async def azure_openai_processing_async(activitypayload):
+    """Asynchronous version of azure_openai_processing, using AsyncAzureOpenAI."""
+    logging.info("Starting azure_openai_processing_async activity")
+    result = await symbol_analysis.analyze_symbol_async(json.loads(activitypayload))
+    logging.info("Returning from azure_openai_processing_async activity")
+    return result
 
 
 @myApp.activity_trigger(input_name="activitypayload")
-def generate_summary(activitypayload):
-    logging.info("Starting generate_summary activity")
-    client = AzureOpenAI(
-        azure_endpoint=os.environ["OPENAI_ENDPOINT"],
-        api_key=os.environ["OPENAI_KEY"],
-        api_version="2024-02-01",
+@metrics.instrumented
+def azure_openai_batch_processing(activitypayload):
+    """
+    Activity function to match a batch of cropped symbols against the legend in
+    a single Azure OpenAI call. Returns one result per symbol, in order.
+    """
+    logging.info("Starting azure_openai_batch_processing activity")
+    data = json.loads(activitypayload)
+    results = symbol_analysis.analyze_symbols_batch(
+        data["items"],
+        data["reference_img"],
+        data.get("analyze_prompt"),
+        data.get("strategy", "parts"),
+        data.get("reference_detail"),
     )
+    logging.info("Returning from azure_openai_batch_processing activity")
+    return results
 
-    data = json.loads(activitypayload)
-    detections = data.get("detections", [])
 
-    prompt = """You are an AI assistant analyzing a floor plan image. I will give you a list of detected objects with their tags and probabilities.
-    Please provide a concise summary of what was detected in the floor plan. Focus on:
-    1. The types of rooms/spaces detected
-    2. Notable features or patterns
-    3. Any potential inaccuracies or areas that need attention
-    
-    Here are the detections:
+@myApp.activity_trigger(input_name="activitypayload")
+@metrics.instrumented
+def local_match(activitypayload):
     """
+    Activity function to match cropped symbols against the labeled patches of the
+    legend on the CPU. Returns, for each crop, its best normalized cross correlation and
+    the answer of the matched legend patch when the match is confident.
+    """
+    logging.info("Starting local_match activity")
+    data = json.loads(activitypayload)
+    matches = template_matching.match_symbols(
+        data["items"],
+        data["reference_img"],
+        data["patches"],
+        data["threshold"],
+        data.get("margin", template_matching.DEFAULT_MATCH_MARGIN),
+    )
+    logging.info("Returning from local_match activity")
+    return matches
 
-    # Format detections for the prompt
-    detections_text = "\n".join(
-        [
-            f"- {det['custom_vision_tag']}: {det['openai_response']} (confidence: {det['probability']:.1%})"
-            for det in detections
-        ]
+
+@myApp.activity_trigger(input_name="activitypayload")
+@metrics.instrumented
+def label_legend(activitypayload):
+    """
+    Activity function to segment the legend into symbol patches and label each
+    of them with Azure OpenAI, once per orchestration. Returns the boxes of the
+    patches and their labels, passed to every local_match call.
+    """
+    logging.info("Starting label_legend activity")
+    data = json.loads(activitypayload)
+    patches = template_matching.label_legend(
+        data["reference_img"],
+        data.get("analyze_prompt"),
+        data.get("reference_detail"),
+        data.get("use_cache", True),
     )
+    logging.info(f"Labeled {len(patches['labels'])} legend patches")
+    logging.info("Returning from label_legend activity")
+    return patches
 
-    messages = [{"role": "user", "content": f"{prompt}\n{detections_text}"}]
 
-    response = client.chat.completions.create(
+@myApp.activity_trigger(input_name="activitypayload")
+@metrics.instrumented
+def generate_summary(activitypayload):
+    """
+    Summarize the table rows (or the detections) with their per-tag stats, one
+    part of a table, or the summaries of its parts. Returns the summary and the
+    estimated tokens of its input, or the parts of the input to summarize
+    separately when it exceeds token_budget (see shared_code.summaries).
+    """
+    logging.info("Starting generate_summary activity")
+
+    data = json.loads(activitypayload)
+    messages, estimated_tokens, parts = summaries.summary_request(data)
+    if parts is not None:
+        logging.info(
+            f"Summary input of {estimated_tokens} tokens split in {len(parts)} parts"
+        )
+        return {"parts": parts, "estimated_tokens": estimated_tokens}
+
+    response = rate_limit.chat_completion(
         model=os.environ["OPENAI_MODEL"],
         messages=messages,
         temperature=0.7,
-        max_tokens=500,
+        max_tokens=summaries.DEFAULT_MAX_TOKENS,
     )
 
     logging.info("Returning from generate_summary activity")
-    return {"summary": response.choices[0].message.content}
+    return {
+        "summary": response.choices[0].message.content,
+        "estimated_tokens": estimated_tokens,
+    }
 
 
 @myApp.activity_trigger(input_name="activitypayload")
+@metrics.instrumented
+async def generate_summary_async(activitypayload):
+    """Asynchronous version of generate_summary, using AsyncAzureOpenAI."""
+    logging.info("Starting generate_summary_async activity")
+
+    data = json.loads(activitypayload)
+    messages, estimated_tokens, parts = summaries.summary_request(data)
+    if parts is not None:
+        logging.info(
+            f"Summary input of {estimated_tokens} tokens split in {len(parts)} parts"
+        )
+        return {"parts": parts, "estimated_tokens": estimated_tokens}
+
+    response = await rate_limit.chat_completion_async(
+        model=os.environ["OPENAI_MODEL"],
+        messages=messages,
+        temperature=0.7,
+        max_tokens=summaries.DEFAULT_MAX_TOKENS,
+    )
+
+    logging.info("Returning from generate_summary_async activity")
+    return {
+        "summary": response.choices[0].message.content,
+        "estimated_tokens": estimated_tokens,
+    }
+
+
+@myApp.activity_trigger(input_name="activitypayload")
+@metrics.instrumented
 def aggregate_detections_activity(activitypayload):
     """
     Activity function to aggregate detections by tag and filter by probability threshold.
-    Returns a dictionary with tags as keys and lists of detections as values.
-    Only includes detections above the minimum probability threshold.
+    Only includes detections above the minimum probability threshold, and removes
+    the duplicate boxes of each tag with non-maximum suppression when
+    iou_threshold is set. When core is set, only the detections centered in that
+    region of a tile are kept, the others belonging to a neighbouring tile.
+    Returns the retained detections as a compact columnar table, grouped by tag
+    and sorted by probability within each tag, with the per-tag statistics.
     """
     logging.info("Starting aggregate_detections_activity")
     data = json.loads(activitypayload)
-    detections = [Prediction.model_validate_json(det) for det in data["detections"]]
-    min_probability = data.get("min_probability", 0.5)
+    table = detection_utils.DetectionTable.from_predictions(data["detections"]).filter(
+        data.get("min_probability", 0.5)
+    )
+    if data.get("core"):
+        table = table.within(data["core"])
+    table = table.nms(data.get("iou_threshold")).sort()
+    logging.info(f"Retained {len(table)} of {len(data['detections'])} detections")
+    return {"table": table.to_dict(), "stats": table.tag_stats()}
 
-    aggregated = {}
-    for detection in detections:
-        if detection.probability >= min_probability:
-            if detection.tag not in aggregated:
-                aggregated[detection.tag] = []
-            aggregated[detection.tag].append(detection)
 
-    # Sort detections within each tag by probability
-    for tag in aggregated:
-        aggregated[tag].sort(key=lambda x: x.probability, reverse=True)
+@myApp.activity_trigger(input_name="activitypayload")
+@metrics.instrumented
+def crop_detections(activitypayload):
+    """
+    Activity function to crop all the detections out of the candidate image at once.
+    The image is decoded a single time and every crop is returned as a data URL,
+    or as an artifact reference when as_artifact is set, in the same order as the
+    detections received.
+    When dedup_threshold is set, near-identical crops of the same tag are grouped
+    and each crop holds the index of the crop representing its group, and its
+    perceptual hash. Representatives close to one of the known_symbols answered
+    on other plans hold its answer as known.
+    When region is set, image_data is the tile covering that region of the plan
+    and the detections, normalized to the plan, are cropped out of the tile.
+    Otherwise, when image_data is the working copy of a plan above
+    MAX_IMAGE_PIXELS, the detections are cropped out of the original plan, whose
+    container and filename are given by plan, at full resolution.
+    """
+    logging.info("Starting crop_detections activity")
+    data = json.loads(activitypayload)
+    detections = data.get("detections", [])
+    dedup_threshold = data.get("dedup_threshold")
+    padding = data.get("padding", DEFAULT_CROP_PADDING)
+    as_artifact = data.get("as_artifact", False)
+    image_format = data.get("format", DEFAULT_CROP_FORMAT).upper()
+    if image_format == "JPG":
+        image_format = "JPEG"
+    mime_type = Image.MIME.get(image_format, f"image/{image_format.lower()}")
+
+    image = Image.open(BytesIO(artifacts.load_bytes(data["image_data"])))
+    region = data.get("region")
+    plan_size = None
+    if data.get("plan") and not region:
+        plan_size = large_images.plan_size(image)
+    if plan_size:
+        # Only the bands of the plan covering the detections are decoded
+        boxes = [
+            padded_box(detection["bounding_box"], *plan_size, padding)
+            for detection in detections
+        ]
+        with download_plan(data["plan"]) as source:
+            regions = dict(large_images.crop_regions(source, boxes))
+        cropped_images = [regions[index] for index in range(len(boxes))]
+        metrics.record(image_width=plan_size[0], image_height=plan_size[1])
+    else:
+        image.load()
+        metrics.record(image_width=image.width, image_height=image.height)
+        cropped_images = (
+            crop_bounding_box(
+                image,
+                (
+                    detection_utils.to_region_coordinates(
+                        detection["bounding_box"], region
+                    )
+                    if region
+                    else detection["bounding_box"]
+                ),
+                padding,
+            )
+            for detection in detections
+        )
+
+    crops = []
+    hashes = []
+    for cropped_image in cropped_images:
+        if dedup_threshold is not None:
+            hashes.append(dedup.difference_hash(cropped_image))
+        crop_bytes = encode_image(cropped_image, image_format)
+        if as_artifact:
+            crops.append({"image": artifacts.put_artifact(crop_bytes, mime_type)})
+        else:
+            img_str = base64.b64encode(crop_bytes).decode("utf-8")
+            crops.append({"image": f"data:{mime_type};base64,{img_str}"})
+
+    if dedup_threshold is not None:
+        tags = [detection["tag"] for detection in detections]
+        representatives = dedup.cluster_hashes(hashes, tags, dedup_threshold)
+        known_symbols = data.get("known_symbols") or []
+        known = dedup.match_known(
+            hashes,
+            tags,
+            [int(symbol["hash"], 16) for symbol in known_symbols],
+            [symbol["tag"] for symbol in known_symbols],
+            dedup_threshold,
+        )
+        for index, (crop, image_hash) in enumerate(zip(crops, hashes)):
+            crop["hash"] = dedup.format_hash(image_hash)
+            if representatives[index] == index and known[index] is not None:
+                crop["known"] = known_symbols[known[index]]["answer"]
+    else:
+        representatives = range(len(crops))
+    for crop, representative in zip(crops, representatives):
+        crop["representative"] = representative
+
+    logging.info(f"Cropped {len(crops)} detections")
+    logging.info("Returning from crop_detections activity")
+    return crops
+
+
+@myApp.activity_trigger(input_name="activitypayload")
+@metrics.instrumented
+def create_tiles(activitypayload):
+    """
+    Activity function to split the candidate image into overlapping tiles for the
+    object detection. Each tile is returned with the region of the full image it
+    covers and its core, the part of the region owning the detections centered
+    in it, in normalized coordinates. When image_data is the working copy of a
+    plan above MAX_IMAGE_PIXELS, the tiles are cut out of the original plan,
+    whose container and filename are given by plan, at full resolution.
+    """
+    logging.info("Starting create_tiles activity")
+    data = json.loads(activitypayload)
+    tile_size = data["tile_size"]
+    overlap = data.get("tile_overlap", DEFAULT_TILE_OVERLAP)
+    as_artifact = data.get("as_artifact", False)
+
+    image = Image.open(BytesIO(artifacts.load_bytes(data["image_data"])))
+    plan_size = large_images.plan_size(image) if data.get("plan") else None
+    width, height = plan_size or image.size
+    metrics.record(image_width=width, image_height=height)
+    regions = detection_utils.plan_tiles(width, height, tile_size, overlap)
+    cores = detection_utils.plan_tile_cores(width, height, tile_size, overlap)
+
+    def tile_images():
+        if plan_size:
+            # Tiles are encoded as soon as the bands covering them are decoded
+            with download_plan(data["plan"]) as source:
+                yield from large_images.crop_regions(source, regions)
+        else:
+            image.load()
+            for index, box in enumerate(regions):
+                yield index, image.crop(box)
+
+    tiles = [None] * len(regions)
+    for index, tile in tile_images():
+        (left, top, right, bottom), core = regions[index], cores[index]
+        tile_bytes = encode_image(tile, "PNG")
+        if as_artifact:
+            tile_image = artifacts.put_artifact(tile_bytes, "image/png")
+        else:
+            tile_image = base64.b64encode(tile_bytes).decode("utf-8")
+        tiles[index] = {
+            "image": tile_image,
+            "region": {
+                "left": left / width,
+                "top": top / height,
+                "width": (right - left) / width,
+                "height": (bottom - top) / height,
+            },
+            "core": {
+                "left": core[0] / width,
+                "top": core[1] / height,
+                "width": (core[2] - core[0]) / width,
+                "height": (core[3] - core[1]) / height,
+            },
+        }
+
+    logging.info(f"Created {len(tiles)} tiles of {width}x{height} image")
+    logging.info("Returning from create_tiles activity")
+    return tiles
+
+
+@myApp.activity_trigger(input_name="activitypayload")
+@metrics.instrumented
+def prepare_reference(activitypayload):
+    """
+    Activity function to read and normalize the reference legend once per
+    orchestration: whitespace is trimmed, the image is converted to grayscale and
+    downscaled to the requested detail level and token budget. The prepared
+    legend is cached by the content hash of the original and the settings used.
+    Returns the prepared legend as a data URL or an artifact reference, with
+    its size and estimated token statistics, and the SHA-256 content hash of the
+    original.
+    """
+    logging.info("Starting prepare_reference activity")
+    data = json.loads(activitypayload)
+    detail = data.get("detail", "high")
+    max_tokens = data.get("max_tokens")
+    as_artifact = data.get("as_artifact", False)
+
+    blob_client = clients.get_blob_service_client().get_blob_client(
+        container=data["container"], blob=data["filename"]
+    )
+    cache = (
+        result_cache.get_result_cache()
+        if data.get("use_cache", True)
+        else result_cache.NullResultCache()
+    )
+    # The legend goes through the same size checks and working copy as the plans
+    with large_images.download_to_file(blob_client) as source:
+        original_bytes = os.fstat(source.fileno()).st_size
+        reference_hash = hashlib.file_digest(source, "sha256").hexdigest()
+        key = artifacts.content_hash(
+            json.dumps(
+                [
+                    "reference",
+                    reference_hash,
+                    detail,
+                    max_tokens,
+                    as_artifact,
+                ]
+            ).encode("utf-8")
+        )
+        cached = cache.get(key)
+        if cached is not None:
+            logging.info("Returning cached prepare_reference result")
+            return {**cached, "content_hash": reference_hash}
+
+        image = large_images.open_image(source)
+        original_width, original_height = image.size
+        image = large_images.working_copy(
+            image, source, large_images.max_image_pixels()
+        )
+    prepared = reference.prepare_reference_image(image, detail, max_tokens)
+    prepared_bytes = encode_image(prepared, "PNG")
+    if as_artifact:
+        prepared_image = artifacts.put_artifact(prepared_bytes, "image/png")
+    else:
+        encoded = base64.b64encode(prepared_bytes).decode("utf-8")
+        prepared_image = f"data:image/png;base64,{encoded}"
+
+    result = {
+        "reference": prepared_image,
+        "content_hash": reference_hash,
+        "detail": detail,
+        "stats": {
+            "original_size": [original_width, original_height],
+            "prepared_size": [prepared.width, prepared.height],
+            "original_bytes": original_bytes,
+            "prepared_bytes": len(prepared_bytes),
+            "original_tokens": reference.estimate_image_tokens(
+                original_width, original_height, "high"
+            ),
+            "prepared_tokens": reference.estimate_image_tokens(
+                prepared.width, prepared.height, detail
+            ),
+        },
+    }
+    cache.set(key, result)
+    logging.info(f"Prepared reference: {result['stats']}")
+    logging.info("Returning from prepare_reference activity")
+    return result
+
+
+def stored_run(data):
+    """
+    Identity of a plan analysis in the result store, from the content hashes of
+    the plan and of the legend, the analysis prompt and the options of the run.
+    """
+    model = os.environ["OPENAI_MODEL"]
+    return {
+        "image_hash": data["image_hash"],
+        "reference_hash": data["reference_hash"],
+        "prompt_hash": result_store.prompt_hash(data.get("analyze_prompt")),
+        "model": model,
+        "run_key": result_store.run_key(
+            data["image_hash"],
+            data["reference_hash"],
+            data.get("analyze_prompt"),
+            model,
+            clients.OPENAI_API_VERSION,
+            data["options"],
+        ),
+    }
 
-    return {tag: [det.dict() for det in dets] for tag, dets in aggregated.items()}
+
+@myApp.activity_trigger(input_name="activitypayload")
+@metrics.instrumented
+def lookup_result(activitypayload):
+    """
+    Activity function looking a plan analysis up in the result store, by the
+    content hashes of the plan and of the legend computed when they were read,
+    the prompt version and the options used. Returns the output of the most
+    recent stored run with the same key, if any, under output.
+    """
+    logging.info("Starting lookup_result activity")
+    data = json.loads(activitypayload)
+    store = result_store.get_result_store()
+    if isinstance(store, result_store.NullResultStore):
+        logging.info("Returning from lookup_result activity, no result store")
+        return {}
+
+    run = stored_run(data)
+    record = store.latest(run["run_key"], run["prompt_hash"], run["image_hash"])
+    output = None
+    if record is not None:
+        output = result_store.expand_output(record["output"])
+        output["stored_record"] = {
+            "record_id": record["record_id"],
+            "created": record["created"],
+        }
+    logging.info(f"Stored result of run {run['run_key']}: {record is not None}")
+    logging.info("Returning from lookup_result activity")
+    return {**run, "output": output}
+
+
+@myApp.activity_trigger(input_name="activitypayload")
+@metrics.instrumented
+def store_result(activitypayload):
+    """
+    Activity function writing the versioned record of a completed plan analysis
+    to the result store, if any: the run identified by stored_run, its options
+    and its output compacted by result_store.compact_output.
+    """
+    logging.info("Starting store_result activity")
+    data = json.loads(activitypayload)
+    store = result_store.get_result_store()
+    if isinstance(store, result_store.NullResultStore):
+        logging.info("Returning from store_result activity, no result store")
+        return {}
+
+    run = stored_run(data)
+    record = {
+        "schema_version": result_store.SCHEMA_VERSION,
+        "record_id": data["record_id"],
+        "created": data["created"],
+        **run,
+        "api_version": clients.OPENAI_API_VERSION,
+        "container": data.get("container"),
+        "filename": data.get("filename"),
+        "reference_filename": data.get("reference_filename"),
+        "options": data["options"],
+        "output": data["output"],
+    }
+    store.put(record)
+    logging.info(f"Stored record {record['record_id']} of run {record['run_key']}")
+    logging.info("Returning from store_result activity")
+    return {"record_id": record["record_id"]}
@@ -0,0 +1 @@
+"""Helpers shared by the functions of the Vision Agent function app."""
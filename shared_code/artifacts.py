@@ -0,0 +1,205 @@
+"""
+Content-addressed artifacts stored in a scratch blob container.
+
+Instead of passing base64 encoded images through the Durable Functions history,
+activities can store them once in the scratch container and exchange small
+references of the form ``artifact://<container>/<sha256>.<extension>``.
+References are resolved lazily, only by the activities that need the bytes.
+"""
+
+import base64
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from azure.core.exceptions import ResourceExistsError
+from azure.storage.blob import ContentSettings
+
+from shared_code import clients
+
+ARTIFACT_SCHEME = "artifact://"
+DEFAULT_ARTIFACT_CONTAINER = "vision-agent-artifacts"
+# Artifacts are immutable, so the ones already downloaded by this worker are kept
+# in memory up to this many bytes (e.g. the reference legend used by every call)
+DEFAULT_ARTIFACT_CACHE_BYTES = 64 * 1024 * 1024
+
+_EXTENSIONS = {
+    "image/jpeg": "jpg",
+    "image/png": "png",
+    "image/webp": "webp",
+    "image/gif": "gif",
+    "application/json": "json",
+}
+
+_created_containers = set()
+_cache = OrderedDict()
+_cache_size = 0
+_cache_lock = threading.Lock()
+
+
+def artifact_container():
+    """Name of the scratch container where the artifacts are written."""
+    return os.environ.get("ARTIFACT_CONTAINER", DEFAULT_ARTIFACT_CONTAINER)
+
+
+def is_artifact_ref(value):
+    """Return True if the value is an artifact reference."""
+    return isinstance(value, str) and value.startswith(ARTIFACT_SCHEME)
+
+
+def make_ref(container, blob_name):
+    """Build an artifact reference from a container and a blob name."""
+    return f"{ARTIFACT_SCHEME}{container}/{blob_name}"
+
+
+def parse_ref(ref):
+    """Split an artifact reference into its container and blob name."""
+    container, _, blob_name = ref[len(ARTIFACT_SCHEME) :].partition("/")
+    return container, blob_name
+
+
+def content_hash(data):
+    """SHA-256 hex digest used to name the artifacts."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def ref_hash(ref):
+    """Content hash embedded in an artifact reference, without downloading it."""
+    _, blob_name = parse_ref(ref)
+    return blob_name.rsplit("/", 1)[-1].split(".", 1)[0]
+
+
+def _ensure_container(blob_service_client, container):
+    if container in _created_containers:
+        return
+    try:
+        blob_service_client.get_container_client(container).create_container()
+    except ResourceExistsError:
+        pass
+    _created_containers.add(container)
+
+
+def _remember(ref, data):
+    global _cache_size
+    max_bytes = int(
+        os.environ.get("ARTIFACT_CACHE_BYTES", DEFAULT_ARTIFACT_CACHE_BYTES)
+    )
+    if len(data) > max_bytes:
+        return
+    with _cache_lock:
+        if ref in _cache:
+            return
+        _cache[ref] = data
+        _cache_size += len(data)
+        while _cache_size > max_bytes:
+            _, evicted = _cache.popitem(last=False)
+            _cache_size -= len(evicted)
+
+
+def put_artifact(data, content_type="application/octet-stream"):
+    """
+    Store bytes in the scratch container under their content hash and return the
+    reference. Uploads are skipped when the same content was already stored.
+    """
+    extension = _EXTENSIONS.get(content_type, "bin")
+    container = artifact_container()
+    blob_name = f"{content_hash(data)}.{extension}"
+    ref = make_ref(container, blob_name)
+
+    blob_service_client = clients.get_blob_service_client()
+    _ensure_container(blob_service_client, container)
+    blob_client = blob_service_client.get_blob_client(
+        container=container, blob=blob_name
+    )
+    try:
+        blob_client.upload_blob(
+            data,
+            overwrite=False,
+            content_settings=ContentSettings(content_type=content_type),
+        )
+    except ResourceExistsError:
+        logging.info(f"Artifact {blob_name} already stored")
+    _remember(ref, data)
+    return ref
+
+
+async def put_artifact_async(data, content_type="application/octet-stream"):
+    """Asynchronous version of put_artifact."""
+    extension = _EXTENSIONS.get(content_type, "bin")
+    container = artifact_container()
+    blob_name = f"{content_hash(data)}.{extension}"
+    ref = make_ref(container, blob_name)
+
+    blob_service_client = clients.get_async_blob_service_client()
+    if container not in _created_containers:
+        try:
+            await blob_service_client.get_container_client(container).create_container()
+        except ResourceExistsError:
+            pass
+        _created_containers.add(container)
+    blob_client = blob_service_client.get_blob_client(
+        container=container, blob=blob_name
+    )
+    try:
+        await blob_client.upload_blob(
+            data,
+            overwrite=False,
+            content_settings=ContentSettings(content_type=content_type),
+        )
+    except ResourceExistsError:
+        logging.info(f"Artifact {blob_name} already stored")
+    _remember(ref, data)
+    return ref
+
+
+def get_artifact(ref):
+    """Download the bytes of an artifact, using the in-memory cache when possible."""
+    with _cache_lock:
+        if ref in _cache:
+            _cache.move_to_end(ref)
+            return _cache[ref]
+    container, blob_name = parse_ref(ref)
+    blob_client = clients.get_blob_service_client().get_blob_client(
+        container=container, blob=blob_name
+    )
+    data = blob_client.download_blob().readall()
+    _remember(ref, data)
+    return data
+
+
+def load_bytes(value):
+    """Return the bytes of an image given as an artifact reference, data URL or base64."""
+    if is_artifact_ref(value):
+        return get_artifact(value)
+    if value.startswith("data:"):
+        value = value.split(",", 1)[1]
+    return base64.b64decode(value)
+
+
+def content_type_of(ref):
+    """Guess the content type of an artifact from its extension."""
+    extension = ref.rsplit(".", 1)[-1].lower()
+    for content_type, known_extension in _EXTENSIONS.items():
+        if known_extension == extension:
+            return content_type
+    return "application/octet-stream"
+
+
+def hash_image(value):
+    """Content hash of an image given as an artifact reference, data URL or base64."""
+    if is_artifact_ref(value):
+        return ref_hash(value)
+    return content_hash(load_bytes(value))
+
+
+def to_data_url(value, content_type="image/jpeg"):
+    """Resolve an artifact reference into a data URL, other values are passed through."""
+    if is_artifact_ref(value):
+        data = get_artifact(value)
+        encoded = base64.b64encode(data).decode("utf-8")
+        return f"data:{content_type_of(value)};base64,{encoded}"
+    if value.startswith("data:"):
+        return value
+    return f"data:{content_type};base64,{value}"
@@ -0,0 +1,324 @@
+"""
+Process-level registry of the Azure SDK clients used by the activities.
+
+Clients are created lazily on first use and then shared by every activity
+invocation of the worker process, so their HTTP connection pools and TLS
+sessions are reused. A client is recreated when the application settings it
+depends on change. Pool sizes and timeouts are configured with:
+
+- HTTP_POOL_SIZE: maximum number of pooled connections per client (default 100)
+- HTTP_CONNECT_TIMEOUT: connection timeout in seconds (default 10)
+- HTTP_READ_TIMEOUT: read timeout in seconds (default 300)
+- OPENAI_MAX_RETRIES: retries of the Azure OpenAI client itself (default 0, the
+  calls are retried by shared_code.rate_limit, which adapts to the throttling)
+
+The asynchronous clients are bound to the event loop they were created in, and
+are recreated for another event loop. Tests and benchmarks plug stand-in
+backends in with registry.override.
+"""
+
+import asyncio
+import inspect
+import logging
+import os
+import threading
+
+import aiohttp
+import httpx
+import requests
+from azure.cognitiveservices.vision.customvision.prediction import (
+    CustomVisionPredictionClient,
+)
+from azure.core.pipeline.transport import AioHttpTransport, RequestsTransport
+from azure.storage.blob import BlobServiceClient
+from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
+from msrest.authentication import ApiKeyCredentials
+from openai import (
+    AsyncAzureOpenAI,
+    AzureOpenAI,
+    DefaultAsyncHttpxClient,
+    DefaultHttpxClient,
+)
+
+# Azure OpenAI API version used for the chat completions
+OPENAI_API_VERSION = "2024-02-01"
+
+DEFAULT_POOL_SIZE = 100
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 300
+DEFAULT_OPENAI_MAX_RETRIES = 0
+
+
+class ClientRegistry:
+    """Thread-safe cache of clients, keyed by name and by the settings used."""
+
+    def __init__(self):
+        self._clients = {}
+        self._overrides = {}
+        self._lock = threading.Lock()
+
+    def get(self, name, settings, factory):
+        """Return the client for these settings, creating it with factory if needed."""
+        with self._lock:
+            factory = self._overrides.get(name, factory)
+            entry = self._clients.get(name)
+            if entry is not None and entry[0] == settings:
+                return entry[1]
+            if entry is not None:
+                logging.info(f"Settings of the {name} client changed, recreating it")
+                _close(entry[1], _loop_of(entry[0]))
+            client = factory(*settings)
+            self._clients[name] = (settings, client)
+            return client
+
+    def override(self, name, factory):
+        """
+        Create the name client ("blob", "custom_vision", "openai", "async_blob",
+        "async_openai" or "onnx_detector") with factory instead of the default
+        one. The factory is called with the same settings, None restores the
+        default factory.
+        """
+        with self._lock:
+            if factory is None:
+                self._overrides.pop(name, None)
+            else:
+                self._overrides[name] = factory
+            entry = self._clients.pop(name, None)
+            if entry is not None:
+                _close(entry[1], _loop_of(entry[0]))
+
+    def clear(self):
+        """Close and forget all the clients, they are recreated on next use."""
+        with self._lock:
+            for settings, client in self._clients.values():
+                _close(client, _loop_of(settings))
+            self._clients.clear()
+
+
+async def _wait(awaitable):
+    return await awaitable
+
+
+# Tasks closing asynchronous clients, referenced until they complete
+_closing_tasks = set()
+
+
+def _loop_of(settings):
+    """Event loop an asynchronous client was created in, the last of its settings."""
+    if settings and isinstance(settings[-1], asyncio.AbstractEventLoop):
+        return settings[-1]
+    return None
+
+
+def _running_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+def _run_until_complete(awaitable, loop=None):
+    """
+    Run an awaitable to completion on an idle event loop, or on a new one, in a
+    helper thread when an event loop already runs in this one.
+    """
+
+    def run():
+        if loop is None:
+            asyncio.run(_wait(awaitable))
+        else:
+            loop.run_until_complete(_wait(awaitable))
+
+    if _running_loop() is None:
+        run()
+        return
+    errors = []
+
+    def run_in_thread():
+        try:
+            run()
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run_in_thread)
+    thread.start()
+    thread.join()
+    if errors:
+        raise errors[0]
+
+
+def _close(client, loop=None):
+    """
+    Close a client. Asynchronous clients are closed on the event loop they were
+    created in: by a task kept until it completes when that loop runs in this
+    thread, from this thread when it runs in another one, and run to completion
+    when it is idle. Only the clients of a closed loop are closed on a new one.
+    """
+    close = getattr(client, "close", None)
+    if close is None:
+        return
+    try:
+        closing = close()
+        if not inspect.isawaitable(closing):
+            return
+        if loop is None or loop.is_closed():
+            _run_until_complete(closing)
+        elif _running_loop() is loop:
+            task = loop.create_task(_wait(closing))
+            _closing_tasks.add(task)
+            task.add_done_callback(_closing_tasks.discard)
+        elif loop.is_running():
+            asyncio.run_coroutine_threadsafe(_wait(closing), loop)
+        else:
+            _run_until_complete(closing, loop)
+    except Exception as e:
+        logging.warning(f"Error closing client: {e}")
+
+
+registry = ClientRegistry()
+
+
+def http_settings():
+    """Connection pool size and timeouts shared by all the clients."""
+    return (
+        int(os.environ.get("HTTP_POOL_SIZE", DEFAULT_POOL_SIZE)),
+        float(os.environ.get("HTTP_CONNECT_TIMEOUT", DEFAULT_CONNECT_TIMEOUT)),
+        float(os.environ.get("HTTP_READ_TIMEOUT", DEFAULT_READ_TIMEOUT)),
+    )
+
+
+def pooled_session(pool_size):
+    """requests session keeping up to pool_size connections alive per host."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _create_blob_service_client(
+    connection_string, pool_size, connect_timeout, read_timeout
+):
+    transport = RequestsTransport(
+        session=pooled_session(pool_size),
+        session_owner=True,
+        connection_timeout=connect_timeout,
+        read_timeout=read_timeout,
+    )
+    return BlobServiceClient.from_connection_string(
+        connection_string, transport=transport
+    )
+
+
+def get_blob_service_client():
+    """Shared BlobServiceClient for BLOB_CONNECTION_STRING."""
+    settings = (os.environ["BLOB_CONNECTION_STRING"], *http_settings())
+    return registry.get("blob", settings, _create_blob_service_client)
+
+
+def _create_custom_vision_client(
+    endpoint, key, pool_size, connect_timeout, read_timeout
+):
+    credentials = ApiKeyCredentials(in_headers={"Prediction-key": key})
+    client = CustomVisionPredictionClient(endpoint, credentials)
+    client.config.connection.timeout = (connect_timeout, read_timeout)
+    # msrest closes its requests session after every call unless kept alive.
+    # Sessions are per thread, so pool_size does not apply to this client.
+    client.config.keep_alive = True
+    return client
+
+
+def get_custom_vision_client():
+    """Shared CustomVisionPredictionClient for the prediction endpoint."""
+    settings = (
+        os.environ["CUSTOM_VISION_PREDICTION_URL"],
+        os.environ["CUSTOM_VISION_PREDICTION_KEY"],
+        *http_settings(),
+    )
+    return registry.get("custom_vision", settings, _create_custom_vision_client)
+
+
+def _create_openai_client(
+    endpoint, key, max_retries, pool_size, connect_timeout, read_timeout
+):
+    http_client = DefaultHttpxClient(
+        limits=httpx.Limits(
+            max_connections=pool_size, max_keepalive_connections=pool_size
+        ),
+        timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+    )
+    return AzureOpenAI(
+        azure_endpoint=endpoint,
+        api_key=key,
+        api_version=OPENAI_API_VERSION,
+        max_retries=max_retries,
+        http_client=http_client,
+    )
+
+
+def get_openai_client():
+    """Shared AzureOpenAI client for OPENAI_ENDPOINT."""
+    settings = (
+        os.environ["OPENAI_ENDPOINT"],
+        os.environ["OPENAI_KEY"],
+        int(os.environ.get("OPENAI_MAX_RETRIES", DEFAULT_OPENAI_MAX_RETRIES)),
+        *http_settings(),
+    )
+    return registry.get("openai", settings, _create_openai_client)
+
+
+def _create_async_blob_service_client(
+    connection_string, pool_size, connect_timeout, read_timeout, loop
+):
+    session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=pool_size))
+    transport = AioHttpTransport(
+        session=session,
+        session_owner=True,
+        connection_timeout=connect_timeout,
+        read_timeout=read_timeout,
+    )
+    return AsyncBlobServiceClient.from_connection_string(
+        connection_string, transport=transport
+    )
+
+
+def get_async_blob_service_client():
+    """Shared asynchronous BlobServiceClient of the running event loop."""
+    settings = (
+        os.environ["BLOB_CONNECTION_STRING"],
+        *http_settings(),
+        asyncio.get_running_loop(),
+    )
+    return registry.get("async_blob", settings, _create_async_blob_service_client)
+
+
+def _create_async_openai_client(
+    endpoint, key, max_retries, pool_size, connect_timeout, read_timeout, loop
+):
+    http_client = DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=pool_size, max_keepalive_connections=pool_size
+        ),
+        timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+    )
+    return AsyncAzureOpenAI(
+        azure_endpoint=endpoint,
+        api_key=key,
+        api_version=OPENAI_API_VERSION,
+        max_retries=max_retries,
+        http_client=http_client,
+    )
+
+
+def get_async_openai_client():
+    """Shared AsyncAzureOpenAI client of the running event loop."""
+    settings = (
+        os.environ["OPENAI_ENDPOINT"],
+        os.environ["OPENAI_KEY"],
+        int(os.environ.get("OPENAI_MAX_RETRIES", DEFAULT_OPENAI_MAX_RETRIES)),
+        *http_settings(),
+        asyncio.get_running_loop(),
+    )
+    return registry.get("async_openai", settings, _create_async_openai_client)
@@ -0,0 +1,74 @@
+"""
+Perceptual hashing of the cropped symbols, used to analyze near-identical
+symbols only once.
+
+Each crop is reduced to a 64-bit difference hash (dHash): the grayscale crop is
+resized to 9x8 pixels and every bit tells whether a pixel is brighter than its
+right neighbour. Crops whose hashes differ by at most ``threshold`` bits are
+considered the same symbol.
+"""
+
+from PIL import Image
+
+HASH_SIZE = 8
+
+
+def difference_hash(image, hash_size=HASH_SIZE):
+    """Return the difference hash of a PIL image as an integer."""
+    small = image.convert("L").resize(
+        (hash_size + 1, hash_size), Image.Resampling.LANCZOS
+    )
+    pixels = small.tobytes()
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def format_hash(image_hash, hash_size=HASH_SIZE):
+    """Hexadecimal form of a hash, as exchanged between orchestrations."""
+    return f"{image_hash:0{hash_size * hash_size // 4}x}"
+
+
+def hamming_distance(hash_a, hash_b):
+    """Number of bits that differ between two hashes."""
+    return bin(hash_a ^ hash_b).count("1")
+
+
+def cluster_hashes(hashes, tags, threshold):
+    """
+    Greedily cluster the hashes of each tag. Returns, for every item, the index
+    of the item representing its cluster (the first item of the cluster).
+    """
+    leaders = {}
+    representatives = []
+    for index, (image_hash, tag) in enumerate(zip(hashes, tags)):
+        for leader in leaders.setdefault(tag, []):
+            if hamming_distance(image_hash, hashes[leader]) <= threshold:
+                representatives.append(leader)
+                break
+        else:
+            leaders[tag].append(index)
+            representatives.append(index)
+    return representatives
+
+
+def match_known(hashes, tags, known_hashes, known_tags, threshold):
+    """
+    Index of the first known hash of the same tag within threshold bits of each
+    hash, or None when there is none.
+    """
+    known_by_tag = {}
+    for index, tag in enumerate(known_tags):
+        known_by_tag.setdefault(tag, []).append(index)
+    matches = []
+    for image_hash, tag in zip(hashes, tags):
+        for index in known_by_tag.get(tag, []):
+            if hamming_distance(image_hash, known_hashes[index]) <= threshold:
+                matches.append(index)
+                break
+        else:
+            matches.append(None)
+    return matches
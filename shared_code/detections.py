@@ -0,0 +1,297 @@
+"""
+Geometry helpers for the object detections.
+
+Bounding boxes are normalized to the full image, as returned by Custom Vision:
+``left``, ``top``, ``width`` and ``height`` between 0 and 1. DetectionTable holds
+the detections of an image as columns, so that they are filtered, deduplicated
+and summarized with array operations and exchanged in a compact form.
+"""
+
+import json
+
+import numpy as np
+
+
+def _tile_starts(length, tile_size, overlap):
+    """Start positions of the tiles along one side of length pixels."""
+    if length <= tile_size:
+        return [0]
+    step = tile_size - min(overlap, tile_size // 2)
+    positions = list(range(0, length - tile_size, step))
+    positions.append(length - tile_size)
+    return positions
+
+
+def plan_tiles(width, height, tile_size, overlap):
+    """
+    Split an image into overlapping square tiles of at most tile_size pixels.
+    Returns the pixel boxes (left, top, right, bottom) of the tiles.
+    """
+    return [
+        (left, top, min(left + tile_size, width), min(top + tile_size, height))
+        for top in _tile_starts(height, tile_size, overlap)
+        for left in _tile_starts(width, tile_size, overlap)
+    ]
+
+
+def plan_tile_cores(width, height, tile_size, overlap):
+    """
+    Pixel boxes of the cores of the tiles of plan_tiles, in the same order. The
+    overlaps between neighbouring tiles are split in their middle, so the cores
+    cover the image without overlapping and every detection belongs to the one
+    tile whose core holds its center.
+    """
+
+    def spans(length):
+        starts = _tile_starts(length, tile_size, overlap)
+        cuts = [
+            (start + min(previous + tile_size, length)) / 2
+            for previous, start in zip(starts, starts[1:])
+        ]
+        edges = [0, *cuts, length]
+        return list(zip(edges, edges[1:]))
+
+    return [
+        (left, top, right, bottom)
+        for top, bottom in spans(height)
+        for left, right in spans(width)
+    ]
+
+
+def to_image_coordinates(bounding_box, region):
+    """Map a box normalized to a tile onto the full image, given the tile region."""
+    return {
+        "left": region["left"] + bounding_box["left"] * region["width"],
+        "top": region["top"] + bounding_box["top"] * region["height"],
+        "width": bounding_box["width"] * region["width"],
+        "height": bounding_box["height"] * region["height"],
+    }
+
+
+def to_region_coordinates(bounding_box, region):
+    """Inverse of to_image_coordinates: map a box of the full image onto a tile."""
+    return {
+        "left": (bounding_box["left"] - region["left"]) / region["width"],
+        "top": (bounding_box["top"] - region["top"]) / region["height"],
+        "width": bounding_box["width"] / region["width"],
+        "height": bounding_box["height"] / region["height"],
+    }
+
+
+def non_max_suppression(boxes, scores, iou_threshold, class_ids=None):
+    """
+    Greedy non-maximum suppression over (N, 4) arrays of left, top, width, height
+    boxes. When class_ids are given, boxes of different classes never suppress
+    each other. Returns the indices of the kept boxes, by decreasing score.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    scores = np.asarray(scores, dtype=np.float64)
+    if len(boxes) == 0:
+        return np.empty(0, dtype=np.int64)
+
+    x1, y1 = boxes[:, 0], boxes[:, 1]
+    x2, y2 = x1 + boxes[:, 2], y1 + boxes[:, 3]
+    if class_ids is not None:
+        # Shift each class to its own region so that classes never overlap
+        offset = np.asarray(class_ids, dtype=np.float64) * (max(x2.max(), 1.0) + 1.0)
+        x1, x2 = x1 + offset, x2 + offset
+    areas = (x2 - x1) * (y2 - y1)
+
+    order = np.argsort(-scores, kind="stable")
+    keep = []
+    while order.size:
+        best, rest = order[0], order[1:]
+        keep.append(best)
+        inter_width = np.clip(
+            np.minimum(x2[best], x2[rest]) - np.maximum(x1[best], x1[rest]), 0, None
+        )
+        inter_height = np.clip(
+            np.minimum(y2[best], y2[rest]) - np.maximum(y1[best], y1[rest]), 0, None
+        )
+        intersection = inter_width * inter_height
+        union = areas[best] + areas[rest] - intersection
+        iou = np.divide(
+            intersection, union, out=np.zeros_like(intersection), where=union > 0
+        )
+        order = rest[iou <= iou_threshold]
+    return np.asarray(keep, dtype=np.int64)
+
+
+# Upper bounds of the bins of the area histogram, as fractions of the image area
+AREA_BINS = (0.0001, 0.001, 0.01, 0.1, 1.0)
+
+
+class DetectionTable:
+    """
+    Columnar detections: (N, 4) left, top, width, height boxes, (N,) scores and
+    (N,) indices of their tag in tags. Filtering, non-maximum suppression and
+    the per-tag statistics are vectorized over the columns.
+    """
+
+    def __init__(self, boxes, scores, tag_ids, tags):
+        self.boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        self.scores = np.asarray(scores, dtype=np.float64)
+        self.tag_ids = np.asarray(tag_ids, dtype=np.int64)
+        self.tags = list(tags)
+
+    @classmethod
+    def from_predictions(cls, predictions):
+        """Build a table from prediction dictionaries or their JSON strings."""
+        predictions = [
+            json.loads(prediction) if isinstance(prediction, str) else prediction
+            for prediction in predictions
+        ]
+        tags = sorted({prediction["tag"] for prediction in predictions})
+        tag_index = {tag: index for index, tag in enumerate(tags)}
+        return cls(
+            [
+                [
+                    prediction["bounding_box"]["left"],
+                    prediction["bounding_box"]["top"],
+                    prediction["bounding_box"]["width"],
+                    prediction["bounding_box"]["height"],
+                ]
+                for prediction in predictions
+            ],
+            [prediction["probability"] for prediction in predictions],
+            [tag_index[prediction["tag"]] for prediction in predictions],
+            tags,
+        )
+
+    @classmethod
+    def from_dict(cls, data):
+        """Inverse of to_dict."""
+        return cls(data["boxes"], data["scores"], data["tag_ids"], data["tags"])
+
+    def to_dict(self, decimals=6):
+        """Compact JSON-serializable form: one list per column."""
+        return {
+            "tags": self.tags,
+            "tag_ids": self.tag_ids.tolist(),
+            "scores": np.round(self.scores, decimals).tolist(),
+            "boxes": np.round(self.boxes, decimals).tolist(),
+        }
+
+    def __len__(self):
+        return len(self.scores)
+
+    def select(self, indices):
+        """Table of the rows given by an index array or a boolean mask."""
+        return DetectionTable(
+            self.boxes[indices], self.scores[indices], self.tag_ids[indices], self.tags
+        )
+
+    def filter(self, min_probability):
+        """Rows whose score is at least min_probability."""
+        return self.select(self.scores >= min_probability)
+
+    def within(self, region):
+        """
+        Rows whose box center lies in a normalized region, its left and top edges
+        included and its right and bottom edges excluded.
+        """
+        centers_x = self.boxes[:, 0] + self.boxes[:, 2] / 2
+        centers_y = self.boxes[:, 1] + self.boxes[:, 3] / 2
+        return self.select(
+            (centers_x >= region["left"])
+            & (centers_x < region["left"] + region["width"])
+            & (centers_y >= region["top"])
+            & (centers_y < region["top"] + region["height"])
+        )
+
+    def nms(self, iou_threshold):
+        """Remove the duplicate boxes of each tag, keeping the best one."""
+        if iou_threshold is None or len(self) == 0:
+            return self
+        keep = non_max_suppression(
+            self.boxes, self.scores, iou_threshold, class_ids=self.tag_ids
+        )
+        return self.select(np.sort(keep))
+
+    def sort(self):
+        """Rows grouped by tag, by decreasing score within each tag."""
+        return self.select(np.lexsort((-self.scores, self.tag_ids)))
+
+    def to_predictions(self):
+        """Prediction dictionaries of the rows, in order."""
+        return [
+            {
+                "tag": self.tags[tag_id],
+                "probability": score,
+                "bounding_box": {
+                    "left": box[0],
+                    "top": box[1],
+                    "width": box[2],
+                    "height": box[3],
+                },
+            }
+            for box, score, tag_id in zip(
+                self.boxes.tolist(), self.scores.tolist(), self.tag_ids.tolist()
+            )
+        ]
+
+    def tag_stats(self, area_bins=AREA_BINS):
+        """
+        Count, mean, min and max score, and histogram of the box areas (counts per
+        bin of area_bins) of each tag.
+        """
+        tag_count = len(self.tags)
+        counts = np.bincount(self.tag_ids, minlength=tag_count)
+        sums = np.bincount(self.tag_ids, weights=self.scores, minlength=tag_count)
+        minimums = np.full(tag_count, np.inf)
+        maximums = np.full(tag_count, -np.inf)
+        np.minimum.at(minimums, self.tag_ids, self.scores)
+        np.maximum.at(maximums, self.tag_ids, self.scores)
+        areas = self.boxes[:, 2] * self.boxes[:, 3]
+        area_bin = np.minimum(
+            np.searchsorted(area_bins, areas, side="left"), len(area_bins) - 1
+        )
+        histogram = np.bincount(
+            self.tag_ids * len(area_bins) + area_bin,
+            minlength=tag_count * len(area_bins),
+        ).reshape(tag_count, len(area_bins))
+        return {
+            tag: {
+                "count": int(counts[index]),
+                "mean_probability": float(sums[index] / counts[index]),
+                "min_probability": float(minimums[index]),
+                "max_probability": float(maximums[index]),
+                "area_histogram": histogram[index].tolist(),
+            }
+            for index, tag in enumerate(self.tags)
+            if counts[index]
+        }
+
+
+def merge_tag_stats(partial_stats):
+    """
+    Per-tag statistics of a set of detections from the tag_stats of its disjoint
+    parts: counts and histograms are added, means weighted by the counts.
+    """
+    merged = {}
+    for stats in partial_stats:
+        for tag, tag_stats in stats.items():
+            if tag not in merged:
+                merged[tag] = {
+                    **tag_stats,
+                    "area_histogram": list(tag_stats["area_histogram"]),
+                }
+                continue
+            total = merged[tag]
+            count = total["count"] + tag_stats["count"]
+            total["mean_probability"] = (
+                total["mean_probability"] * total["count"]
+                + tag_stats["mean_probability"] * tag_stats["count"]
+            ) / count
+            total["count"] = count
+            total["min_probability"] = min(
+                total["min_probability"], tag_stats["min_probability"]
+            )
+            total["max_probability"] = max(
+                total["max_probability"], tag_stats["max_probability"]
+            )
+            total["area_histogram"] = [
+                a + b
+                for a, b in zip(total["area_histogram"], tag_stats["area_histogram"])
+            ]
+    return dict(sorted(merged.items()))
@@ -0,0 +1,359 @@
+"""
+Memory-bounded reading of the floor plan images.
+
+Scanned plans can reach hundreds of megapixels, several gigabytes once decoded.
+Plans are downloaded in chunks to an anonymous temporary file rather than into
+memory, and their size is read from the file header without decoding them.
+Plans larger than MAX_IMAGE_PIXELS are replaced by a downscaled working copy for
+the detection of whole plans, which records the size of its plan in its comment.
+The tiles and the crops are cut out of the original plan at full resolution, by
+decoding the regions they cover. 8-bit PNG plans are decoded by bands of rows,
+so that only a band and the regions overlapping it are held in memory, and
+their working copy is averaged from the same bands. JPEG plans are decoded at a
+reduced scale (draft mode) for their working copy. Pillow cannot decode a part
+of a JPEG or of the other formats, they are decoded whole when regions are cut
+out of them, the JPEG plans at the largest scale within MAX_DECODE_PIXELS.
+Bounding boxes are normalized to the image, so the detections of the working
+copy apply to the original unchanged.
+
+Pillow's own decompression bomb limit (Image.MAX_IMAGE_PIXELS) is only raised to
+MAX_SOURCE_PIXELS while open_image reads the header of a plan, and restored
+right after, the plans being checked against MAX_SOURCE_PIXELS instead.
+
+- MAX_IMAGE_PIXELS: largest working copy, in pixels
+- MAX_DECODE_PIXELS: largest JPEG plan decoded at full resolution to cut
+  regions out of it
+- MAX_SOURCE_PIXELS: largest plan accepted, larger ones are rejected as
+  decompression bombs
+- BLOB_DOWNLOAD_CONCURRENCY: parallel chunk downloads of a plan
+"""
+
+import contextlib
+import logging
+import math
+import os
+import struct
+import tempfile
+import threading
+import zlib
+from io import BytesIO
+
+from PIL import Image, PngImagePlugin
+
+from shared_code import metrics
+
+DEFAULT_MAX_IMAGE_PIXELS = 40_000_000
+DEFAULT_MAX_SOURCE_PIXELS = 1_000_000_000
+DEFAULT_MAX_DECODE_PIXELS = 100_000_000
+DEFAULT_DOWNLOAD_CONCURRENCY = 4
+WORKING_COPY_JPEG_QUALITY = 90
+# Decoded bytes of a band of rows, and compressed bytes read at a time
+BAND_BYTES = 4 * 1024 * 1024
+READ_BYTES = 1024 * 1024
+# Channels of the PNG color types decoded by bands: gray, RGB, gray with alpha
+# and RGBA, the palette images being decoded whole
+_PNG_CHANNELS = {0: 1, 2: 3, 4: 2, 6: 4}
+# Comment of the working copies, followed by the size of their plan
+PLAN_SIZE_COMMENT = "plan_size="
+
+
+def max_image_pixels():
+    return int(os.environ.get("MAX_IMAGE_PIXELS", DEFAULT_MAX_IMAGE_PIXELS))
+
+
+def max_decode_pixels():
+    return int(os.environ.get("MAX_DECODE_PIXELS", DEFAULT_MAX_DECODE_PIXELS))
+
+
+def max_source_pixels():
+    return int(os.environ.get("MAX_SOURCE_PIXELS", DEFAULT_MAX_SOURCE_PIXELS))
+
+
+def _download_concurrency():
+    return int(
+        os.environ.get("BLOB_DOWNLOAD_CONCURRENCY", DEFAULT_DOWNLOAD_CONCURRENCY)
+    )
+
+
+def download_to_file(blob_client):
+    """Download a blob in chunks to a temporary file, returned rewound."""
+    spool = tempfile.TemporaryFile()
+    blob_client.download_blob(max_concurrency=_download_concurrency()).readinto(spool)
+    spool.seek(0)
+    return spool
+
+
+async def download_to_file_async(blob_client):
+    """Asynchronous version of download_to_file, using an aio blob client."""
+    spool = tempfile.TemporaryFile()
+    downloader = await blob_client.download_blob(
+        max_concurrency=_download_concurrency()
+    )
+    await downloader.readinto(spool)
+    spool.seek(0)
+    return spool
+
+
+_pixel_limit_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def source_pixel_limit():
+    """
+    Pillow's decompression bomb limit raised to MAX_SOURCE_PIXELS, and restored
+    on exit. Only the headers of the plans should be read within it.
+    """
+    with _pixel_limit_lock:
+        previous = Image.MAX_IMAGE_PIXELS
+        if previous is not None:
+            Image.MAX_IMAGE_PIXELS = max(previous, max_source_pixels())
+        try:
+            yield
+        finally:
+            Image.MAX_IMAGE_PIXELS = previous
+
+
+def open_image(source):
+    """
+    Open an image lazily, only its header is read. Raises ValueError when it has
+    more than MAX_SOURCE_PIXELS pixels.
+    """
+    source.seek(0)
+    try:
+        with source_pixel_limit():
+            image = Image.open(source)
+    except Image.DecompressionBombError as e:
+        raise ValueError(f"Image exceeds MAX_SOURCE_PIXELS: {e}") from e
+    if image.width * image.height > max_source_pixels():
+        raise ValueError(
+            f"Image of {image.width}x{image.height} pixels exceeds MAX_SOURCE_PIXELS"
+        )
+    return image
+
+
+def plan_size(image):
+    """Size of the plan of a working copy made by read_plan, None for other images."""
+    comment = image.info.get("comment", "")
+    if isinstance(comment, bytes):
+        comment = comment.decode("latin-1")
+    if not comment.startswith(PLAN_SIZE_COMMENT):
+        return None
+    width, height = comment[len(PLAN_SIZE_COMMENT) :].split("x")
+    return int(width), int(height)
+
+
+def _png_channels(image, source):
+    """
+    Channels of a PNG image decodable by bands: 8-bit, not interlaced and not
+    palette based. None for the other images.
+    """
+    if image.format != "PNG":
+        return None
+    # The IHDR chunk follows the signature
+    source.seek(16)
+    _, _, depth, color_type, _, _, interlace = struct.unpack(
+        ">IIBBBBB", source.read(13)
+    )
+    if depth != 8 or interlace or color_type not in _PNG_CHANNELS:
+        return None
+    return _PNG_CHANNELS[color_type]
+
+
+def _png_data(source):
+    """Compressed rows of a PNG file: the content of its IDAT chunks, in pieces."""
+    source.seek(8)
+    while True:
+        header = source.read(8)
+        if len(header) < 8:
+            return
+        length, chunk_type = struct.unpack(">I4s", header)
+        if chunk_type == b"IEND":
+            return
+        if chunk_type != b"IDAT":
+            source.seek(length + 4, os.SEEK_CUR)
+            continue
+        while length:
+            data = source.read(min(length, READ_BYTES))
+            if not data:
+                return
+            length -= len(data)
+            yield data
+        # CRC of the chunk
+        source.seek(4, os.SEEK_CUR)
+
+
+def _png_bands(image, source, channels, band_rows):
+    """
+    (top, band) of the rows of a PNG image, decoded band_rows at a time. Each
+    band is inflated as needed and unfiltered by Pillow's PNG decoder after the
+    last row of the band above, which the filters of its first row refer to.
+    """
+    row_bytes = 1 + image.width * channels
+    inflater = zlib.decompressobj()
+    compressed = _png_data(source)
+    # Filter type 0 and the row above the first one, zeros in PNG
+    above = bytes(row_bytes)
+    for top in range(0, image.height, band_rows):
+        rows = min(band_rows, image.height - top)
+        needed = rows * row_bytes
+        # Pillow's decoder takes a zlib stream, the rows are stored uncompressed
+        stored = zlib.compressobj(0)
+        parts = [stored.compress(above)]
+        size = 0
+        while size < needed:
+            data = inflater.unconsumed_tail or next(compressed, b"")
+            if not data:
+                raise ValueError("Truncated PNG image data")
+            part = inflater.decompress(data, needed - size)
+            parts.append(stored.compress(part))
+            size += len(part)
+        parts.append(stored.flush())
+        band = Image.frombytes(
+            image.mode, (image.width, rows + 1), b"".join(parts), "zip", image.mode
+        )
+        del parts
+        above = b"\0" + band.crop((0, rows, image.width, rows + 1)).tobytes()
+        yield top, band.crop((0, 1, image.width, rows + 1))
+
+
+def iter_bands(image, source, multiple=1):
+    """
+    (top, band) of the rows of an image opened lazily from a file object, the
+    band heights being a multiple of multiple. 8-bit PNG images are decoded by
+    bands of about BAND_BYTES, the other images whole as a single band.
+    """
+    channels = _png_channels(image, source)
+    if channels is None:
+        image.load()
+        yield 0, image
+        return
+    band_rows = BAND_BYTES // (image.width * channels)
+    yield from _png_bands(
+        image, source, channels, max(multiple, band_rows - band_rows % multiple)
+    )
+
+
+def crop_regions(source, boxes):
+    """
+    Regions (left, top, right, bottom) of an image read from a file object, in
+    pixels. Yields (index, region) as soon as the bands covering a region have
+    been decoded, so that only the regions overlapping a band are held. JPEG
+    images above MAX_DECODE_PIXELS are decoded at the largest DCT scale within
+    it, their regions being scaled accordingly.
+    """
+    image = open_image(source)
+    factor = reduction_factor(image.width, image.height, max_decode_pixels())
+    if factor > 1 and image.format == "JPEG":
+        # The scales of the DCT are powers of two
+        width = image.width
+        scale = 2 ** math.ceil(math.log2(factor))
+        image.draft(
+            "L" if image.mode == "L" else "RGB",
+            (image.width // scale, image.height // scale),
+        )
+        ratio = image.width / width
+        boxes = [tuple(round(side * ratio) for side in box) for box in boxes]
+    waiting = sorted(range(len(boxes)), key=lambda index: boxes[index][1])
+    spanning = {}
+    for top, band in iter_bands(image, source):
+        bottom = top + band.height
+        while waiting and boxes[waiting[0]][1] < bottom:
+            index = waiting.pop(0)
+            left, region_top, right, region_bottom = boxes[index]
+            if region_bottom <= bottom:
+                yield index, band.crop(
+                    (left, region_top - top, right, region_bottom - top)
+                )
+            else:
+                # Only the modes decoded by bands reach here, which have no palette
+                spanning[index] = Image.new(
+                    band.mode, (right - left, region_bottom - region_top)
+                )
+                spanning[index].paste(
+                    band.crop((left, region_top - top, right, band.height)), (0, 0)
+                )
+        for index, region in list(spanning.items()):
+            left, region_top, right, region_bottom = boxes[index]
+            if region_top >= top:
+                continue
+            region.paste(
+                band.crop((left, 0, right, min(region_bottom, bottom) - top)),
+                (0, top - region_top),
+            )
+            if region_bottom <= bottom:
+                del spanning[index]
+                yield index, region
+
+
+def reduction_factor(width, height, max_pixels):
+    """Smallest integer factor bringing a width x height image within max_pixels."""
+    return max(1, math.ceil(math.sqrt(width * height / max_pixels)))
+
+
+def working_copy(image, source, max_pixels):
+    """
+    Decoded image downscaled to at most max_pixels, from an image opened lazily
+    from a file object. JPEG images are decoded at the smallest DCT scale above
+    the target size. The rest of the reduction averages blocks of pixels, which
+    unlike a two-pass resize needs no intermediate image larger than the result,
+    band by band for the images decoded by bands.
+    """
+    factor = reduction_factor(image.width, image.height, max_pixels)
+    if factor > 1 and image.format == "JPEG":
+        image.draft(
+            "L" if image.mode == "L" else "RGB",
+            (image.width // factor, image.height // factor),
+        )
+        factor = reduction_factor(image.width, image.height, max_pixels)
+    if factor == 1:
+        image.load()
+        return image
+    if _png_channels(image, source) is None:
+        return image.reduce(factor)
+    copy = Image.new(
+        image.mode,
+        (math.ceil(image.width / factor), math.ceil(image.height / factor)),
+    )
+    for top, band in iter_bands(image, source, factor):
+        copy.paste(band.reduce(factor), (0, top // factor))
+    return copy
+
+
+def read_plan(source, max_pixels=None):
+    """
+    Bytes and content type of a plan read from a file object. Plans within
+    max_pixels (MAX_IMAGE_PIXELS by default) are returned as they are, larger
+    ones as an encoded working copy, in JPEG for JPEG plans and PNG otherwise,
+    whose comment holds the size of the plan (see plan_size).
+    """
+    max_pixels = max_pixels or max_image_pixels()
+    image = open_image(source)
+    content_type = Image.MIME.get(image.format, "application/octet-stream")
+    metrics.record(image_width=image.width, image_height=image.height)
+    if image.width * image.height <= max_pixels:
+        source.seek(0)
+        return source.read(), content_type
+
+    image_format = "JPEG" if image.format == "JPEG" else "PNG"
+    comment = f"{PLAN_SIZE_COMMENT}{image.width}x{image.height}"
+    copy = working_copy(image, source, max_pixels)
+    if image_format == "JPEG" and copy.mode not in ("L", "RGB"):
+        copy = copy.convert("RGB")
+    logging.info(
+        f"Downscaled {image.width}x{image.height} plan to a "
+        f"{copy.width}x{copy.height} working copy"
+    )
+    metrics.record(working_width=copy.width, working_height=copy.height)
+    buffered = BytesIO()
+    if image_format == "JPEG":
+        copy.save(
+            buffered,
+            format="JPEG",
+            quality=WORKING_COPY_JPEG_QUALITY,
+            comment=comment,
+        )
+    else:
+        info = PngImagePlugin.PngInfo()
+        info.add_text("comment", comment)
+        copy.save(buffered, format="PNG", pnginfo=info)
+    return buffered.getvalue(), Image.MIME[image_format]
@@ -0,0 +1,157 @@
+"""
+Instrumentation of the activities and of the orchestration stages.
+
+Activities decorated with instrumented log one structured record per call: its
+duration, payload sizes, image dimensions and Azure OpenAI token usage. The
+fields are passed as custom_dimensions, which Application Insights stores as
+custom properties, so the records can be charted per activity. Code running in
+an activity adds fields to its record with record, and the chat completions
+record their token usage with record_usage.
+
+Activities returning a dict also return the record of the call in its metrics
+entry, and activities returning a list return it in an envelope
+{"result": [...], "metrics": {...}}, unwrapped with result_of, so that the
+items of the list are left as they are. The orchestrator adds up these records
+per stage with stage_metrics, together with the wall time of the stage measured
+with the replay-safe current_utc_datetime, which also covers the time the
+activities were queued and retried.
+"""
+
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import time
+
+METRICS_LOGGER = logging.getLogger("vision_agent.metrics")
+# Fields of the activity record returned to the orchestrator
+RETURNED_FIELDS = (
+    "duration_ms",
+    "output_bytes",
+    "prompt_tokens",
+    "completion_tokens",
+    "image_width",
+    "image_height",
+)
+
+_current = contextvars.ContextVar("activity_metrics", default=None)
+
+
+def record(**fields):
+    """Add fields to the record of the running activity, if any."""
+    fields_so_far = _current.get()
+    if fields_so_far is not None:
+        fields_so_far.update(fields)
+
+
+def record_usage(usage):
+    """Add the token usage of a chat completion to the record of the activity."""
+    fields = _current.get()
+    if fields is None or usage is None:
+        return
+    for name in ("prompt_tokens", "completion_tokens"):
+        fields[name] = fields.get(name, 0) + (getattr(usage, name, 0) or 0)
+
+
+def _attach(result, fields):
+    """
+    Result with the returned fields of the record, in its metrics entry or in
+    an envelope around a list.
+    """
+    returned = {name: fields[name] for name in RETURNED_FIELDS if name in fields}
+    if isinstance(result, dict):
+        return {**result, "metrics": returned}
+    if isinstance(result, list):
+        return {"result": result, "metrics": returned}
+    return result
+
+
+def result_of(value):
+    """Result of an activity, without the envelope of the list results."""
+    if isinstance(value, dict) and value.keys() == {"result", "metrics"}:
+        return value["result"]
+    return value
+
+
+def _start(name, payload):
+    fields = {"activity": name, "input_bytes": len(payload or "")}
+    return fields, _current.set(fields), time.perf_counter()
+
+
+def _finish(fields, token, start, result=None, error=None):
+    _current.reset(token)
+    fields["duration_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    fields["succeeded"] = error is None
+    if error is None:
+        fields["output_bytes"] = len(json.dumps(result))
+    METRICS_LOGGER.info(
+        f"Activity {fields['activity']} took {fields['duration_ms']} ms",
+        extra={"custom_dimensions": fields},
+    )
+    return _attach(result, fields) if error is None else None
+
+
+def instrumented(activity):
+    """Decorator of the activity functions, synchronous or asynchronous."""
+    if inspect.iscoroutinefunction(activity):
+
+        @functools.wraps(activity)
+        async def async_wrapper(activitypayload):
+            fields, token, start = _start(activity.__name__, activitypayload)
+            try:
+                result = await activity(activitypayload)
+            except Exception as e:
+                _finish(fields, token, start, error=e)
+                raise
+            return _finish(fields, token, start, result)
+
+        return async_wrapper
+
+    @functools.wraps(activity)
+    def wrapper(activitypayload):
+        fields, token, start = _start(activity.__name__, activitypayload)
+        try:
+            result = activity(activitypayload)
+        except Exception as e:
+            _finish(fields, token, start, error=e)
+            raise
+        return _finish(fields, token, start, result)
+
+    return wrapper
+
+
+def call_metrics(result):
+    """Record returned by an activity with its result, or the size of the result."""
+    if isinstance(result, dict) and "metrics" in result:
+        return result["metrics"]
+    return {"output_bytes": len(json.dumps(result))}
+
+
+def stage_metrics(stage, started, finished, payloads, calls, concurrency=1):
+    """
+    Metrics of an orchestration stage from the payloads of its activities and
+    their records (see call_metrics). wall_ms runs from the scheduling of the
+    activities to their last result. When every call reported its duration,
+    activity_ms is their total and queue_ms the rest of the wall time, the
+    calls running concurrency at a time.
+    """
+    wall_ms = (finished - started).total_seconds() * 1000
+    entry = {
+        "stage": stage,
+        "calls": len(payloads),
+        "wall_ms": round(wall_ms),
+        "input_bytes": sum(len(payload) for payload in payloads),
+        "output_bytes": sum(call.get("output_bytes", 0) for call in calls),
+    }
+    durations = [call["duration_ms"] for call in calls if "duration_ms" in call]
+    if durations and len(durations) == len(calls):
+        activity_ms = sum(durations)
+        entry["activity_ms"] = round(activity_ms)
+        busy_ms = activity_ms / max(1, min(concurrency, len(calls)))
+        entry["queue_ms"] = max(0, round(wall_ms - busy_ms))
+    for name in ("prompt_tokens", "completion_tokens"):
+        tokens = sum(call.get(name, 0) for call in calls)
+        if tokens:
+            entry[name] = tokens
+    return entry
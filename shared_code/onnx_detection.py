@@ -0,0 +1,222 @@
+"""
+Local object detection with a Custom Vision model exported to ONNX.
+
+Compact Custom Vision object detection models can be exported to ONNX, with a
+labels.txt file listing their tags. The model is loaded once per worker process,
+through the client registry, and run on the CPU with onnxruntime, an optional
+dependency only needed by this backend. It is configured with:
+
+- ONNX_MODEL_PATH: the exported model.onnx file
+- ONNX_LABELS_PATH: the labels file, labels.txt next to the model by default
+- ONNX_INTRA_OP_THREADS: threads used by one inference, all the cores by default
+- ONNX_MIN_PROBABILITY: probability under which detections are dropped
+- ONNX_INPUT_SIZE: side of the input of the models whose input size is not
+  fixed by the export
+
+Images are resized to the input size of the model and converted to the pixel
+layout declared in its metadata, in batches of at most ONNX_BATCH_SIZE images
+(the batch size of the model when it is fixed). The detected boxes, normalized
+to the model input, are normalized to the image as well, so the predictions
+have the same shape as the ones of the Custom Vision prediction endpoint.
+"""
+
+import logging
+import os
+
+import numpy as np
+from PIL import Image
+
+from shared_code import clients, detections
+
+DEFAULT_BATCH_SIZE = 8
+DEFAULT_MIN_PROBABILITY = 0.01
+DEFAULT_INPUT_SIZE = 416
+OUTPUT_NAMES = ("detected_boxes", "detected_scores", "detected_classes")
+
+
+def load_labels(path):
+    with open(path, encoding="utf-8") as labels_file:
+        return [line.strip() for line in labels_file if line.strip()]
+
+
+def preprocess(images, size, bgr=True, range_255=True):
+    """
+    Batch of images as a float32 (N, 3, height, width) array at the input size
+    of the model, in BGR order and 0-255 range unless the model says otherwise.
+    """
+    batch = np.stack(
+        [
+            np.asarray(
+                image.convert("RGB").resize(size, Image.Resampling.BILINEAR),
+                dtype=np.float32,
+            )
+            for image in images
+        ]
+    ).transpose((0, 3, 1, 2))
+    if bgr:
+        batch = batch[:, ::-1]
+    if not range_255:
+        batch = batch / 255.0
+    return np.ascontiguousarray(batch)
+
+
+def to_predictions(boxes, scores, classes, labels, min_probability):
+    """
+    Predictions of one image from the outputs of the model, boxes being
+    normalized (x1, y1, x2, y2) corners.
+    """
+    boxes = np.clip(boxes, 0.0, 1.0)
+    keep = scores >= min_probability
+    return [
+        {
+            "tag": labels[int(tag_id)],
+            "probability": float(score),
+            "bounding_box": {
+                "left": float(x1),
+                "top": float(y1),
+                "width": float(x2 - x1),
+                "height": float(y2 - y1),
+            },
+        }
+        for (x1, y1, x2, y2), score, tag_id in zip(
+            boxes[keep], scores[keep], classes[keep]
+        )
+    ]
+
+
+class OnnxDetector:
+    """Exported Custom Vision model run with an onnxruntime CPU session."""
+
+    def __init__(
+        self,
+        model_path,
+        labels_path,
+        intra_op_threads=0,
+        batch_size=None,
+        input_size=DEFAULT_INPUT_SIZE,
+    ):
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise RuntimeError(
+                "The onnx detection backend needs the onnxruntime package"
+            ) from e
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        self.session = onnxruntime.InferenceSession(
+            model_path, options, providers=["CPUExecutionProvider"]
+        )
+        self.labels = load_labels(labels_path)
+
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        batch, _, height, width = model_input.shape
+        # Dimensions left symbolic by the export are names or None
+        width = width if isinstance(width, int) else input_size
+        height = height if isinstance(height, int) else input_size
+        self.input_size = (width, height)
+        # Models exported with a fixed batch size only accept that many images
+        self.fixed_batch = isinstance(batch, int)
+        self.batch_size = batch if self.fixed_batch else batch_size
+        self.batch_size = self.batch_size or DEFAULT_BATCH_SIZE
+
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.bgr = metadata.get("Image.BitmapPixelFormat", "Bgr8") == "Bgr8"
+        self.range_255 = (
+            metadata.get("Image.NominalPixelRange", "NominalRange_0_255")
+            == "NominalRange_0_255"
+        )
+        output_names = [output.name for output in self.session.get_outputs()]
+        if set(OUTPUT_NAMES) <= set(output_names):
+            self.output_names = list(OUTPUT_NAMES)
+        elif len(output_names) >= 3:
+            # Outputs renamed by the export, in the boxes, scores, classes order
+            self.output_names = output_names[:3]
+        else:
+            raise ValueError(
+                f"The ONNX model {model_path} has the outputs {output_names}, an "
+                "object detection export with boxes, scores and classes outputs "
+                "is expected"
+            )
+        logging.info(
+            f"Loaded ONNX model {model_path}: {len(self.labels)} tags, input "
+            f"{width}x{height}, batches of {self.batch_size}"
+        )
+
+    def detect(self, images, min_probability=DEFAULT_MIN_PROBABILITY):
+        """Predictions of each image, in the order of the images."""
+        predictions = []
+        for start in range(0, len(images), self.batch_size):
+            batch = images[start : start + self.batch_size]
+            inputs = preprocess(batch, self.input_size, self.bgr, self.range_255)
+            if self.fixed_batch and len(batch) < self.batch_size:
+                # Pad the last batch of a fixed size model
+                padding = np.zeros(
+                    (self.batch_size - len(batch), *inputs.shape[1:]), np.float32
+                )
+                inputs = np.concatenate((inputs, padding))
+            boxes, scores, classes = self.session.run(
+                self.output_names, {self.input_name: inputs}
+            )
+            for index in range(len(batch)):
+                predictions.append(
+                    to_predictions(
+                        boxes[index],
+                        scores[index],
+                        classes[index],
+                        self.labels,
+                        min_probability,
+                    )
+                )
+        return predictions
+
+
+def onnx_settings():
+    model_path = os.environ["ONNX_MODEL_PATH"]
+    return (
+        model_path,
+        os.environ.get(
+            "ONNX_LABELS_PATH", os.path.join(os.path.dirname(model_path), "labels.txt")
+        ),
+        int(os.environ.get("ONNX_INTRA_OP_THREADS", 0)),
+        int(os.environ.get("ONNX_BATCH_SIZE", DEFAULT_BATCH_SIZE)),
+        int(os.environ.get("ONNX_INPUT_SIZE", DEFAULT_INPUT_SIZE)),
+    )
+
+
+def get_onnx_detector():
+    """Shared OnnxDetector of the worker process, loaded on first use."""
+    return clients.registry.get("onnx_detector", onnx_settings(), OnnxDetector)
+
+
+def min_probability():
+    return float(os.environ.get("ONNX_MIN_PROBABILITY", DEFAULT_MIN_PROBABILITY))
+
+
+def detect_image(image, tile_size=None, overlap=0):
+    """
+    Predictions of a whole image with the shared detector. When tile_size is
+    set, the overlapping tiles are detected in batches and their boxes are
+    normalized to the whole image, duplicates being left to the aggregation.
+    """
+    if not tile_size:
+        return get_onnx_detector().detect([image], min_probability())[0]
+    tiles = detections.plan_tiles(image.width, image.height, tile_size, overlap)
+    tile_predictions = get_onnx_detector().detect(
+        [image.crop(tile) for tile in tiles], min_probability()
+    )
+    predictions = []
+    for (left, top, right, bottom), tile in zip(tiles, tile_predictions):
+        region = {
+            "left": left / image.width,
+            "top": top / image.height,
+            "width": (right - left) / image.width,
+            "height": (bottom - top) / image.height,
+        }
+        for prediction in tile:
+            prediction["bounding_box"] = detections.to_image_coordinates(
+                prediction["bounding_box"], region
+            )
+            predictions.append(prediction)
+    return predictions
@@ -0,0 +1,317 @@
+"""
+Adaptive rate limiting of the Azure OpenAI calls of a worker process.
+
+All the chat completions of the worker share one limiter, which knows the
+requests per minute and tokens per minute budget of the deployment
+(OPENAI_RPM_LIMIT and OPENAI_TPM_LIMIT, 0 for unlimited) as two token buckets.
+The number of requests in flight adapts AIMD-style: it grows by one after a
+full window of successful calls and is halved on a 429 response, starting from
+OPENAI_MAX_CONCURRENCY. A burst of 429 responses halves it once, only the calls
+started after the last decrease decrease it again. The buckets follow the
+x-ratelimit-remaining-* headers of the responses, and retry-after pauses every
+caller.
+
+Throttled, timed out and failed calls are retried up to OPENAI_RETRY_ATTEMPTS
+times with jittered exponential backoff, as long as the retries fit in
+OPENAI_RETRY_BUDGET seconds. The activities are retried again by the
+orchestrator, so a call lasts at most about retry_attempts times the budget.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+
+import openai
+
+from shared_code import clients, metrics
+
+DEFAULT_MAX_CONCURRENCY = 16
+DEFAULT_RETRY_ATTEMPTS = 6
+# Seconds a call may spend waiting for its retries
+DEFAULT_RETRY_BUDGET = 90.0
+# Exponential backoff of the retries, in seconds
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+# Rough token cost of the parts of a request, used before the usage is known
+TOKENS_PER_IMAGE = 765
+CHARACTERS_PER_TOKEN = 4
+DEFAULT_COMPLETION_TOKENS = 50
+
+RETRIABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+
+class AdaptiveRateLimiter:
+    """Token buckets for requests and tokens, with an adaptive concurrency limit."""
+
+    def __init__(self, rpm=0, tpm=0, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concurrency = max_concurrency
+        self.concurrency_limit = max_concurrency
+        self.in_flight = 0
+        self.request_allowance = float(rpm)
+        self.token_allowance = float(tpm)
+        self.paused_until = 0.0
+        self._successes = 0
+        # Number of multiplicative decreases, the window of the calls started since
+        self._decreases = 0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._updated = now
+        if self.rpm:
+            self.request_allowance = min(
+                self.rpm, self.request_allowance + elapsed * self.rpm / 60
+            )
+        if self.tpm:
+            self.token_allowance = min(
+                self.tpm, self.token_allowance + elapsed * self.tpm / 60
+            )
+
+    def _reserve(self, tokens):
+        tokens = min(tokens, self.tpm) if self.tpm else tokens
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.paused_until:
+                return self.paused_until - now, None
+            if self.in_flight >= self.concurrency_limit:
+                return 0.05, None
+            if self.rpm and self.request_allowance < 1:
+                return (1 - self.request_allowance) * 60 / self.rpm, None
+            if self.tpm and self.token_allowance < tokens:
+                return (tokens - self.token_allowance) * 60 / self.tpm, None
+            self.in_flight += 1
+            self.request_allowance -= 1
+            self.token_allowance -= tokens
+            return 0, self._decreases
+
+    def try_acquire(self, tokens):
+        """
+        Reserve a request slot and its estimated tokens. Returns 0 when reserved,
+        or the number of seconds to wait before trying again.
+        """
+        return self._reserve(tokens)[0]
+
+    def acquire(self, tokens):
+        """Wait for a request slot, and return the window it was reserved in."""
+        while True:
+            wait, window = self._reserve(tokens)
+            if not wait:
+                return window
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens):
+        while True:
+            wait, window = self._reserve(tokens)
+            if not wait:
+                return window
+            await asyncio.sleep(wait)
+
+    def release(
+        self,
+        estimated_tokens,
+        used_tokens=None,
+        headers=None,
+        throttled=False,
+        failed=False,
+        window=None,
+    ):
+        """
+        Release a request slot and adapt the limits to the response received.
+        Throttled calls decrease the concurrency limit, unless it was already
+        decreased since the window their slot was reserved in. Calls that failed
+        otherwise leave it unchanged.
+        """
+        headers = headers or {}
+        with self._lock:
+            now = time.monotonic()
+            self.in_flight -= 1
+            if self.tpm and used_tokens is not None:
+                self.token_allowance += estimated_tokens - used_tokens
+            remaining_requests = _header_number(
+                headers, "x-ratelimit-remaining-requests"
+            )
+            if self.rpm and remaining_requests is not None:
+                self.request_allowance = min(self.request_allowance, remaining_requests)
+            remaining_tokens = _header_number(headers, "x-ratelimit-remaining-tokens")
+            if self.tpm and remaining_tokens is not None:
+                self.token_allowance = min(self.token_allowance, remaining_tokens)
+
+            if throttled:
+                # Multiplicative decrease once per window, and every caller waits
+                # for retry-after
+                if window is None or window == self._decreases:
+                    self.concurrency_limit = max(1, self.concurrency_limit // 2)
+                    self._decreases += 1
+                    logging.warning(
+                        f"Azure OpenAI throttled, concurrency limit "
+                        f"{self.concurrency_limit}"
+                    )
+                self._successes = 0
+                self.paused_until = max(
+                    self.paused_until, now + (retry_after_seconds(headers) or 1.0)
+                )
+            elif not failed:
+                # Additive increase after a full window of successful calls
+                self._successes += 1
+                if self._successes >= self.concurrency_limit:
+                    self.concurrency_limit = min(
+                        self.max_concurrency, self.concurrency_limit + 1
+                    )
+                    self._successes = 0
+
+
+def _header_number(headers, name):
+    value = headers.get(name)
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def retry_after_seconds(headers):
+    """Delay requested by the retry-after-ms or retry-after headers, in seconds."""
+    milliseconds = _header_number(headers, "retry-after-ms")
+    if milliseconds is not None:
+        return milliseconds / 1000
+    return _header_number(headers, "retry-after")
+
+
+def backoff_delay(attempt, retry_after=None):
+    """Full-jitter exponential backoff, never shorter than retry_after."""
+    delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2**attempt))
+    return (retry_after or 0) + delay
+
+
+def estimate_tokens(messages, max_tokens=None):
+    """Rough token count of a chat completion request, images included."""
+    tokens = max_tokens or DEFAULT_COMPLETION_TOKENS
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            tokens += len(content) // CHARACTERS_PER_TOKEN
+            continue
+        for part in content:
+            if part["type"] == "text":
+                tokens += len(part["text"]) // CHARACTERS_PER_TOKEN
+            else:
+                tokens += TOKENS_PER_IMAGE
+    return tokens
+
+
+_limiter = None
+_limiter_settings = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """Rate limiter of the worker process, recreated when its settings change."""
+    global _limiter, _limiter_settings
+    settings = (
+        int(os.environ.get("OPENAI_RPM_LIMIT", 0)),
+        int(os.environ.get("OPENAI_TPM_LIMIT", 0)),
+        int(os.environ.get("OPENAI_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY)),
+    )
+    with _limiter_lock:
+        if _limiter is None or settings != _limiter_settings:
+            _limiter = AdaptiveRateLimiter(*settings)
+            _limiter_settings = settings
+        return _limiter
+
+
+def _retry_attempts():
+    return int(os.environ.get("OPENAI_RETRY_ATTEMPTS", DEFAULT_RETRY_ATTEMPTS))
+
+
+def _retry_budget():
+    return float(os.environ.get("OPENAI_RETRY_BUDGET", DEFAULT_RETRY_BUDGET))
+
+
+def _response_headers(error):
+    response = getattr(error, "response", None)
+    return response.headers if response is not None else {}
+
+
+def chat_completion(**kwargs):
+    """Rate limited chat completion, retried with backoff when throttled or failed."""
+    limiter = get_rate_limiter()
+    estimated = estimate_tokens(kwargs["messages"], kwargs.get("max_tokens"))
+    attempts = _retry_attempts()
+    deadline = time.monotonic() + _retry_budget()
+    for attempt in range(attempts + 1):
+        window = limiter.acquire(estimated)
+        try:
+            raw = clients.get_openai_client().chat.completions.with_raw_response.create(
+                **kwargs
+            )
+        except RETRIABLE_ERRORS as e:
+            headers = _response_headers(e)
+            throttled = isinstance(e, openai.RateLimitError)
+            limiter.release(
+                estimated,
+                headers=headers,
+                throttled=throttled,
+                failed=True,
+                window=window,
+            )
+            delay = backoff_delay(attempt, retry_after_seconds(headers))
+            if attempt == attempts or time.monotonic() + delay > deadline:
+                raise
+            logging.warning(f"Retrying chat completion in {delay:.1f}s: {e}")
+            time.sleep(delay)
+            continue
+        except Exception:
+            limiter.release(estimated, failed=True)
+            raise
+        response = raw.parse()
+        used = response.usage.total_tokens if response.usage else None
+        limiter.release(estimated, used, raw.headers)
+        metrics.record_usage(response.usage)
+        return response
+
+
+async def chat_completion_async(**kwargs):
+    """Asynchronous version of chat_completion, using AsyncAzureOpenAI."""
+    limiter = get_rate_limiter()
+    estimated = estimate_tokens(kwargs["messages"], kwargs.get("max_tokens"))
+    attempts = _retry_attempts()
+    deadline = time.monotonic() + _retry_budget()
+    for attempt in range(attempts + 1):
+        window = await limiter.acquire_async(estimated)
+        try:
+            client = clients.get_async_openai_client()
+            raw = await client.chat.completions.with_raw_response.create(**kwargs)
+        except RETRIABLE_ERRORS as e:
+            headers = _response_headers(e)
+            throttled = isinstance(e, openai.RateLimitError)
+            limiter.release(
+                estimated,
+                headers=headers,
+                throttled=throttled,
+                failed=True,
+                window=window,
+            )
+            delay = backoff_delay(attempt, retry_after_seconds(headers))
+            if attempt == attempts or time.monotonic() + delay > deadline:
+                raise
+            logging.warning(f"Retrying chat completion in {delay:.1f}s: {e}")
+            await asyncio.sleep(delay)
+            continue
+        except Exception:
+            limiter.release(estimated, failed=True)
+            raise
+        response = raw.parse()
+        used = response.usage.total_tokens if response.usage else None
+        limiter.release(estimated, used, raw.headers)
+        metrics.record_usage(response.usage)
+        return response
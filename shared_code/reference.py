@@ -0,0 +1,85 @@
+"""
+Preparation of the reference legend sent with every symbol analysis.
+
+The legend is cropped to its content, converted to grayscale and downscaled to
+what the model actually looks at, optionally further to fit a vision token
+budget. Token counts follow the Azure OpenAI GPT-4o image rules: a ``low``
+detail image costs 85 tokens, a ``high`` detail image is scaled to fit in
+2048x2048 then to a shortest side of 768 pixels, and costs 170 tokens per
+512-pixel tile plus 85.
+"""
+
+import math
+
+from PIL import Image
+
+BASE_TOKENS = 85
+TILE_TOKENS = 170
+TILE_SIZE = 512
+MAX_SIDE = 2048
+SHORT_SIDE = 768
+LOW_DETAIL_SIDE = 512
+# Pixels brighter than this are considered background when trimming
+WHITESPACE_LEVEL = 245
+TRIM_MARGIN = 8
+MIN_SIDE = 64
+
+
+def model_image_size(width, height, detail="high"):
+    """Size of an image once resized by the service for the given detail level."""
+    if detail == "low":
+        scale = min(1.0, LOW_DETAIL_SIDE / max(width, height))
+        return max(1, round(width * scale)), max(1, round(height * scale))
+    scale = min(1.0, MAX_SIDE / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, SHORT_SIDE / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def estimate_image_tokens(width, height, detail="high"):
+    """Vision tokens billed for an image of this size and detail level."""
+    if detail == "low":
+        return BASE_TOKENS
+    width, height = model_image_size(width, height, detail)
+    tiles = math.ceil(width / TILE_SIZE) * math.ceil(height / TILE_SIZE)
+    return BASE_TOKENS + TILE_TOKENS * tiles
+
+
+def trim_whitespace(image):
+    """Crop the uniform light background around the content of an image."""
+    mask = image.convert("L").point(
+        lambda level: 255 if level < WHITESPACE_LEVEL else 0
+    )
+    bbox = mask.getbbox()
+    if bbox is None:
+        return image
+    left, top, right, bottom = bbox
+    return image.crop(
+        (
+            max(0, left - TRIM_MARGIN),
+            max(0, top - TRIM_MARGIN),
+            min(image.width, right + TRIM_MARGIN),
+            min(image.height, bottom + TRIM_MARGIN),
+        )
+    )
+
+
+def prepare_reference_image(image, detail="high", max_tokens=None, grayscale=True):
+    """
+    Normalize a legend image: trim the whitespace, convert to grayscale and
+    downscale to the size used by the model, then further until its estimated
+    token count fits in max_tokens.
+    """
+    image = trim_whitespace(image)
+    image = image.convert("L") if grayscale else image.convert("RGB")
+
+    width, height = model_image_size(image.width, image.height, detail)
+    if max_tokens and detail != "low":
+        while (
+            estimate_image_tokens(width, height, detail) > max_tokens
+            and min(width, height) > MIN_SIDE
+        ):
+            width, height = max(1, int(width * 0.9)), max(1, int(height * 0.9))
+    if (width, height) != image.size:
+        image = image.resize((width, height), Image.Resampling.LANCZOS)
+    return image
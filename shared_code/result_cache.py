@@ -0,0 +1,194 @@
+"""
+Persistent cache for the Azure OpenAI symbol analysis results.
+
+Entries are keyed by a hash of everything that determines the model answer: the
+cropped symbol, the reference legend, the analysis prompt and the model and API
+version. The backend is selected with the RESULT_CACHE_BACKEND application
+setting:
+
+- ``none`` (default): caching disabled
+- ``sqlite``: local SQLite file (RESULT_CACHE_PATH), with TTL and LRU eviction
+- ``blob``: JSON blobs in a container (RESULT_CACHE_CONTAINER), with TTL eviction
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from azure.storage.blob import ContentSettings
+
+from shared_code import clients
+
+DEFAULT_TTL_SECONDS = 7 * 24 * 3600
+DEFAULT_MAX_ENTRIES = 100_000
+DEFAULT_CACHE_CONTAINER = "vision-agent-cache"
+
+
+def cache_key(crop_hash, reference_hash, prompt, model, api_version):
+    """Hash identifying one symbol analysis request."""
+    digest = hashlib.sha256()
+    for part in (crop_hash, reference_hash, prompt or "", model, api_version):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Interface of the result cache backends."""
+
+    def get(self, key):
+        """Return the cached value for the key, or None."""
+        raise NotImplementedError
+
+    def set(self, key, value):
+        """Store a JSON serializable value for the key."""
+        raise NotImplementedError
+
+
+class NullResultCache(ResultCache):
+    """Backend used when caching is disabled."""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+
+class SqliteResultCache(ResultCache):
+    """Local SQLite cache with TTL expiration and least-recently-used eviction."""
+
+    def __init__(self, path, ttl_seconds=DEFAULT_TTL_SECONDS, max_entries=None):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries or DEFAULT_MAX_ENTRIES
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)"
+            )
+
+    def get(self, key):
+        now = time.time()
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT value, created FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, created = row
+            if self.ttl_seconds and created + self.ttl_seconds < now:
+                self._connection.execute("DELETE FROM results WHERE key = ?", (key,))
+                return None
+            self._connection.execute(
+                "UPDATE results SET accessed = ? WHERE key = ?", (now, key)
+            )
+        return json.loads(value)
+
+    def set(self, key, value):
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO results (key, value, created, accessed) "
+                "VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now),
+            )
+            self._evict(now)
+
+    def _evict(self, now):
+        if self.ttl_seconds:
+            self._connection.execute(
+                "DELETE FROM results WHERE created < ?", (now - self.ttl_seconds,)
+            )
+        (count,) = self._connection.execute("SELECT COUNT(*) FROM results").fetchone()
+        if count > self.max_entries:
+            self._connection.execute(
+                "DELETE FROM results WHERE key IN ("
+                "SELECT key FROM results ORDER BY accessed LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+
+class BlobResultCache(ResultCache):
+    """
+    Cache stored as JSON blobs, shared by all the function app instances.
+    Expired entries are ignored and deleted on read, a storage lifecycle
+    management rule on the container can be used to bound its size.
+    """
+
+    def __init__(self, container, ttl_seconds=DEFAULT_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._container_client = clients.get_blob_service_client().get_container_client(
+            container
+        )
+        try:
+            self._container_client.create_container()
+        except ResourceExistsError:
+            pass
+
+    def get(self, key):
+        blob_client = self._container_client.get_blob_client(f"{key}.json")
+        try:
+            entry = json.loads(blob_client.download_blob().readall())
+        except ResourceNotFoundError:
+            return None
+        if self.ttl_seconds and entry["created"] + self.ttl_seconds < time.time():
+            blob_client.delete_blob()
+            return None
+        return entry["value"]
+
+    def set(self, key, value):
+        blob_client = self._container_client.get_blob_client(f"{key}.json")
+        blob_client.upload_blob(
+            json.dumps({"created": time.time(), "value": value}),
+            overwrite=True,
+            content_settings=ContentSettings(content_type="application/json"),
+        )
+
+
+_cache_instance = None
+_cache_settings = None
+_cache_lock = threading.Lock()
+
+
+def _settings():
+    return (
+        os.environ.get("RESULT_CACHE_BACKEND", "none").lower(),
+        os.environ.get(
+            "RESULT_CACHE_PATH",
+            os.path.join(tempfile.gettempdir(), "vision_agent_result_cache.sqlite"),
+        ),
+        os.environ.get("RESULT_CACHE_CONTAINER", DEFAULT_CACHE_CONTAINER),
+        int(os.environ.get("RESULT_CACHE_TTL_SECONDS", DEFAULT_TTL_SECONDS)),
+        int(os.environ.get("RESULT_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)),
+    )
+
+
+def get_result_cache():
+    """Return the result cache configured by the application settings."""
+    global _cache_instance, _cache_settings
+    settings = _settings()
+    with _cache_lock:
+        if _cache_instance is None or settings != _cache_settings:
+            backend, path, container, ttl_seconds, max_entries = settings
+            if backend == "sqlite":
+                _cache_instance = SqliteResultCache(path, ttl_seconds, max_entries)
+            elif backend == "blob":
+                _cache_instance = BlobResultCache(container, ttl_seconds)
+            else:
+                _cache_instance = NullResultCache()
+            _cache_settings = settings
+            logging.info(f"Using {type(_cache_instance).__name__} for results")
+        return _cache_instance
@@ -0,0 +1,405 @@
+"""
+Persisted, queryable store of the results of the analyzed plans.
+
+Every completed vision_agent_orchestrator writes one compact, versioned record:
+the detections with their answers and match sources (as columns), the summary,
+the metrics and statistics, the model, and the hashes identifying the inputs.
+Records are indexed by the content hash of the plan (image_hash) and by the
+prompt version (prompt_hash, the SHA-256 of the analysis prompt, also written
+with the prompts saved by the frontend in prompts.jsonl), so that prompt
+variants can be compared over the same plans, and accuracy computed over the
+training set, without analyzing them again. The run key hashes everything that
+determines a result, and a new run with the key of a stored record is answered
+from it instantly. The backend is selected with the RESULT_STORE_BACKEND
+application setting:
+
+- ``none`` (default): results are not stored
+- ``sqlite``: local SQLite file (RESULT_STORE_PATH), one row per record and one
+  row per detection, which can be queried with SQL
+- ``blob``: JSON blobs in a container (RESULT_STORE_CONTAINER), named
+  ``records/<prompt_hash>/<image_hash>/<run_key>/<record_id>.json``. Each record
+  has an empty index blob
+  ``by_image/<image_hash>/<prompt_hash>/<run_key>/<record_id>``, so that the
+  records of a plan are listed without those of the other plans
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+
+from azure.core.exceptions import ResourceExistsError
+from azure.storage.blob import ContentSettings
+
+from shared_code import clients
+
+# Version of the layout of the records, increased on incompatible changes
+SCHEMA_VERSION = 1
+DEFAULT_STORE_CONTAINER = "vision-agent-results"
+# Columns of the stored detections, one list each
+DETECTION_COLUMNS = (
+    "boxes",
+    "tags",
+    "probabilities",
+    "answers",
+    "match_sources",
+    "match_scores",
+)
+
+
+def prompt_hash(prompt):
+    """Prompt version: SHA-256 hex digest of the prompt text."""
+    return hashlib.sha256((prompt or "").encode("utf-8")).hexdigest()
+
+
+def content_hash_of_blob(blob_client, max_concurrency=1):
+    """SHA-256 hex digest of a blob, downloaded in chunks without keeping it."""
+    digest = hashlib.sha256()
+    for chunk in blob_client.download_blob(max_concurrency=max_concurrency).chunks():
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def run_key(image_hash, reference_hash, prompt, model, api_version, options):
+    """Hash of everything that determines the result of a plan analysis."""
+    return hashlib.sha256(
+        json.dumps(
+            [
+                SCHEMA_VERSION,
+                image_hash,
+                reference_hash,
+                prompt_hash(prompt),
+                model,
+                api_version,
+                options,
+            ],
+            sort_keys=True,
+        ).encode("utf-8")
+    ).hexdigest()
+
+
+def symbols_digest(symbols):
+    """
+    SHA-256 hex digest of the known symbols passed to a plan by a batch, part of
+    its run key, None when there are none.
+    """
+    if not symbols:
+        return None
+    return hashlib.sha256(
+        json.dumps(symbols, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def compact_output(output, decimals=6):
+    """
+    Output of vision_agent_orchestrator as stored: the detections as columns,
+    without the aggregated_detections derived from them.
+    """
+    detections = output["detections"]
+    columns = {
+        "boxes": [
+            [
+                round(detection["bounding_box"][side], decimals)
+                for side in ("left", "top", "width", "height")
+            ]
+            for detection in detections
+        ],
+        "tags": [detection["custom_vision_tag"] for detection in detections],
+        "probabilities": [
+            round(detection["probability"], decimals) for detection in detections
+        ],
+        "answers": [detection["openai_response"] for detection in detections],
+        "match_sources": [detection.get("match_source") for detection in detections],
+        "match_scores": [detection.get("match_score") for detection in detections],
+    }
+    compact = {
+        name: value
+        for name, value in output.items()
+        if name not in ("detections", "aggregated_detections", "stored_record")
+    }
+    return {**compact, "detections": columns}
+
+
+def expand_output(compact):
+    """Inverse of compact_output."""
+    columns = compact["detections"]
+    detections = []
+    aggregated_detections = {}
+    for box, tag, probability, answer, source, score in zip(
+        *(columns[name] for name in DETECTION_COLUMNS)
+    ):
+        bounding_box = dict(zip(("left", "top", "width", "height"), box))
+        detections.append(
+            {
+                "openai_response": answer,
+                "bounding_box": bounding_box,
+                "custom_vision_tag": tag,
+                "probability": probability,
+                "match_source": source,
+                "match_score": score,
+            }
+        )
+        aggregated_detections.setdefault(tag, []).append(
+            {"tag": tag, "probability": probability, "bounding_box": bounding_box}
+        )
+    return {
+        **compact,
+        "detections": detections,
+        "aggregated_detections": aggregated_detections,
+    }
+
+
+class ResultStore:
+    """Interface of the result store backends."""
+
+    def put(self, record):
+        """Store a record, identified by its record_id."""
+        raise NotImplementedError
+
+    def latest(self, key, prompt_version, image_hash):
+        """Most recent record with the run key, or None."""
+        raise NotImplementedError
+
+    def query(self, image_hash=None, prompt_version=None):
+        """Records of a plan, of a prompt version or of both, newest first."""
+        raise NotImplementedError
+
+
+class NullResultStore(ResultStore):
+    """Backend used when the results are not stored."""
+
+    def put(self, record):
+        pass
+
+    def latest(self, key, prompt_version, image_hash):
+        return None
+
+    def query(self, image_hash=None, prompt_version=None):
+        return []
+
+
+class SqliteResultStore(ResultStore):
+    """
+    Local SQLite store. The records are kept without their detections, which
+    are stored one row each in the detections table.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS records ("
+                "record_id TEXT PRIMARY KEY, schema_version INTEGER NOT NULL, "
+                "created TEXT NOT NULL, run_key TEXT NOT NULL, "
+                "image_hash TEXT NOT NULL, reference_hash TEXT NOT NULL, "
+                "prompt_hash TEXT NOT NULL, model TEXT NOT NULL, "
+                "filename TEXT, record TEXT NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS records_image_prompt "
+                "ON records (image_hash, prompt_hash)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS records_prompt ON records (prompt_hash)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS records_run_key "
+                "ON records (run_key, created)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS detections ("
+                "record_id TEXT NOT NULL, position INTEGER NOT NULL, "
+                "tag TEXT NOT NULL, answer TEXT, probability REAL NOT NULL, "
+                "box_left REAL NOT NULL, box_top REAL NOT NULL, "
+                "box_width REAL NOT NULL, box_height REAL NOT NULL, "
+                "match_source TEXT, match_score REAL, "
+                "PRIMARY KEY (record_id, position))"
+            )
+
+    def put(self, record):
+        output = dict(record["output"])
+        columns = output.pop("detections")
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM detections WHERE record_id = ?", (record["record_id"],)
+            )
+            self._connection.execute(
+                "INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    record["record_id"],
+                    record["schema_version"],
+                    record["created"],
+                    record["run_key"],
+                    record["image_hash"],
+                    record["reference_hash"],
+                    record["prompt_hash"],
+                    record["model"],
+                    record.get("filename"),
+                    json.dumps({**record, "output": output}),
+                ),
+            )
+            self._connection.executemany(
+                "INSERT INTO detections VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (record["record_id"], position, tag, answer, probability, *box)
+                    + (source, score)
+                    for position, (
+                        box,
+                        tag,
+                        probability,
+                        answer,
+                        source,
+                        score,
+                    ) in enumerate(zip(*(columns[name] for name in DETECTION_COLUMNS)))
+                ],
+            )
+
+    def _records(self, where, parameters, limit=-1):
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT record_id, record FROM records WHERE {where} "
+                "ORDER BY created DESC LIMIT ?",
+                (*parameters, limit),
+            ).fetchall()
+            records = []
+            for record_id, value in rows:
+                record = json.loads(value)
+                columns = {name: [] for name in DETECTION_COLUMNS}
+                for row in self._connection.execute(
+                    "SELECT box_left, box_top, box_width, box_height, tag, "
+                    "probability, answer, "
+                    "match_source, match_score FROM detections "
+                    "WHERE record_id = ? ORDER BY position",
+                    (record_id,),
+                ):
+                    columns["boxes"].append(list(row[:4]))
+                    for name, value in zip(DETECTION_COLUMNS[1:], row[4:]):
+                        columns[name].append(value)
+                record["output"]["detections"] = columns
+                records.append(record)
+        return records
+
+    def latest(self, key, prompt_version, image_hash):
+        records = self._records("run_key = ?", (key,), limit=1)
+        return records[0] if records else None
+
+    def query(self, image_hash=None, prompt_version=None):
+        conditions = {"image_hash": image_hash, "prompt_hash": prompt_version}
+        where = [f"{name} = ?" for name, value in conditions.items() if value]
+        return self._records(
+            " AND ".join(where) or "1",
+            [value for value in conditions.values() if value],
+        )
+
+
+class BlobResultStore(ResultStore):
+    """
+    Store of JSON blobs shared by all the function app instances, named by
+    prompt version, plan and run key so that they are listed by prefix. The
+    by_image index blobs name the records by plan first.
+    """
+
+    def __init__(self, container):
+        self._container_client = clients.get_blob_service_client().get_container_client(
+            container
+        )
+        try:
+            self._container_client.create_container()
+        except ResourceExistsError:
+            pass
+
+    def put(self, record):
+        path = f"{record['image_hash']}/{record['run_key']}/{record['record_id']}"
+        self._container_client.get_blob_client(
+            f"records/{record['prompt_hash']}/{path}.json"
+        ).upload_blob(
+            json.dumps(record).encode("utf-8"),
+            overwrite=True,
+            content_settings=ContentSettings(content_type="application/json"),
+        )
+        # Written after the record, so that every index blob names a record
+        self._container_client.get_blob_client(
+            f"by_image/{record['image_hash']}/{record['prompt_hash']}/"
+            f"{record['run_key']}/{record['record_id']}"
+        ).upload_blob(b"", overwrite=True)
+
+    def _download(self, blob_names):
+        records = [
+            json.loads(
+                self._container_client.get_blob_client(blob_name)
+                .download_blob()
+                .readall()
+            )
+            for blob_name in blob_names
+        ]
+        return sorted(records, key=lambda record: record["created"], reverse=True)
+
+    def _records(self, prefix):
+        return self._download(
+            blob.name
+            for blob in self._container_client.list_blobs(name_starts_with=prefix)
+        )
+
+    def _records_of_image(self, image_hash):
+        # by_image/<image_hash>/<prompt_hash>/<run_key>/<record_id>
+        blob_names = []
+        for blob in self._container_client.list_blobs(
+            name_starts_with=f"by_image/{image_hash}/"
+        ):
+            _, _, prompt_version, key, record_id = blob.name.split("/")
+            blob_names.append(
+                f"records/{prompt_version}/{image_hash}/{key}/{record_id}.json"
+            )
+        return self._download(blob_names)
+
+    def latest(self, key, prompt_version, image_hash):
+        records = self._records(f"records/{prompt_version}/{image_hash}/{key}/")
+        return records[0] if records else None
+
+    def query(self, image_hash=None, prompt_version=None):
+        if prompt_version and image_hash:
+            return self._records(f"records/{prompt_version}/{image_hash}/")
+        if prompt_version:
+            return self._records(f"records/{prompt_version}/")
+        if image_hash:
+            return self._records_of_image(image_hash)
+        return self._records("records/")
+
+
+_store_instance = None
+_store_settings = None
+_store_lock = threading.Lock()
+
+
+def _settings():
+    return (
+        os.environ.get("RESULT_STORE_BACKEND", "none").lower(),
+        os.environ.get(
+            "RESULT_STORE_PATH",
+            os.path.join(tempfile.gettempdir(), "vision_agent_result_store.sqlite"),
+        ),
+        os.environ.get("RESULT_STORE_CONTAINER", DEFAULT_STORE_CONTAINER),
+    )
+
+
+def get_result_store():
+    """Return the result store configured by the application settings."""
+    global _store_instance, _store_settings
+    settings = _settings()
+    with _store_lock:
+        if _store_instance is None or settings != _store_settings:
+            backend, path, container = settings
+            if backend == "sqlite":
+                _store_instance = SqliteResultStore(path)
+            elif backend == "blob":
+                _store_instance = BlobResultStore(container)
+            else:
+                _store_instance = NullResultStore()
+            _store_settings = settings
+            logging.info(f"Using {type(_store_instance).__name__} for stored results")
+        return _store_instance
@@ -0,0 +1,151 @@
+"""
+Token-budgeted summaries of the analyzed detections.
+
+The detections are first aggregated deterministically into a compact table: one
+row per tag and answer (the legend symbol matched by the analysis) with its
+count and confidence distribution, followed by the statistics of every tag.
+Only this table is sent to the model, so the prompt grows with the number of
+distinct symbols rather than with the number of detections. When the table is
+still estimated above the token budget, it is split into parts summarized
+separately (map) and their summaries are combined (reduce), in parts again while
+they exceed the budget.
+"""
+
+from shared_code.rate_limit import CHARACTERS_PER_TOKEN
+
+# Estimated prompt tokens of one summary call, and completion tokens of the call
+DEFAULT_TOKEN_BUDGET = 4000
+DEFAULT_MAX_TOKENS = 500
+# Upper bounds of the low and medium confidence bins of the table rows
+CONFIDENCE_BINS = (0.7, 0.9)
+
+INSTRUCTIONS = """Please provide a concise summary of what was detected in the floor plan. Focus on:
+    1. The types of rooms/spaces detected
+    2. Notable features or patterns
+    3. Any potential inaccuracies or areas that need attention"""
+
+
+def table_rows(detections):
+    """
+    One row per tag and answer of the analyzed detections, with its count and
+    probabilities, sorted by tag and by decreasing count within each tag.
+    """
+    rows = {}
+    for detection in detections:
+        key = (detection["custom_vision_tag"], detection["openai_response"])
+        probability = detection["probability"]
+        row = rows.get(key)
+        if row is None:
+            row = rows[key] = {
+                "tag": key[0],
+                "answer": key[1],
+                "count": 0,
+                "probability_sum": 0.0,
+                "min_probability": probability,
+                "max_probability": probability,
+                "confidence_bins": [0] * (len(CONFIDENCE_BINS) + 1),
+            }
+        row["count"] += 1
+        row["probability_sum"] += probability
+        row["min_probability"] = min(row["min_probability"], probability)
+        row["max_probability"] = max(row["max_probability"], probability)
+        row["confidence_bins"][
+            sum(probability >= bound for bound in CONFIDENCE_BINS)
+        ] += 1
+    for row in rows.values():
+        row["mean_probability"] = row.pop("probability_sum") / row["count"]
+    return sorted(rows.values(), key=lambda row: (row["tag"], -row["count"]))
+
+
+def table_lines(rows, stats=None):
+    """Text lines of the table rows, then of the per-tag statistics when given."""
+    low, high = CONFIDENCE_BINS
+    lines = [
+        f"- {row['tag']} | {row['answer']}: {row['count']} "
+        f"(confidence {row['min_probability']:.0%} to {row['max_probability']:.0%}, "
+        f"mean {row['mean_probability']:.0%}; "
+        f"{row['confidence_bins'][0]} below {low:.0%}, "
+        f"{row['confidence_bins'][1]} from {low:.0%} to {high:.0%}, "
+        f"{row['confidence_bins'][2]} above {high:.0%})"
+        for row in rows
+    ]
+    for tag, tag_stats in (stats or {}).items():
+        lines.append(
+            f"- {tag} (all answers): {tag_stats['count']} detected, confidence "
+            f"{tag_stats['min_probability']:.1%} to {tag_stats['max_probability']:.1%} "
+            f"(mean {tag_stats['mean_probability']:.1%})"
+        )
+    return lines
+
+
+def estimate_tokens(lines):
+    return sum(len(line) + 1 for line in lines) // CHARACTERS_PER_TOKEN
+
+
+def split_lines(lines, token_budget):
+    """
+    Consecutive parts of the lines estimated within token_budget each, every
+    part but the last holding at least two lines so that the parts always
+    shrink, even when single lines exceed the budget.
+    """
+    parts = [[]]
+    for line in lines:
+        part = parts[-1]
+        if len(part) >= 2 and estimate_tokens(part + [line]) > token_budget:
+            parts.append([line])
+        else:
+            part.append(line)
+    return parts
+
+
+def summary_messages(lines, kind="table", part=None, parts=None):
+    """
+    Chat messages asking to summarize the table lines (kind table), one part of
+    them or of the summaries of a previous level (kind part), or to combine the
+    summaries of the parts (kind summaries).
+    """
+    if kind == "part":
+        prompt = f"""You are an AI assistant analyzing a floor plan image. I will give you part {part} of {parts} of the description of what was detected on it.
+    Please summarize this part concisely, keeping the counts and the symbols that need attention. It will be combined with the summaries of the other parts."""
+    elif kind == "summaries":
+        prompt = f"""You are an AI assistant analyzing a floor plan image. I will give you the summaries of the parts of the description of what was detected on it.
+    {INSTRUCTIONS}"""
+    else:
+        prompt = f"""You are an AI assistant analyzing a floor plan image. I will give you a table of the detected objects: for each tag and the legend symbol it was identified as, how many were detected and their confidence, then the totals of each tag.
+    {INSTRUCTIONS}"""
+    text = "\n".join(lines)
+    return [{"role": "user", "content": f"{prompt}\n\n{text}"}]
+
+
+def summary_request(data):
+    """
+    Messages of the summary call described by a generate_summary payload and
+    the estimated tokens of its input, or None instead of the messages with the
+    parts of the input when it exceeds the token budget.
+
+    The payload holds the table rows (or the detections to aggregate) with the
+    per-tag stats, the lines of one part with its position, or the summaries
+    of the parts to combine.
+    """
+    token_budget = data.get("token_budget") or DEFAULT_TOKEN_BUDGET
+    if "lines" in data:
+        lines = data["lines"]
+        tokens = estimate_tokens(lines)
+        return (
+            summary_messages(lines, "part", data.get("part"), data.get("parts")),
+            tokens,
+            None,
+        )
+    if "summaries" in data:
+        kind = "summaries"
+        lines = [f"- {summary}" for summary in data["summaries"]]
+    else:
+        kind = "table"
+        rows = data.get("rows")
+        if rows is None:
+            rows = table_rows(data.get("detections", []))
+        lines = table_lines(rows, data.get("stats"))
+    tokens = estimate_tokens(lines)
+    if tokens > token_budget and len(lines) > 1:
+        return None, tokens, split_lines(lines, token_budget)
+    return summary_messages(lines, kind), tokens, None
@@ -0,0 +1,292 @@
+"""
+Matching of the cropped symbols against the reference legend with Azure OpenAI.
+
+A symbol is analyzed either on its own (one chat completion per crop), or in a
+batch where several crops share a single chat completion and the model answers
+with a JSON array of matches. Batched crops are sent either as separate labeled
+image parts or combined into one numbered contact sheet image.
+"""
+
+import asyncio
+import base64
+import logging
+import math
+import os
+from io import BytesIO
+from typing import List
+
+from PIL import Image, ImageDraw
+from pydantic import BaseModel, ValidationError
+
+from shared_code import artifacts, rate_limit, result_cache
+from shared_code.clients import OPENAI_API_VERSION
+
+BATCH_STRATEGIES = ("parts", "contact_sheet")
+# Largest side of a cell of the contact sheet, crops are downscaled to fit
+CONTACT_SHEET_CELL_SIZE = 256
+CONTACT_SHEET_LABEL_HEIGHT = 24
+
+BATCH_INSTRUCTIONS = """
+You will receive {count} symbols numbered from 1 to {count}{layout}.
+Apply the task above to each symbol independently.
+Answer with a JSON object of the form {{"matches": [{{"index": 1, "name": "..."}}]}}
+containing exactly one entry per symbol, where name follows the output format above.
+"""
+
+
+class SymbolMatch(BaseModel):
+    index: int
+    name: str
+
+
+class SymbolMatches(BaseModel):
+    matches: List[SymbolMatch]
+
+
+def get_cache(data):
+    """Result cache to use for a request, honoring its use_cache flag."""
+    if data.get("use_cache", True):
+        return result_cache.get_result_cache()
+    return result_cache.NullResultCache()
+
+
+def symbol_cache_key(data, model, strategy=None):
+    """
+    Cache key of the analysis of one symbol. Answers given within a batch are
+    kept apart from single-symbol answers, per batch strategy, as the model is
+    not asked the same question.
+    """
+    reference_hash = artifacts.hash_image(data.get("reference_img"))
+    if data.get("reference_detail"):
+        reference_hash = f"{reference_hash}:{data['reference_detail']}"
+    if strategy is not None:
+        reference_hash = f"{reference_hash}:batch:{strategy}"
+    return result_cache.cache_key(
+        artifacts.hash_image(data.get("image")),
+        reference_hash,
+        data.get("analyze_prompt"),
+        model,
+        OPENAI_API_VERSION,
+    )
+
+
+def symbol_result(data, openai_response, cache_hit):
+    """Per-detection result returned by the analysis activities."""
+    return {
+        "openai_response": openai_response,
+        "bounding_box": data.get("bounding_box"),
+        "custom_vision_tag": data.get("tag"),
+        "probability": data.get("probability"),
+        "cache_hit": cache_hit,
+    }
+
+
+def reference_image_url(data):
+    """image_url part of the legend, with its detail level when one was chosen."""
+    image_url = {"url": artifacts.to_data_url(data.get("reference_img"))}
+    if data.get("reference_detail"):
+        image_url["detail"] = data["reference_detail"]
+    return image_url
+
+
+def symbol_messages(data):
+    """Chat messages asking to match one cropped symbol against the legend."""
+    # Images are either data URLs or artifact references resolved here
+    detected_img = artifacts.to_data_url(data.get("image"))
+
+    return [
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": data.get("analyze_prompt")},
+                {"type": "image_url", "image_url": reference_image_url(data)},
+            ],
+        },
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": "Here is the symbol and the legend"},
+                {
+                    "type": "image_url",
+                    "image_url": {"url": detected_img, "detail": "high"},
+                },
+            ],
+        },
+    ]
+
+
+def analyze_symbol(data):
+    """Match one cropped symbol against the legend, using the result cache."""
+    model = os.environ["OPENAI_MODEL"]
+    cache = get_cache(data)
+    key = symbol_cache_key(data, model)
+    cached = cache.get(key)
+    if cached is not None:
+        logging.info("Using cached symbol analysis")
+        return symbol_result(data, cached["openai_response"], cache_hit=True)
+
+    response = rate_limit.chat_completion(model=model, messages=symbol_messages(data))
+    openai_response = response.choices[0].message.content
+    cache.set(key, {"openai_response": openai_response})
+    return symbol_result(data, openai_response, cache_hit=False)
+
+
+async def analyze_symbol_async(data):
+    """
+    Asynchronous version of analyze_symbol. The cache and artifact accesses run
+    in threads so that they do not block the event loop.
+    """
+    model = os.environ["OPENAI_MODEL"]
+    cache = get_cache(data)
+    key = await asyncio.to_thread(symbol_cache_key, data, model)
+    cached = await asyncio.to_thread(cache.get, key)
+    if cached is not None:
+        logging.info("Using cached symbol analysis")
+        return symbol_result(data, cached["openai_response"], cache_hit=True)
+
+    messages = await asyncio.to_thread(symbol_messages, data)
+    response = await rate_limit.chat_completion_async(model=model, messages=messages)
+    openai_response = response.choices[0].message.content
+    await asyncio.to_thread(cache.set, key, {"openai_response": openai_response})
+    return symbol_result(data, openai_response, cache_hit=False)
+
+
+def contact_sheet(images):
+    """Combine images in a grid, with the 1-based number of each one above it."""
+    columns = math.ceil(math.sqrt(len(images)))
+    rows = math.ceil(len(images) / columns)
+    cell_height = CONTACT_SHEET_CELL_SIZE + CONTACT_SHEET_LABEL_HEIGHT
+    sheet = Image.new(
+        "RGB", (columns * CONTACT_SHEET_CELL_SIZE, rows * cell_height), "white"
+    )
+    draw = ImageDraw.Draw(sheet)
+    for number, image in enumerate(images, start=1):
+        left = ((number - 1) % columns) * CONTACT_SHEET_CELL_SIZE
+        top = ((number - 1) // columns) * cell_height
+        cell = image.convert("RGB")
+        cell.thumbnail((CONTACT_SHEET_CELL_SIZE - 8, CONTACT_SHEET_CELL_SIZE - 8))
+        sheet.paste(cell, (left + 4, top + CONTACT_SHEET_LABEL_HEIGHT))
+        draw.rectangle(
+            [left, top, left + CONTACT_SHEET_CELL_SIZE - 1, top + cell_height - 1],
+            outline="gray",
+        )
+        draw.text((left + 4, top + 4), str(number), fill="red")
+    return sheet
+
+
+def _batch_symbol_content(items, strategy):
+    if strategy == "contact_sheet":
+        images = [
+            Image.open(BytesIO(artifacts.load_bytes(item["image"]))) for item in items
+        ]
+        buffered = BytesIO()
+        contact_sheet(images).save(buffered, format="JPEG")
+        encoded = base64.b64encode(buffered.getvalue()).decode("utf-8")
+        sheet_url = f"data:image/jpeg;base64,{encoded}"
+        return [
+            {"type": "text", "text": "Here are the numbered symbols"},
+            {
+                "type": "image_url",
+                "image_url": {"url": sheet_url, "detail": "high"},
+            },
+        ]
+    content = []
+    for number, item in enumerate(items, start=1):
+        content.append({"type": "text", "text": f"Symbol {number}:"})
+        content.append(
+            {
+                "type": "image_url",
+                "image_url": {
+                    "url": artifacts.to_data_url(item["image"]),
+                    "detail": "high",
+                },
+            }
+        )
+    return content
+
+
+def parse_matches(content, count):
+    """
+    Validate the JSON answer of a batched request. Returns the name matched for
+    each 1-based symbol number, numbers missing from the answer are left out.
+    """
+    try:
+        matches = SymbolMatches.model_validate_json(content).matches
+    except ValidationError as e:
+        logging.warning(f"Invalid batched answer: {e}")
+        return {}
+    return {
+        match.index: match.name.strip()
+        for match in matches
+        if 1 <= match.index <= count and match.name.strip()
+    }
+
+
+def analyze_symbols_batch(
+    items, reference_img, analyze_prompt, strategy="parts", reference_detail=None
+):
+    """
+    Match several cropped symbols against the legend in a single chat completion.
+    Symbols answered by an earlier batch of the same strategy are not sent, and
+    the symbols missing from the model answer fall back to single-symbol requests.
+    """
+    model = os.environ["OPENAI_MODEL"]
+    items = [
+        {
+            **item,
+            "reference_img": reference_img,
+            "reference_detail": reference_detail,
+            "analyze_prompt": analyze_prompt,
+        }
+        for item in items
+    ]
+    results = [None] * len(items)
+    pending = []
+    for position, item in enumerate(items):
+        cached = get_cache(item).get(symbol_cache_key(item, model, strategy))
+        if cached is not None:
+            results[position] = symbol_result(
+                item, cached["openai_response"], cache_hit=True
+            )
+        else:
+            pending.append(position)
+
+    if len(pending) == 1:
+        results[pending[0]] = analyze_symbol(items[pending[0]])
+    elif pending:
+        batch = [items[position] for position in pending]
+        layout = (
+            " in a single image, each one below its number"
+            if strategy == "contact_sheet"
+            else ", each one after its number"
+        )
+        instructions = BATCH_INSTRUCTIONS.format(count=len(batch), layout=layout)
+        messages = [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": f"{analyze_prompt}\n{instructions}"},
+                    {"type": "image_url", "image_url": reference_image_url(batch[0])},
+                ],
+            },
+            {"role": "user", "content": _batch_symbol_content(batch, strategy)},
+        ]
+        response = rate_limit.chat_completion(
+            model=model,
+            messages=messages,
+            response_format={"type": "json_object"},
+        )
+        names = parse_matches(response.choices[0].message.content, len(batch))
+        logging.info(f"Batched answer matched {len(names)} of {len(batch)} symbols")
+
+        for number, position in enumerate(pending, start=1):
+            item = items[position]
+            if number in names:
+                get_cache(item).set(
+                    symbol_cache_key(item, model, strategy),
+                    {"openai_response": names[number]},
+                )
+                results[position] = symbol_result(item, names[number], cache_hit=False)
+            else:
+                results[position] = analyze_symbol(item)
+    return results
@@ -0,0 +1,220 @@
+"""
+Local matching of the cropped symbols against the patches of the reference legend.
+
+The legend is segmented once into candidate symbol patches with projection
+profiles: its rows are separated by blank lines, and every row is split into
+entries at wide blank gaps, the first blob of an entry being its symbol and the
+rest its description. Patches and crops are normalized to small zero-mean,
+unit-norm vectors, so that a single matrix product gives the normalized cross
+correlation of every crop variant (several scales and the four rotations)
+against every patch.
+
+The patches are labeled by the model once per orchestration with label_legend,
+in batches, and their boxes and labels are passed to every match_symbols call.
+Crops whose best match is confident reuse the label of their patch, the others
+are left to the model.
+"""
+
+import base64
+import logging
+from io import BytesIO
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+from shared_code import artifacts, symbol_analysis
+from shared_code.reference import trim_whitespace
+
+TEMPLATE_SIZE = 32
+BLUR_RADIUS = 1.5
+# Fractions of the crop kept around its center, the crops include padding and
+# neighbouring walls that the legend patches do not have
+MATCH_SCALES = (1.0, 0.85, 0.7)
+INK_LEVEL = 160
+# Blank gap, relative to the row height, separating two legend entries
+ENTRY_GAP = 1.5
+# Blank gap, relative to the row height, separating a symbol from its text
+SYMBOL_GAP = 0.4
+MIN_PATCH_SIDE = 6
+# Legend patches labeled by a single chat completion
+LABEL_BATCH_SIZE = 16
+DEFAULT_MATCH_MARGIN = 0.1
+
+
+def _runs(profile):
+    """(start, end) of the runs of True values of a 1-D boolean array."""
+    padded = np.concatenate(([False], profile, [False]))
+    changes = np.flatnonzero(padded[1:] != padded[:-1])
+    return list(zip(changes[::2], changes[1::2]))
+
+
+def _split(runs, min_gap):
+    """Group runs separated by less than min_gap."""
+    groups = []
+    for start, end in runs:
+        if groups and start - groups[-1][1] < min_gap:
+            groups[-1] = (groups[-1][0], end)
+        else:
+            groups.append((start, end))
+    return groups
+
+
+def segment_legend(image):
+    """
+    Boxes (left, top, right, bottom) of the candidate symbol patches of a legend
+    image, in pixels.
+    """
+    ink = np.asarray(image.convert("L")) < INK_LEVEL
+    boxes = []
+    for top, bottom in _runs(ink.any(axis=1)):
+        row = ink[top:bottom]
+        height = bottom - top
+        if height < MIN_PATCH_SIDE:
+            continue
+        blobs = _runs(row.any(axis=0))
+        for entry_start, entry_end in _split(blobs, ENTRY_GAP * height):
+            entry = [blob for blob in blobs if entry_start <= blob[0] < entry_end]
+            left, right = _split(entry, SYMBOL_GAP * height)[0]
+            rows = np.flatnonzero(row[:, left:right].any(axis=1))
+            box = (int(left), int(top + rows[0]), int(right), int(top + rows[-1] + 1))
+            if min(box[2] - box[0], box[3] - box[1]) >= MIN_PATCH_SIDE:
+                boxes.append(box)
+    return boxes
+
+
+def normalize(image, size=TEMPLATE_SIZE):
+    """
+    Zero-mean, unit-norm vector of an image: the ink is trimmed, padded to a
+    square to keep the aspect ratio, resized, blurred and inverted so that ink
+    is high.
+    """
+    image = trim_whitespace(image.convert("L"))
+    side = max(image.size)
+    square = Image.new("L", (side, side), 255)
+    square.paste(image, ((side - image.width) // 2, (side - image.height) // 2))
+    # Blurring makes the correlation tolerant to small offsets of thin strokes
+    small = square.resize((size, size), Image.Resampling.BOX).filter(
+        ImageFilter.GaussianBlur(BLUR_RADIUS)
+    )
+    pixels = 255.0 - np.asarray(small, dtype=np.float32)
+    pixels = pixels.ravel() - pixels.mean()
+    norm = np.linalg.norm(pixels)
+    return pixels / norm if norm else pixels
+
+
+def crop_variants(image, scales=MATCH_SCALES):
+    """Normalized vectors of the centered scales and rotations of a crop."""
+    image = image.convert("L")
+    variants = []
+    for scale in scales:
+        width, height = image.width * scale, image.height * scale
+        left, top = (image.width - width) / 2, (image.height - height) / 2
+        scaled = image.crop(
+            (round(left), round(top), round(left + width), round(top + height))
+        )
+        for angle in (0, 90, 180, 270):
+            variants.append(normalize(scaled.rotate(angle, expand=True)))
+    return np.stack(variants)
+
+
+def match_scores(crops, templates, scales=MATCH_SCALES):
+    """
+    Best normalized cross correlation of each crop against each template, as a
+    (crops, templates) array. Templates are vectors returned by normalize.
+    """
+    variants = np.stack([crop_variants(crop, scales) for crop in crops])
+    scores = variants @ np.asarray(templates).T
+    return scores.max(axis=1)
+
+
+def best_matches(scores, labels, threshold, margin):
+    """
+    For each row of scores, the index of the best template and its score, and
+    whether the match is confident: the score reaches the threshold and beats
+    the best template with a different label by at least the margin.
+    """
+    matches = []
+    for row in scores:
+        best = int(row.argmax())
+        others = [score for score, label in zip(row, labels) if label != labels[best]]
+        runner_up = max(others) if others else -1.0
+        confident = row[best] >= threshold and row[best] - runner_up >= margin
+        matches.append((best, float(row[best]), bool(confident)))
+    return matches
+
+
+def _patch_url(patch):
+    buffered = BytesIO()
+    patch.save(buffered, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(buffered.getvalue()).decode()
+
+
+def label_patches(
+    legend, boxes, reference_img, analyze_prompt, reference_detail, use_cache
+):
+    """Answer of the model for each legend patch, as if it were a detected crop."""
+    items = [
+        {
+            "bounding_box": dict(zip(("left", "top", "right", "bottom"), box)),
+            "tag": "legend",
+            "probability": None,
+            "image": _patch_url(legend.crop(box)),
+            "use_cache": use_cache,
+        }
+        for box in boxes
+    ]
+    labels = []
+    for start in range(0, len(items), LABEL_BATCH_SIZE):
+        results = symbol_analysis.analyze_symbols_batch(
+            items[start : start + LABEL_BATCH_SIZE],
+            reference_img,
+            analyze_prompt,
+            reference_detail=reference_detail,
+        )
+        labels.extend(result["openai_response"] for result in results)
+    return labels
+
+
+def _load_legend(reference_img):
+    return Image.open(BytesIO(artifacts.load_bytes(reference_img))).convert("L")
+
+
+def label_legend(reference_img, analyze_prompt, reference_detail=None, use_cache=True):
+    """
+    Segment the legend into symbol patches and label each of them with the
+    model. Returns the boxes of the patches and their labels.
+    """
+    legend = _load_legend(reference_img)
+    boxes = segment_legend(legend)
+    logging.info(f"Segmented {len(boxes)} legend patches")
+    labels = (
+        label_patches(
+            legend, boxes, reference_img, analyze_prompt, reference_detail, use_cache
+        )
+        if boxes
+        else []
+    )
+    return {"boxes": [list(box) for box in boxes], "labels": labels}
+
+
+def match_symbols(
+    items, reference_img, patches, threshold, margin=DEFAULT_MATCH_MARGIN
+):
+    """
+    Match the cropped symbols against the legend patches labeled by
+    label_legend. Returns, for each item, the best score and the label of the
+    matched patch when the match is confident (None otherwise).
+    """
+    boxes = [tuple(box) for box in patches["boxes"]]
+    if not boxes or not items:
+        return [{"answer": None, "score": None} for _ in items]
+
+    legend = _load_legend(reference_img)
+    labels = patches["labels"]
+    templates = [normalize(legend.crop(box)) for box in boxes]
+    crops = [Image.open(BytesIO(artifacts.load_bytes(item["image"]))) for item in items]
+    matches = best_matches(match_scores(crops, templates), labels, threshold, margin)
+    return [
+        {"answer": labels[best] if confident else None, "score": round(score, 4)}
+        for best, score, confident in matches
+    ]
@@ -0,0 +1,52 @@
+"""
+Shared fixtures of the tests, run from the repository root with python -m pytest.
+
+The activities run against the offline fake backends of benchmarks.fake_backends,
+with the application settings of the benchmarks, so no Azure service is needed.
+"""
+
+import json
+import os
+
+import pytest
+
+from benchmarks.fake_backends import FakeBackends
+from benchmarks.pipeline_benchmark import ENVIRONMENT
+
+for name, value in ENVIRONMENT.items():
+    os.environ.setdefault(name, value)
+
+
+@pytest.fixture
+def backends():
+    """Fake Blob Storage, Custom Vision and Azure OpenAI clients."""
+    with FakeBackends() as installed:
+        yield installed
+
+
+@pytest.fixture(autouse=True)
+def artifact_cache():
+    """Start every test with an empty artifact cache."""
+    from shared_code import artifacts
+
+    def clear():
+        with artifacts._cache_lock:
+            artifacts._cache.clear()
+            artifacts._cache_size = 0
+        artifacts._created_containers.clear()
+
+    clear()
+    yield
+    clear()
+
+
+@pytest.fixture
+def activity():
+    """Run an activity function with a payload, its result going through JSON."""
+    import function_app
+
+    def run(name, payload):
+        function = getattr(function_app, name)._function._func
+        return json.loads(json.dumps(function(json.dumps(payload))))
+
+    return run
@@ -0,0 +1,76 @@
+import base64
+
+from shared_code import artifacts
+
+PNG = b"\x89PNG fake image bytes"
+
+
+def stored(backends):
+    return {
+        name: data
+        for (container, name), data in backends.blob.blobs.items()
+        if container == artifacts.DEFAULT_ARTIFACT_CONTAINER
+    }
+
+
+def test_references_are_parsed_back():
+    ref = artifacts.make_ref("scratch", "ab/cd.png")
+    assert ref == "artifact://scratch/ab/cd.png"
+    assert artifacts.is_artifact_ref(ref)
+    assert not artifacts.is_artifact_ref("data:image/png;base64,AAAA")
+    assert not artifacts.is_artifact_ref(None)
+    assert artifacts.parse_ref(ref) == ("scratch", "ab/cd.png")
+    assert artifacts.ref_hash(ref) == "cd"
+    assert artifacts.content_type_of(ref) == "image/png"
+    assert artifacts.content_type_of("artifact://scratch/x.bin") == (
+        "application/octet-stream"
+    )
+
+
+def test_put_and_get_round_trip(backends):
+    ref = artifacts.put_artifact(PNG, "image/png")
+    digest = artifacts.content_hash(PNG)
+    assert ref == f"artifact://{artifacts.DEFAULT_ARTIFACT_CONTAINER}/{digest}.png"
+    assert stored(backends) == {f"{digest}.png": PNG}
+    # The same content is stored once under the same reference
+    assert artifacts.put_artifact(PNG, "image/png") == ref
+    assert len(stored(backends)) == 1
+
+    artifacts._cache.clear()
+    assert artifacts.get_artifact(ref) == PNG
+    assert artifacts.load_bytes(ref) == PNG
+    assert artifacts.hash_image(ref) == digest
+
+
+def test_images_are_read_from_references_data_urls_and_base64(backends):
+    encoded = base64.b64encode(PNG).decode()
+    ref = artifacts.put_artifact(PNG, "image/png")
+    for value in (ref, f"data:image/png;base64,{encoded}", encoded):
+        assert artifacts.load_bytes(value) == PNG
+        assert artifacts.hash_image(value) == artifacts.content_hash(PNG)
+    assert artifacts.to_data_url(ref) == f"data:image/png;base64,{encoded}"
+    assert artifacts.to_data_url(encoded) == f"data:image/jpeg;base64,{encoded}"
+
+
+def test_cache_keeps_the_most_recently_used_artifacts(backends, monkeypatch):
+    monkeypatch.setenv("ARTIFACT_CACHE_BYTES", "20")
+    first = artifacts.put_artifact(b"a" * 8, "image/png")
+    second = artifacts.put_artifact(b"b" * 8, "image/png")
+    # Reading the first one makes the second the least recently used
+    assert artifacts.get_artifact(first) == b"a" * 8
+    third = artifacts.put_artifact(b"c" * 8, "image/png")
+    assert list(artifacts._cache) == [first, third]
+    assert artifacts._cache_size == 16
+
+    # Cached artifacts are not downloaded again, evicted ones are
+    backends.blob.blobs.clear()
+    assert artifacts.get_artifact(third) == b"c" * 8
+    backends.blob.blobs[artifacts.parse_ref(second)] = b"b" * 8
+    assert artifacts.get_artifact(second) == b"b" * 8
+    assert list(artifacts._cache) == [third, second]
+
+
+def test_artifacts_larger_than_the_cache_are_not_kept(backends, monkeypatch):
+    monkeypatch.setenv("ARTIFACT_CACHE_BYTES", "4")
+    artifacts.put_artifact(PNG, "image/png")
+    assert not artifacts._cache
@@ -0,0 +1,133 @@
+import asyncio
+import threading
+
+from shared_code import clients
+
+
+class AsyncClient:
+    """Asynchronous client recording the event loop it is closed on."""
+
+    def __init__(self, *settings):
+        self.settings = settings
+        self.closed_on = None
+
+    async def close(self):
+        self.closed_on = asyncio.get_running_loop()
+
+
+class Client:
+    def __init__(self, *settings):
+        self.settings = settings
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_clients_are_shared_until_their_settings_change():
+    registry = clients.ClientRegistry()
+    first = registry.get("blob", ("a", 10), Client)
+    assert registry.get("blob", ("a", 10), Client) is first
+    assert first.settings == ("a", 10)
+
+    second = registry.get("blob", ("a", 20), Client)
+    assert second is not first
+    assert first.closed and not second.closed
+
+
+def test_override_replaces_the_factory_until_restored():
+    registry = clients.ClientRegistry()
+    default = registry.get("openai", ("a",), Client)
+    stand_in = Client()
+    registry.override("openai", lambda *settings: stand_in)
+    assert default.closed
+    assert registry.get("openai", ("a",), Client) is stand_in
+
+    registry.override("openai", None)
+    restored = registry.get("openai", ("a",), Client)
+    assert restored is not stand_in and restored.settings == ("a",)
+
+
+def test_clear_closes_every_client():
+    registry = clients.ClientRegistry()
+    blob = registry.get("blob", ("a",), Client)
+    openai = registry.get("openai", ("b",), Client)
+    registry.clear()
+    assert blob.closed and openai.closed
+    assert registry.get("blob", ("a",), Client) is not blob
+
+
+def test_async_client_is_closed_on_its_running_loop():
+    registry = clients.ClientRegistry()
+
+    async def recreate():
+        loop = asyncio.get_running_loop()
+        client = registry.get("async_blob", ("a", loop), AsyncClient)
+        registry.get("async_blob", ("b", loop), AsyncClient)
+        # The closing task is kept until it completes
+        assert clients._closing_tasks
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        return client, loop
+
+    client, loop = asyncio.run(recreate())
+    assert client.closed_on is loop
+    assert not clients._closing_tasks
+
+
+def test_async_client_is_closed_on_its_loop_from_another_thread():
+    registry = clients.ClientRegistry()
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+    try:
+        client = registry.get("async_openai", ("a", loop), AsyncClient)
+        registry.clear()
+        asyncio.run_coroutine_threadsafe(asyncio.sleep(0), loop).result(timeout=5)
+        assert client.closed_on is loop
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+def test_async_client_of_an_idle_loop_is_closed_on_it():
+    registry = clients.ClientRegistry()
+    loop = asyncio.new_event_loop()
+    try:
+        client = registry.get("async_blob", ("a", loop), AsyncClient)
+
+        async def recreate_from_other_loop():
+            registry.get("async_blob", ("a", asyncio.get_running_loop()), AsyncClient)
+
+        asyncio.run(recreate_from_other_loop())
+        assert client.closed_on is loop
+    finally:
+        loop.close()
+
+
+def test_async_client_of_a_closed_loop_is_closed_on_a_new_one():
+    registry = clients.ClientRegistry()
+    loop = asyncio.new_event_loop()
+    client = registry.get("async_blob", ("a", loop), AsyncClient)
+    loop.close()
+    registry.clear()
+    assert client.closed_on is not None and client.closed_on is not loop
+
+
+def test_blob_service_client_is_recreated_with_the_pool_size(monkeypatch):
+    monkeypatch.setattr(clients, "registry", clients.ClientRegistry())
+    monkeypatch.setenv("BLOB_CONNECTION_STRING", "UseDevelopmentStorage=true")
+    monkeypatch.setenv("HTTP_POOL_SIZE", "4")
+    client = clients.get_blob_service_client()
+    assert clients.get_blob_service_client() is client
+
+    monkeypatch.setenv("HTTP_POOL_SIZE", "8")
+    assert clients.get_blob_service_client() is not client
+
+
+def test_pooled_session_keeps_pool_size_connections():
+    session = clients.pooled_session(7)
+    adapter = session.get_adapter("https://example.blob.core.windows.net")
+    assert adapter._pool_maxsize == 7
+    assert adapter._pool_connections == 7
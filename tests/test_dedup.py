@@ -0,0 +1,81 @@
+import base64
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+
+from shared_code import metrics
+from shared_code.dedup import (
+    cluster_hashes,
+    difference_hash,
+    format_hash,
+    hamming_distance,
+    match_known,
+)
+
+
+def symbol(offset=0, size=64):
+    image = Image.new("L", (size, size), 255)
+    draw = ImageDraw.Draw(image)
+    draw.ellipse((8 + offset, 8, 40 + offset, 40), outline=0, width=3)
+    draw.line((8, 56, 56, 56), fill=0, width=3)
+    return image
+
+
+def test_difference_hash_of_near_identical_crops_is_close():
+    base = difference_hash(symbol())
+    assert difference_hash(symbol().convert("RGB")) == base
+    assert hamming_distance(base, difference_hash(symbol(offset=1))) <= 8
+    different = Image.new("L", (64, 64), 255)
+    ImageDraw.Draw(different).rectangle((4, 4, 30, 60), fill=0)
+    assert hamming_distance(base, difference_hash(different)) > 16
+    assert len(format_hash(base)) == 16
+
+
+def test_cluster_hashes_groups_close_hashes_of_the_same_tag():
+    hashes = [0b0000, 0b0001, 0b1111, 0b0001]
+    tags = ["door", "door", "door", "outlet"]
+    assert cluster_hashes(hashes, tags, threshold=1) == [0, 0, 2, 3]
+
+
+def test_cluster_hashes_with_a_zero_threshold_groups_identical_hashes():
+    assert cluster_hashes([5, 4, 5], ["door"] * 3, threshold=0) == [0, 1, 0]
+
+
+def test_match_known_finds_the_first_known_hash_of_the_same_tag():
+    matches = match_known(
+        [0b0000, 0b1111, 0b0000],
+        ["door", "door", "outlet"],
+        known_hashes=[0b1000, 0b0001],
+        known_tags=["outlet", "door"],
+        threshold=1,
+    )
+    assert matches == [1, None, 0]
+
+
+def test_crop_detections_groups_near_identical_symbols(activity):
+    plan = Image.new("L", (256, 64), 255)
+    for left in (0, 64, 128):
+        plan.paste(symbol(), (left, 0))
+    ImageDraw.Draw(plan).rectangle((196, 8, 248, 56), fill=0)
+    detections = [
+        {
+            "tag": "door",
+            "probability": 0.9,
+            "bounding_box": {"left": left / 256, "top": 0, "width": 0.25, "height": 1},
+        }
+        for left in (0, 64, 128, 192)
+    ]
+    buffered = BytesIO()
+    plan.save(buffered, format="PNG")
+    result = activity(
+        "crop_detections",
+        {
+            "image_data": base64.b64encode(buffered.getvalue()).decode(),
+            "detections": detections,
+            "padding": 0,
+            "dedup_threshold": 4,
+        },
+    )
+    crops = metrics.result_of(result)
+    assert [crop["representative"] for crop in crops] == [0, 0, 0, 3]
+    assert all(len(crop["hash"]) == 16 for crop in crops)
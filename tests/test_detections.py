@@ -0,0 +1,99 @@
+import json
+
+import numpy as np
+
+from shared_code.detections import (
+    DetectionTable,
+    non_max_suppression,
+    plan_tile_cores,
+    plan_tiles,
+)
+
+
+def prediction(tag, probability, left, top, width=0.1, height=0.1):
+    return {
+        "tag": tag,
+        "probability": probability,
+        "bounding_box": {"left": left, "top": top, "width": width, "height": height},
+    }
+
+
+def test_non_max_suppression_keeps_the_best_of_overlapping_boxes():
+    boxes = [[0, 0, 10, 10], [1, 1, 10, 10], [20, 20, 10, 10]]
+    keep = non_max_suppression(boxes, [0.6, 0.9, 0.5], iou_threshold=0.5)
+    assert keep.tolist() == [1, 2]
+
+
+def test_non_max_suppression_keeps_boxes_of_other_classes():
+    boxes = [[0, 0, 10, 10], [1, 1, 10, 10]]
+    keep = non_max_suppression(boxes, [0.6, 0.9], 0.5, class_ids=[0, 1])
+    assert keep.tolist() == [1, 0]
+
+
+def test_non_max_suppression_of_no_boxes():
+    assert non_max_suppression([], [], 0.5).size == 0
+
+
+def test_detection_table_filters_and_merges_duplicates_per_tag():
+    table = DetectionTable.from_predictions(
+        [
+            prediction("door", 0.9, 0.10, 0.10),
+            prediction("door", 0.8, 0.11, 0.11),
+            prediction("outlet", 0.7, 0.11, 0.11),
+            prediction("outlet", 0.3, 0.50, 0.50),
+        ]
+    )
+    retained = table.filter(0.5).nms(0.5).sort()
+    assert [(p["tag"], p["probability"]) for p in retained.to_predictions()] == [
+        ("door", 0.9),
+        ("outlet", 0.7),
+    ]
+    stats = retained.tag_stats()
+    assert stats["door"]["count"] == 1
+    assert sum(stats["outlet"]["area_histogram"]) == 1
+
+
+def test_detection_table_round_trips_through_its_dict():
+    table = DetectionTable.from_predictions(
+        [prediction("door", 0.9, 0.1, 0.2), prediction("outlet", 0.4, 0.3, 0.4)]
+    )
+    copy = DetectionTable.from_dict(table.to_dict())
+    assert copy.to_predictions() == table.to_predictions()
+
+
+def test_detection_table_within_keeps_the_centers_of_a_region():
+    table = DetectionTable.from_predictions(
+        [prediction("door", 0.9, 0.0, 0.0), prediction("door", 0.8, 0.45, 0.0)]
+    )
+    region = {"left": 0.0, "top": 0.0, "width": 0.5, "height": 1.0}
+    assert len(table.within(region)) == 1
+
+
+def test_plan_tile_cores_cover_the_image_once():
+    width, height, tile_size, overlap = 2500, 1300, 1000, 128
+    tiles = plan_tiles(width, height, tile_size, overlap)
+    cores = plan_tile_cores(width, height, tile_size, overlap)
+    assert len(cores) == len(tiles)
+    coverage = np.zeros((height, width), dtype=np.int64)
+    for (left, top, right, bottom), tile in zip(cores, tiles):
+        # Every core lies within its tile
+        assert tile[0] <= left and tile[1] <= top
+        assert right <= tile[2] and bottom <= tile[3]
+        coverage[int(top) : int(bottom), int(left) : int(right)] += 1
+    assert (coverage == 1).all()
+
+
+def test_aggregation_activity_returns_the_retained_table(activity):
+    detections = [
+        json.dumps(prediction("door", 0.9, 0.10, 0.10)),
+        json.dumps(prediction("door", 0.8, 0.11, 0.11)),
+        json.dumps(prediction("window", 0.2, 0.60, 0.60)),
+    ]
+    aggregation = activity(
+        "aggregate_detections_activity",
+        {"detections": detections, "min_probability": 0.5, "iou_threshold": 0.5},
+    )
+    retained = DetectionTable.from_dict(aggregation["table"]).to_predictions()
+    assert [(p["tag"], p["probability"]) for p in retained] == [("door", 0.9)]
+    assert aggregation["stats"]["door"]["count"] == 1
+    assert "window" not in aggregation["stats"]
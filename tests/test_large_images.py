@@ -0,0 +1,150 @@
+import struct
+import subprocess
+import sys
+import zlib
+from io import BytesIO
+from pathlib import Path
+
+import pytest
+from PIL import Image, ImageDraw
+
+from shared_code import large_images
+
+ROOT = Path(__file__).resolve().parents[1]
+# Decoded in full, the large plan would take 144 MB
+LARGE_SIZE = (8000, 6000)
+MAX_PEAK_BYTES = 60 * 1024 * 1024
+
+MEASURE = """
+import resource
+import sys
+
+from shared_code import large_images
+
+
+def peak():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+with open(sys.argv[1], "rb") as source:
+    before = peak()
+    boxes = [(10, 10, 110, 110), (2000, 100, 3000, 1900), (7000, 5800, 8000, 6000)]
+    regions = dict(large_images.crop_regions(source, boxes))
+    assert [regions[index].size for index in range(3)] == [
+        (100, 100),
+        (1000, 1800),
+        (1000, 200),
+    ]
+    del regions
+    copy = large_images.working_copy(
+        large_images.open_image(source), source, 4_000_000
+    )
+    assert copy.size == (2000, 1500)
+    print(peak() - before)
+"""
+
+
+def png_chunk(chunk_type, data):
+    return (
+        struct.pack(">I", len(data))
+        + chunk_type
+        + data
+        + struct.pack(">I", zlib.crc32(chunk_type + data))
+    )
+
+
+def write_large_png(path, width, height):
+    """An RGB PNG written row by row, never held in memory as a whole."""
+    compressor = zlib.compressobj(1)
+    row = b"\0" + bytes(index % 251 for index in range(width * 3))
+    with open(path, "wb") as file:
+        file.write(b"\x89PNG\r\n\x1a\n")
+        file.write(
+            png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        )
+        for _ in range(height):
+            data = compressor.compress(row)
+            if data:
+                file.write(png_chunk(b"IDAT", data))
+        file.write(png_chunk(b"IDAT", compressor.flush()))
+        file.write(png_chunk(b"IEND", b""))
+
+
+def plan(width=300, height=200, mode="RGB"):
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    for index in range(0, width, 7):
+        draw.line((index, 0, width - index, height), fill=(index % 256, 40, 90))
+    return image.convert(mode)
+
+
+def encoded(image, image_format="PNG"):
+    buffered = BytesIO()
+    image.save(buffered, format=image_format)
+    buffered.seek(0)
+    return buffered
+
+
+def test_open_image_rejects_images_above_the_source_limit(monkeypatch):
+    monkeypatch.setenv("MAX_SOURCE_PIXELS", "50000")
+    assert large_images.open_image(encoded(plan(250, 200))).size == (250, 200)
+    with pytest.raises(ValueError, match="MAX_SOURCE_PIXELS"):
+        large_images.open_image(encoded(plan(300, 200)))
+    # Above twice the limit Pillow refuses the image itself
+    with pytest.raises(ValueError, match="MAX_SOURCE_PIXELS"):
+        large_images.open_image(encoded(plan(500, 300)))
+
+
+def test_open_image_raises_the_limit_of_pillow_only_while_opening(monkeypatch):
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 1000)
+    source = encoded(plan())
+    assert large_images.open_image(source).size == (300, 200)
+    assert Image.MAX_IMAGE_PIXELS == 1000
+    with pytest.raises(Image.DecompressionBombError):
+        Image.open(source)
+
+
+@pytest.mark.parametrize("mode", ["RGB", "L", "RGBA"])
+def test_crop_regions_match_the_decoded_image(monkeypatch, mode):
+    # Bands of a few rows, so that regions span several of them
+    monkeypatch.setattr(large_images, "BAND_BYTES", 4000)
+    image = plan(mode=mode)
+    boxes = [(0, 0, 300, 200), (10, 5, 60, 25), (100, 30, 250, 190), (5, 180, 9, 200)]
+    regions = dict(large_images.crop_regions(encoded(image), boxes))
+    assert sorted(regions) == [0, 1, 2, 3]
+    for index, box in enumerate(boxes):
+        assert regions[index].tobytes() == image.crop(box).tobytes()
+
+
+def test_working_copy_of_a_png_is_reduced_band_by_band(monkeypatch):
+    monkeypatch.setattr(large_images, "BAND_BYTES", 4000)
+    image = plan()
+    source = encoded(image)
+    copy = large_images.working_copy(large_images.open_image(source), source, 10_000)
+    assert copy.tobytes() == image.reduce(3).tobytes()
+
+
+def test_read_plan_writes_the_size_of_the_plan_in_its_working_copy():
+    data, content_type = large_images.read_plan(encoded(plan()), max_pixels=10_000)
+    copy = Image.open(BytesIO(data))
+    assert content_type == "image/png"
+    assert copy.size == (100, 67)
+    assert large_images.plan_size(copy) == (300, 200)
+    # Plans within the limit are returned as they are
+    source = encoded(plan(), "JPEG")
+    assert large_images.read_plan(source) == (source.getvalue(), "image/jpeg")
+
+
+def test_large_plans_are_decoded_in_bounded_memory(tmp_path):
+    pytest.importorskip("resource")
+    path = tmp_path / "large.png"
+    write_large_png(path, *LARGE_SIZE)
+    # A new interpreter, whose peak memory is not raised by other tests
+    measured = subprocess.run(
+        [sys.executable, "-c", MEASURE, str(path)],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert int(measured.stdout) < MAX_PEAK_BYTES
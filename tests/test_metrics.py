@@ -0,0 +1,100 @@
+import asyncio
+import json
+import logging
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+from shared_code import metrics
+
+
+@metrics.instrumented
+def answer(activitypayload):
+    metrics.record(image_width=640)
+    metrics.record_usage(SimpleNamespace(prompt_tokens=100, completion_tokens=7))
+    return json.loads(activitypayload)
+
+
+@metrics.instrumented
+async def answer_async(activitypayload):
+    metrics.record_usage(SimpleNamespace(prompt_tokens=50, completion_tokens=None))
+    return json.loads(activitypayload)
+
+
+@metrics.instrumented
+def fail(activitypayload):
+    raise ValueError("failed")
+
+
+def test_dict_results_get_a_metrics_entry():
+    result = answer(json.dumps({"openai_response": "Door"}))
+    assert result["openai_response"] == "Door"
+    assert set(result["metrics"]) <= set(metrics.RETURNED_FIELDS)
+    assert result["metrics"]["prompt_tokens"] == 100
+    assert result["metrics"]["completion_tokens"] == 7
+    assert result["metrics"]["image_width"] == 640
+    assert result["metrics"]["output_bytes"] == len('{"openai_response": "Door"}')
+    assert metrics.result_of(result) is result
+    assert metrics.call_metrics(result) == result["metrics"]
+
+
+def test_list_results_are_wrapped_in_an_envelope():
+    result = answer(json.dumps([{"metrics": "kept"}, 2]))
+    assert set(result) == {"result", "metrics"}
+    # The items of the list are left as they are
+    assert metrics.result_of(result) == [{"metrics": "kept"}, 2]
+    assert metrics.result_of(json.loads(json.dumps(result))) == result["result"]
+    assert metrics.call_metrics(result) == result["metrics"]
+
+
+def test_other_results_are_returned_unchanged():
+    assert answer('"summary"') == "summary"
+    assert metrics.result_of("summary") == "summary"
+    assert metrics.call_metrics("summary") == {"output_bytes": len('"summary"')}
+    # A dict with other keys than the envelope is not unwrapped
+    assert metrics.result_of({"result": 1}) == {"result": 1}
+
+
+def test_asynchronous_activities_are_instrumented():
+    result = asyncio.run(answer_async(json.dumps({"answer": 1})))
+    assert result["answer"] == 1
+    assert result["metrics"]["prompt_tokens"] == 50
+    assert result["metrics"]["completion_tokens"] == 0
+
+
+def test_failed_calls_are_logged_and_raised(caplog):
+    with caplog.at_level(logging.INFO, logger="vision_agent.metrics"):
+        with pytest.raises(ValueError):
+            fail("{}")
+    fields = caplog.records[-1].custom_dimensions
+    assert fields["activity"] == "fail" and fields["succeeded"] is False
+    # Fields recorded outside of an activity are dropped
+    metrics.record(image_width=1)
+    metrics.record_usage(SimpleNamespace(prompt_tokens=1, completion_tokens=1))
+
+
+def test_stage_metrics_add_up_the_calls():
+    started = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    calls = [
+        {"duration_ms": 300, "output_bytes": 10, "prompt_tokens": 5},
+        {"duration_ms": 100, "output_bytes": 20, "prompt_tokens": 6},
+    ]
+    entry = metrics.stage_metrics(
+        "analyzing", started, started + timedelta(seconds=1), ["ab", "cde"], calls, 2
+    )
+    assert entry == {
+        "stage": "analyzing",
+        "calls": 2,
+        "wall_ms": 1000,
+        "input_bytes": 5,
+        "output_bytes": 30,
+        "activity_ms": 400,
+        "queue_ms": 800,
+        "prompt_tokens": 11,
+    }
+    # Without every duration, the activity and queue times are unknown
+    partial = metrics.stage_metrics(
+        "analyzing", started, started, ["ab"], [{"output_bytes": 3}]
+    )
+    assert "activity_ms" not in partial and "queue_ms" not in partial
@@ -0,0 +1,104 @@
+import base64
+import json
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from benchmarks.onnx_parity import FIXTURE, match_predictions
+from shared_code import onnx_detection
+
+pytest.importorskip("onnxruntime")
+
+MIN_PROBABILITY = 0.5
+
+
+@pytest.fixture
+def fixture_model(monkeypatch):
+    monkeypatch.setenv("ONNX_MODEL_PATH", str(FIXTURE / "model.onnx"))
+    monkeypatch.setenv("ONNX_MIN_PROBABILITY", str(MIN_PROBABILITY))
+
+
+def recorded():
+    return json.loads((FIXTURE / "recorded_predictions.json").read_text())
+
+
+def assert_agree(cloud, local):
+    cloud = [p for p in cloud if p["probability"] >= MIN_PROBABILITY]
+    pairs = match_predictions(cloud, local, iou_threshold=0.5)
+    # Every detection is paired, with the same box and probability
+    assert len(pairs) == len(cloud) == len(local)
+    for cloud_index, local_index, iou in pairs:
+        assert iou > 0.99
+        assert cloud[cloud_index]["probability"] == pytest.approx(
+            local[local_index]["probability"], abs=0.05
+        )
+
+
+def test_fixture_model_agrees_with_the_recorded_predictions(fixture_model):
+    for name, cloud in recorded().items():
+        with Image.open(FIXTURE / "images" / name) as image:
+            assert_agree(cloud, onnx_detection.detect_image(image))
+
+
+def test_images_are_detected_in_batches_of_the_batch_size(monkeypatch, fixture_model):
+    monkeypatch.setenv("ONNX_BATCH_SIZE", "4")
+    detector = onnx_detection.get_onnx_detector()
+    assert detector.batch_size == 4 and detector.input_size == (64, 64)
+    names = sorted(recorded())
+    images = [Image.open(FIXTURE / "images" / name) for name in names]
+    for name, local in zip(names, detector.detect(images, MIN_PROBABILITY)):
+        assert_agree(recorded()[name], local)
+
+
+def test_symbolic_input_dimensions_use_the_configured_size(monkeypatch, tmp_path):
+    pytest.importorskip("onnx")
+    from benchmarks import onnx_fixture
+
+    model_path = tmp_path / "model.onnx"
+    onnx_fixture.build_model(model_path, input_shape=(None, 3, "height", "width"))
+    detector = onnx_detection.OnnxDetector(
+        str(model_path),
+        str(FIXTURE / "labels.txt"),
+        batch_size=2,
+        input_size=onnx_fixture.INPUT_SIZE,
+    )
+    assert detector.input_size == (64, 64)
+    assert not detector.fixed_batch and detector.batch_size == 2
+    name, cloud = next(iter(recorded().items()))
+    with Image.open(FIXTURE / "images" / name) as image:
+        assert_agree(cloud, detector.detect([image], MIN_PROBABILITY)[0])
+
+
+def test_preprocess_follows_the_pixel_layout_of_the_model():
+    image = Image.new("RGB", (4, 2), (255, 0, 0))
+    bgr = onnx_detection.preprocess([image, image], (8, 8))
+    assert bgr.shape == (2, 3, 8, 8) and bgr.dtype == np.float32
+    assert bgr[0, 2].max() == 255 and bgr[0, 0].max() == 0
+    rgb = onnx_detection.preprocess([image], (8, 8), bgr=False, range_255=False)
+    assert rgb[0, 0].min() == 1.0 and rgb[0, 2].max() == 0.0
+
+
+def test_boxes_are_clipped_and_weak_detections_dropped():
+    boxes = np.array([[-0.1, 0.2, 0.5, 1.2], [0.1, 0.1, 0.2, 0.2]])
+    predictions = onnx_detection.to_predictions(
+        boxes, np.array([0.9, 0.05]), np.array([1, 0]), ["door", "window"], 0.5
+    )
+    assert predictions == [
+        {
+            "tag": "window",
+            "probability": 0.9,
+            "bounding_box": {"left": 0.0, "top": 0.2, "width": 0.5, "height": 0.8},
+        }
+    ]
+
+
+def test_object_detection_activity_with_the_onnx_backend(activity, fixture_model):
+    name, cloud = next(iter(recorded().items()))
+    image_data = base64.b64encode((FIXTURE / "images" / name).read_bytes()).decode()
+    detection = activity(
+        "object_detection", {"image_data": image_data, "backend": "onnx"}
+    )
+    local = [json.loads(p) for p in detection["result"]]
+    assert_agree(cloud, local)
+    assert detection["metrics"]["image_width"] == 256
@@ -0,0 +1,195 @@
+from io import BytesIO
+
+import pytest
+from PIL import Image, ImageDraw
+
+import function_app
+from benchmarks.pipelined_latency import START, Simulation, plan_objects
+from shared_code import artifacts, result_store
+
+PLAN_SIDE = 1000
+INPUT = {
+    "container": "plans",
+    "filename": "plan.png",
+    "reference_filename": "legend.png",
+    "analyze_prompt": "Which legend symbol is this?",
+    "use_cache": False,
+}
+
+
+class RecordingSimulation(Simulation):
+    """Simulation recording the activities run and the inputs of the chunks."""
+
+    def __init__(self, objects):
+        super().__init__(function_app, objects, workers=64, latency_scale=1.0)
+        self.activities = []
+        self.chunks = []
+
+    def run_activity(self, name, *args, **kwargs):
+        self.activities.append(name)
+        return super().run_activity(name, *args, **kwargs)
+
+    def run_orchestrator(self, name, orchestration_input, *args, **kwargs):
+        if name == "analysis_chunk_orchestrator":
+            self.chunks.append(orchestration_input)
+        return super().run_orchestrator(name, orchestration_input, *args, **kwargs)
+
+
+def png(image):
+    buffered = BytesIO()
+    image.save(buffered, format="PNG")
+    return buffered.getvalue()
+
+
+def store_plan(backends, objects, distinct=True):
+    """
+    A plan with a symbol drawn in the box of each object, distinct unless
+    distinct is False, and its legend.
+    """
+    plan = Image.new("RGB", (PLAN_SIDE, PLAN_SIDE), "white")
+    draw = ImageDraw.Draw(plan)
+    for index, prediction in enumerate(objects):
+        box = prediction["bounding_box"]
+        left, top = box["left"] * PLAN_SIDE, box["top"] * PLAN_SIDE
+        right = left + box["width"] * PLAN_SIDE
+        bottom = top + box["height"] * PLAN_SIDE
+        draw.rectangle((left, top, right, bottom), outline="black")
+        shift = index if distinct else 0
+        draw.line((left, top + shift % 7, right, bottom - shift % 5), fill="black")
+    legend = Image.new("RGB", (200, 60), "white")
+    ImageDraw.Draw(legend).ellipse((10, 10, 40, 40), outline="black", width=3)
+    backends.blob.blobs[("plans", "plan.png")] = png(plan)
+    backends.blob.blobs[("plans", "legend.png")] = png(legend)
+
+
+def run(simulation, **options):
+    return simulation.run_orchestrator(
+        "vision_agent_orchestrator", {**INPUT, **options}, START
+    ).result
+
+
+def answers(output):
+    return [
+        (detection["bounding_box"], detection["openai_response"])
+        for detection in output["detections"]
+    ]
+
+
+@pytest.mark.parametrize(
+    "options", [{}, {"tile_size": 400}, {"tile_size": 400, "pipelined": True}]
+)
+def test_chunked_analysis_passes_artifact_references(backends, options):
+    objects = plan_objects(40, seed=1)
+    store_plan(backends, objects)
+    inline = run(RecordingSimulation(objects), **options)
+
+    simulation = RecordingSimulation(objects)
+    chunked = run(simulation, chunk_size=10, **options)
+    assert answers(chunked) == answers(inline)
+    assert len(simulation.chunks) >= 2
+    for chunk in simulation.chunks:
+        assert set(chunk) >= {"images", "use_cache", "analysis"}
+        assert "items" not in chunk
+        assert 0 < len(chunk["images"]) <= 10
+        assert all(artifacts.is_artifact_ref(image) for image in chunk["images"])
+
+
+@pytest.mark.parametrize("seed_plans, analyzed_plans", [(0, 3), (1, 1)])
+def test_batch_plans_wait_for_the_symbols_of_the_seed_plans(
+    backends, seed_plans, analyzed_plans
+):
+    objects = plan_objects(12, seed=2)
+    store_plan(backends, objects)
+    analyzed = run(RecordingSimulation(objects))["match_stats"]["model"]
+    for name in ("copy-1.png", "copy-2.png"):
+        backends.blob.blobs[("plans", name)] = backends.blob.blobs[
+            ("plans", "plan.png")
+        ]
+
+    simulation = RecordingSimulation(objects)
+    output = simulation.run_orchestrator(
+        "batch_orchestrator",
+        {
+            **INPUT,
+            "filenames": ["plan.png", "copy-1.png", "copy-2.png"],
+            "max_concurrent_plans": 3,
+            "seed_plans": seed_plans,
+        },
+        START,
+    ).result
+    assert len(output["plans"]) == 3 and not output["failed"]
+    stats = [plan["match_stats"] for plan in output["plans"].values()]
+    assert sum(plan_stats["model"] for plan_stats in stats) == (
+        analyzed_plans * analyzed
+    )
+    assert output["dedup_stats"]["answered_from_other_plans"] == (
+        (3 - analyzed_plans) * analyzed
+    )
+
+
+@pytest.mark.parametrize("dedup_threshold", [0, 10, 64])
+def test_pipelined_deduplication_spans_the_tiles(backends, dedup_threshold):
+    objects = plan_objects(40, seed=3)
+    store_plan(backends, objects, distinct=False)
+    options = {"tile_size": 400, "dedup_threshold": dedup_threshold}
+    barrier = run(RecordingSimulation(objects), **options)
+    pipelined = run(RecordingSimulation(objects), pipelined=True, **options)
+    analyzed = barrier["match_stats"]["model"]
+    assert analyzed < len(barrier["detections"])
+    assert pipelined["match_stats"]["model"] == analyzed
+    assert pipelined["dedup_stats"] == barrier["dedup_stats"]
+    # The groups may have other representatives, analyzed in another order
+    boxes = sorted(str(box) for box, _ in answers(barrier))
+    assert sorted(str(box) for box, _ in answers(pipelined)) == boxes
+
+
+@pytest.mark.parametrize("pipelined", [False, True])
+def test_stored_results_answer_the_runs_with_the_same_inputs(
+    backends, monkeypatch, tmp_path, pipelined
+):
+    monkeypatch.setenv("RESULT_STORE_BACKEND", "sqlite")
+    monkeypatch.setenv("RESULT_STORE_PATH", str(tmp_path / "results.sqlite"))
+    objects = plan_objects(12, seed=4)
+    store_plan(backends, objects)
+    options = {"pipelined": pipelined, "use_stored_result": True, "use_cache": True}
+    first = run(RecordingSimulation(objects), **options)
+    assert "stored_record" not in first
+
+    simulation = RecordingSimulation(objects)
+    stored = run(simulation, **options)
+    assert stored["stored_record"]["record_id"] == "plan"
+    assert answers(stored) == answers(first)
+    # The images are read once for their hashes, and nothing else is run
+    assert sorted(simulation.activities) == [
+        "lookup_result",
+        "prepare_reference",
+        "read_image",
+    ]
+
+    # Without caching the run is not looked up, and symbols known from other
+    # plans make another run key
+    known = [{"hash": "0" * 16, "tag": "Door", "answer": "Door"}]
+    for other, looked_up in (
+        ({"use_cache": False}, False),
+        ({"known_symbols": known}, True),
+    ):
+        simulation = RecordingSimulation(objects)
+        output = run(simulation, **{**options, **other})
+        assert "stored_record" not in output
+        assert "object_detection" in simulation.activities
+        assert ("lookup_result" in simulation.activities) == looked_up
+
+
+def test_runs_are_stored_without_looking_them_up(backends, monkeypatch, tmp_path):
+    monkeypatch.setenv("RESULT_STORE_BACKEND", "sqlite")
+    monkeypatch.setenv("RESULT_STORE_PATH", str(tmp_path / "results.sqlite"))
+    objects = plan_objects(12, seed=4)
+    store_plan(backends, objects)
+    simulation = RecordingSimulation(objects)
+    run(simulation)
+    assert "lookup_result" not in simulation.activities
+    assert simulation.activities.count("read_image") == 1
+    plan_hash = artifacts.content_hash(backends.blob.blobs[("plans", "plan.png")])
+    records = result_store.get_result_store().query(image_hash=plan_hash)
+    assert [record["record_id"] for record in records] == ["plan"]
+    assert records[0]["options"]["known_symbols"] is None
@@ -0,0 +1,87 @@
+import openai
+import pytest
+
+from benchmarks.fake_backends import FakeBackends, FaultProfile
+from shared_code import rate_limit
+from shared_code.rate_limit import AdaptiveRateLimiter
+
+
+def test_concurrency_limit_bounds_the_requests_in_flight():
+    limiter = AdaptiveRateLimiter(max_concurrency=2)
+    assert limiter.try_acquire(10) == 0
+    assert limiter.try_acquire(10) == 0
+    assert limiter.try_acquire(10) > 0
+    limiter.release(10)
+    assert limiter.try_acquire(10) == 0
+
+
+def test_request_budget_asks_to_wait():
+    limiter = AdaptiveRateLimiter(rpm=1)
+    assert limiter.try_acquire(10) == 0
+    assert 0 < limiter.try_acquire(10) <= 60
+
+
+def test_throttled_calls_halve_the_limit_and_pause_every_caller():
+    limiter = AdaptiveRateLimiter(max_concurrency=8)
+    limiter.try_acquire(10)
+    limiter.release(10, headers={"retry-after": "2"}, throttled=True)
+    assert limiter.concurrency_limit == 4
+    assert 0 < limiter.try_acquire(10) <= 2
+
+
+def test_successful_calls_grow_the_limit_back_and_failures_do_not():
+    limiter = AdaptiveRateLimiter(max_concurrency=4)
+    limiter.concurrency_limit = 2
+    for _ in range(2):
+        limiter.try_acquire(10)
+        limiter.release(10, failed=True)
+    assert limiter.concurrency_limit == 2
+    for _ in range(2):
+        limiter.try_acquire(10)
+        limiter.release(10)
+    assert limiter.concurrency_limit == 3
+    assert limiter.in_flight == 0
+
+
+def test_a_burst_of_throttled_calls_halves_the_limit_once():
+    limiter = AdaptiveRateLimiter(max_concurrency=16)
+    windows = [limiter.acquire(10) for _ in range(16)]
+    for window in windows:
+        limiter.release(10, throttled=True, window=window)
+    assert limiter.concurrency_limit == 8
+
+    # Only a call started after the decrease decreases it again
+    limiter.paused_until = 0.0
+    window = limiter.acquire(10)
+    limiter.release(10, throttled=True, window=window)
+    assert limiter.concurrency_limit == 4
+    assert limiter.in_flight == 0
+
+
+def throttling_backends(monkeypatch, attempts, budget):
+    monkeypatch.setenv("OPENAI_RETRY_ATTEMPTS", str(attempts))
+    monkeypatch.setenv("OPENAI_RETRY_BUDGET", str(budget))
+    monkeypatch.setattr(rate_limit, "_limiter", None)
+    monkeypatch.setattr(rate_limit, "backoff_delay", lambda attempt, retry_after: 0.0)
+    return FakeBackends(
+        openai_profile=FaultProfile(throttle_rate=1.0, retry_after_ms=1)
+    )
+
+
+def test_throttled_completions_are_retried_up_to_the_attempts(monkeypatch):
+    with throttling_backends(monkeypatch, attempts=2, budget=60) as backends:
+        with pytest.raises(openai.RateLimitError):
+            rate_limit.chat_completion(
+                model="gpt-4o", messages=[{"role": "user", "content": "Hi"}]
+            )
+    assert backends.openai.profile.calls == 3
+    assert rate_limit.get_rate_limiter().in_flight == 0
+
+
+def test_retries_stop_at_the_retry_budget(monkeypatch):
+    with throttling_backends(monkeypatch, attempts=6, budget=0) as backends:
+        with pytest.raises(openai.RateLimitError):
+            rate_limit.chat_completion(
+                model="gpt-4o", messages=[{"role": "user", "content": "Hi"}]
+            )
+    assert backends.openai.profile.calls == 1
@@ -0,0 +1,87 @@
+import pytest
+
+from shared_code import result_cache, symbol_analysis
+
+CROP = "data:image/png;base64,QUJD"
+REFERENCE = "data:image/png;base64,REVG"
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(result_cache.time, "time", lambda: now[0])
+    return now
+
+
+def test_cache_key_covers_every_input():
+    parts = ("crop", "legend", "prompt", "gpt-4o", "2024-02-01")
+    key = result_cache.cache_key(*parts)
+    assert key == result_cache.cache_key(*parts)
+    for position in range(len(parts)):
+        changed = list(parts)
+        changed[position] += "!"
+        assert result_cache.cache_key(*changed) != key
+    # Parts are delimited, moving a character between them changes the key
+    assert result_cache.cache_key("cro", "plegend", *parts[2:]) != key
+
+
+def test_sqlite_cache_expires_entries(tmp_path, clock):
+    cache = result_cache.SqliteResultCache(str(tmp_path / "cache.sqlite"), 60)
+    cache.set("key", {"openai_response": "Door"})
+    assert cache.get("key") == {"openai_response": "Door"}
+    assert cache.get("other") is None
+    clock[0] += 61
+    assert cache.get("key") is None
+
+
+def test_sqlite_cache_evicts_the_least_recently_used(tmp_path, clock):
+    cache = result_cache.SqliteResultCache(
+        str(tmp_path / "cache.sqlite"), max_entries=2
+    )
+    cache.set("first", 1)
+    clock[0] += 1
+    cache.set("second", 2)
+    clock[0] += 1
+    assert cache.get("first") == 1
+    clock[0] += 1
+    cache.set("third", 3)
+    assert cache.get("second") is None
+    assert (cache.get("first"), cache.get("third")) == (1, 3)
+
+
+def test_blob_cache_round_trip_and_expiry(backends, clock):
+    cache = result_cache.BlobResultCache("cache", ttl_seconds=60)
+    cache.set("key", {"openai_response": "Door"})
+    assert cache.get("key") == {"openai_response": "Door"}
+    assert cache.get("missing") is None
+    clock[0] += 61
+    assert cache.get("key") is None
+    assert ("cache", "key.json") not in backends.blob.blobs
+
+
+def test_get_result_cache_follows_the_settings(tmp_path, monkeypatch):
+    monkeypatch.setenv("RESULT_CACHE_BACKEND", "none")
+    assert isinstance(result_cache.get_result_cache(), result_cache.NullResultCache)
+    monkeypatch.setenv("RESULT_CACHE_BACKEND", "sqlite")
+    monkeypatch.setenv("RESULT_CACHE_PATH", str(tmp_path / "cache.sqlite"))
+    cache = result_cache.get_result_cache()
+    assert isinstance(cache, result_cache.SqliteResultCache)
+    assert result_cache.get_result_cache() is cache
+
+
+def test_analyzed_symbols_are_answered_from_the_cache(backends, tmp_path, monkeypatch):
+    monkeypatch.setenv("RESULT_CACHE_BACKEND", "sqlite")
+    monkeypatch.setenv("RESULT_CACHE_PATH", str(tmp_path / "cache.sqlite"))
+    data = {"image": CROP, "reference_img": REFERENCE, "analyze_prompt": "Which?"}
+
+    first = symbol_analysis.analyze_symbol(data)
+    second = symbol_analysis.analyze_symbol(data)
+    assert (first["cache_hit"], second["cache_hit"]) == (False, True)
+    assert second["openai_response"] == first["openai_response"]
+    assert backends.openai.profile.calls == 1
+
+    # Another prompt, or use_cache set to false, calls the model again
+    symbol_analysis.analyze_symbol({**data, "analyze_prompt": "Which one?"})
+    uncached = symbol_analysis.analyze_symbol({**data, "use_cache": False})
+    assert not uncached["cache_hit"]
+    assert backends.openai.profile.calls == 3
@@ -0,0 +1,79 @@
+import pytest
+
+from shared_code import result_store
+
+
+def output(answer):
+    return {
+        "detections": [
+            {
+                "openai_response": answer,
+                "bounding_box": {"left": 0.1, "top": 0.2, "width": 0.3, "height": 0.4},
+                "custom_vision_tag": "door",
+                "probability": 0.9,
+                "match_source": "model",
+                "match_score": None,
+            }
+        ],
+        "aggregated_detections": {},
+        "summary": "One door.",
+    }
+
+
+def record(record_id, created, image_hash, prompt, answer):
+    return {
+        "record_id": record_id,
+        "schema_version": result_store.SCHEMA_VERSION,
+        "created": created,
+        "run_key": f"key-{record_id}",
+        "image_hash": image_hash,
+        "reference_hash": "reference",
+        "prompt_hash": result_store.prompt_hash(prompt),
+        "model": "gpt-4o",
+        "filename": "plan.png",
+        "output": result_store.compact_output(output(answer)),
+    }
+
+
+def test_compact_output_round_trips():
+    expanded = result_store.expand_output(result_store.compact_output(output("A")))
+    assert expanded["detections"] == output("A")["detections"]
+    assert expanded["aggregated_detections"]["door"][0]["probability"] == 0.9
+
+
+@pytest.fixture(params=["sqlite", "blob"])
+def store(request, tmp_path):
+    if request.param == "sqlite":
+        return result_store.SqliteResultStore(str(tmp_path / "results.sqlite"))
+    request.getfixturevalue("backends")
+    return result_store.BlobResultStore("results")
+
+
+def test_store_round_trip(store):
+    store.put(record("first", "2025-01-01T00:00:00", "plan", "prompt", "A"))
+    store.put(record("second", "2025-01-02T00:00:00", "plan", "other prompt", "B"))
+    store.put(record("third", "2025-01-03T00:00:00", "other plan", "prompt", "C"))
+
+    latest = store.latest("key-first", result_store.prompt_hash("prompt"), "plan")
+    assert latest == record("first", "2025-01-01T00:00:00", "plan", "prompt", "A")
+    assert store.latest("missing", "prompt", "plan") is None
+
+    def ids(records):
+        return [stored["record_id"] for stored in records]
+
+    assert ids(store.query(image_hash="plan")) == ["second", "first"]
+    assert ids(store.query(prompt_version=result_store.prompt_hash("prompt"))) == [
+        "third",
+        "first",
+    ]
+    assert ids(store.query()) == ["third", "second", "first"]
+
+
+def test_symbols_digest_identifies_the_known_symbols():
+    symbols = [{"hash": "00ff", "tag": "door", "answer": "A"}]
+    assert result_store.symbols_digest([]) is None
+    digest = result_store.symbols_digest(symbols)
+    assert digest == result_store.symbols_digest(
+        [{"answer": "A", "tag": "door", "hash": "00ff"}]
+    )
+    assert digest != result_store.symbols_digest([{**symbols[0], "answer": "B"}])
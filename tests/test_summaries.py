@@ -0,0 +1,19 @@
+from shared_code.summaries import estimate_tokens, split_lines
+
+
+def test_split_lines_keeps_the_parts_within_the_budget():
+    lines = [f"door {index}: OUTLET at the entrance" for index in range(40)]
+    parts = split_lines(lines, token_budget=50)
+    assert [line for part in parts for line in part] == lines
+    assert len(parts) > 1
+    assert all(estimate_tokens(part) <= 50 for part in parts)
+
+
+def test_split_lines_puts_two_lines_in_a_part_even_over_the_budget():
+    lines = ["x" * 400] * 5
+    parts = split_lines(lines, token_budget=10)
+    assert [len(part) for part in parts] == [2, 2, 1]
+
+
+def test_split_lines_of_small_tables_is_a_single_part():
+    assert split_lines(["a", "b"], token_budget=1000) == [["a", "b"]]
@@ -0,0 +1,78 @@
+import base64
+import json
+from io import BytesIO
+
+from PIL import Image
+
+from shared_code import symbol_analysis
+
+REFERENCE = "data:image/png;base64,REVG"
+
+
+def crop(color):
+    buffered = BytesIO()
+    Image.new("RGB", (16, 16), color).save(buffered, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(buffered.getvalue()).decode()
+
+
+def items(count):
+    colors = ("red", "green", "blue", "black")
+    return [{"image": crop(colors[index]), "tag": "door"} for index in range(count)]
+
+
+def test_parse_matches_keeps_the_valid_numbered_names():
+    content = json.dumps(
+        {
+            "matches": [
+                {"index": 1, "name": " Door "},
+                {"index": 2, "name": "  "},
+                {"index": 4, "name": "Window"},
+                {"index": 3, "name": "Outlet"},
+            ]
+        }
+    )
+    assert symbol_analysis.parse_matches(content, 3) == {1: "Door", 3: "Outlet"}
+
+
+def test_parse_matches_of_an_invalid_answer_is_empty():
+    assert symbol_analysis.parse_matches("Door, Window", 2) == {}
+    assert symbol_analysis.parse_matches('{"matches": [{"index": 1}]}', 1) == {}
+
+
+def test_batch_sends_one_request_for_all_the_symbols(backends):
+    results = symbol_analysis.analyze_symbols_batch(items(3), REFERENCE, "Which?")
+    assert backends.openai.profile.calls == 1
+    assert [result["custom_vision_tag"] for result in results] == ["door"] * 3
+    assert all(result["openai_response"] for result in results)
+
+
+def test_symbols_missing_from_the_batch_answer_are_asked_alone(backends, monkeypatch):
+    complete = backends.openai.complete
+    requests = []
+
+    def drop_second(messages, response_format=None, **kwargs):
+        requests.append(response_format)
+        completion = complete(messages, response_format=response_format, **kwargs)
+        if response_format:
+            answer = json.loads(completion.choices[0].message.content)
+            answer["matches"] = [m for m in answer["matches"] if m["index"] != 2]
+            completion.choices[0].message.content = json.dumps(answer)
+        return completion
+
+    monkeypatch.setattr(backends.openai, "complete", drop_second)
+    results = symbol_analysis.analyze_symbols_batch(items(3), REFERENCE, "Which?")
+    # One batched request, then a single-symbol request for the second symbol
+    assert requests == [{"type": "json_object"}, None]
+    assert all(result["openai_response"] for result in results)
+    assert [result["cache_hit"] for result in results] == [False] * 3
+
+
+def test_contact_sheet_numbers_every_symbol_in_a_grid():
+    images = [Image.new("RGB", (300, 100), "black")] * 5
+    sheet = symbol_analysis.contact_sheet(images)
+    cell = symbol_analysis.CONTACT_SHEET_CELL_SIZE
+    label = symbol_analysis.CONTACT_SHEET_LABEL_HEIGHT
+    assert sheet.size == (3 * cell, 2 * (cell + label))
+    # The crops are downscaled to fit in their cell
+    assert sheet.getpixel((cell // 2, label + 10)) == (0, 0, 0)
+    assert sheet.getpixel((cell // 2, label + cell - 20)) == (255, 255, 255)
@@ -0,0 +1,113 @@
+import base64
+from io import BytesIO
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from shared_code import template_matching
+
+SHAPES = ("circle", "square", "triangle", "cross")
+
+
+def draw_shape(draw, shape, left, top, side, width=3):
+    right, bottom = left + side, top + side
+    if shape == "circle":
+        draw.ellipse((left, top, right, bottom), outline="black", width=width)
+    elif shape == "square":
+        draw.rectangle((left, top, right, bottom), outline="black", width=width)
+    elif shape == "triangle":
+        points = [((left + right) / 2, top), (right, bottom), (left, bottom)]
+        draw.polygon(points, outline="black", width=width)
+    else:
+        draw.line((left, top, right, bottom), fill="black", width=width)
+        draw.line((left, bottom, right, top), fill="black", width=width)
+
+
+def legend():
+    """One shape per row, each followed by its description."""
+    image = Image.new("RGB", (400, 200), "white")
+    draw = ImageDraw.Draw(image)
+    for row, shape in enumerate(SHAPES):
+        draw_shape(draw, shape, 20, 20 + row * 45, 30)
+        draw.text((70, 30 + row * 45), f"{shape} symbol", fill="black")
+    return image
+
+
+def crop(shape, side=60, padding=12, width=5):
+    """A detected symbol: the shape at another scale, with some padding."""
+    image = Image.new("RGB", (side + 2 * padding, side + 2 * padding), "white")
+    draw_shape(ImageDraw.Draw(image), shape, padding, padding, side, width)
+    return image
+
+
+def data_url(image):
+    buffered = BytesIO()
+    image.save(buffered, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(buffered.getvalue()).decode()
+
+
+def test_legend_is_segmented_into_its_symbols():
+    boxes = template_matching.segment_legend(legend())
+    assert len(boxes) == len(SHAPES)
+    for row, (left, top, right, bottom) in enumerate(boxes):
+        # The symbol alone, without its description
+        assert 18 <= left <= 22 and 48 <= right <= 53
+        assert abs(top - (20 + row * 45)) <= 2 and bottom - top <= 33
+
+
+def test_normalized_vectors_are_centered_and_scale_invariant():
+    small = template_matching.normalize(crop("circle", 30, padding=2, width=3))
+    large = template_matching.normalize(crop("circle", 90, padding=30))
+    assert small.shape == (template_matching.TEMPLATE_SIZE**2,)
+    assert abs(small.mean()) < 1e-5
+    assert abs(np.linalg.norm(small) - 1) < 1e-5
+    assert small @ large > 0.9
+    assert small @ template_matching.normalize(crop("square", 30, 2, 3)) < 0.9
+    # A blank image has no ink to normalize
+    blank = template_matching.normalize(Image.new("L", (20, 20), 255))
+    assert not blank.any()
+
+
+def test_best_matches_need_the_threshold_and_the_margin():
+    scores = np.array([[0.9, 0.5, 0.85], [0.9, 0.85, 0.1], [0.6, 0.1, 0.1]])
+    labels = ["door", "window", "door"]
+    matches = template_matching.best_matches(scores, labels, 0.8, 0.1)
+    # A patch with the same label is not a runner-up
+    assert matches[0] == (0, 0.9, True)
+    assert matches[1][2] is False
+    assert matches[2][2] is False
+
+
+def test_symbols_are_matched_to_their_legend_patch():
+    image = legend()
+    patches = {
+        "boxes": [list(box) for box in template_matching.segment_legend(image)],
+        "labels": [f"{shape} symbol" for shape in SHAPES],
+    }
+    items = [
+        {"image": data_url(crop(shape).rotate(angle))}
+        for shape, angle in zip(SHAPES, (0, 90, 0, 180))
+    ]
+    results = template_matching.match_symbols(
+        items, data_url(image), patches, threshold=0.6
+    )
+    assert [result["answer"] for result in results] == patches["labels"]
+    assert all(result["score"] >= 0.6 for result in results)
+
+    unmatched = template_matching.match_symbols(
+        items, data_url(image), patches, threshold=1.01
+    )
+    assert [result["answer"] for result in unmatched] == [None] * len(SHAPES)
+    assert template_matching.match_symbols(
+        items[:1], data_url(image), {"boxes": [], "labels": []}, 0.6
+    ) == [{"answer": None, "score": None}]
+
+
+def test_legend_patches_are_labeled_in_one_batch(backends):
+    labeled = template_matching.label_legend(
+        data_url(legend()), "Which legend symbol is this?", use_cache=False
+    )
+    assert len(labeled["boxes"]) == len(SHAPES)
+    assert len(labeled["labels"]) == len(SHAPES)
+    assert all(label in backends.openai.answers for label in labeled["labels"])
+    assert backends.openai.profile.calls == 1